@@ -1,8 +1,13 @@
+from .cache import *
 from .cel import *
 from .em import *
 from .geom import *
 from .ion import *
+from .level import *
 from .misc import *
 from .orl import *
 from .pdf import *
+from .psf import *
+from .sparse import *
+from .table import *
 from .utils import *
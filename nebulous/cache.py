@@ -0,0 +1,243 @@
+from collections import OrderedDict
+import pyneb as pn
+import numpy as np
+import h5py, hashlib, os
+
+__all__ = [
+    'setCacheDir',
+    'getAtomicDataSet',
+    'getCachePath',
+    'loadCache',
+    'saveCache',
+    'LRUCache',
+    'enableMemo',
+    'disableMemo',
+    'fingerprint',
+]
+
+# ===================================================
+# Directory holding the cached tables. Set the
+# environment variable NEBULOUS_CACHE to change it
+# or call setCacheDir(None) to disable caching.
+# ===================================================
+cacheDir = os.environ.get('NEBULOUS_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'nebulous'))
+
+def setCacheDir(directory):
+    """
+    Sets the directory of the on-disk table cache; <None> disables it.
+    """
+    global cacheDir
+    cacheDir = directory
+
+def getAtomicDataSet(atom):
+    """
+    Returns a tuple identifying the atomic data files used by a
+    PyNeb Atom or RecAtom.
+    """
+    files = ('atomFile', 'collFile', 'recFitsFile')
+    return tuple(str(getattr(atom, f, None)) for f in files)
+
+def getCachePath(kind, atom, key):
+    """
+    Returns the path of the cache file for a table.
+
+    Parameters:
+        kind        kind of table (e.g. "emiss") {str}
+        atom        PyNeb Atom or RecAtom; None for tables that do not
+                    depend on the atomic data (e.g. geometries)
+        key         parameters defining the table {dict}
+
+    Returns:
+        path        path of the HDF5 file or None if caching is disabled
+
+    Postcondition:
+        The file name includes a hash of <key>, the PyNeb version and
+        the atomic data set, so changing any of them invalidates the cache.
+    """
+    if isinstance(cacheDir, type(None)):
+        return None
+
+    key = dict(key)
+    if isinstance(atom, type(None)):
+        name = kind
+    else:
+        key['pyneb'] = pn.__version__
+        key['data'] = getAtomicDataSet(atom)
+        name = '{:s}_{:s}'.format(kind, atom.atom)
+    digest = hashlib.sha1(repr(sorted(key.items())).encode()).hexdigest()[:16]
+
+    return os.path.join(cacheDir, '{:s}_{:s}.h5'.format(name, digest))
+
+def loadCache(path, mmap=True):
+    """
+    Loads the arrays stored in a cache file.
+
+    Parameters:
+        path        path of the HDF5 file
+        mmap        memory-map the arrays rather than reading them
+
+    Returns:
+        arrays      dictionary of arrays or None if the file does not exist
+    """
+    if isinstance(path, type(None)) or not os.path.isfile(path):
+        return None
+
+    arrays = {}
+    with h5py.File(path, 'r') as f:
+        for name, dset in f.items():
+            offset = dset.id.get_offset()
+            if mmap and not isinstance(offset, type(None)):
+                arrays[name] = np.memmap(path, mode='r', dtype=dset.dtype,
+                                         shape=dset.shape, offset=offset)
+            else:
+                arrays[name] = dset[()]
+
+    return arrays
+
+def saveCache(path, arrays, key=None):
+    """
+    Saves arrays to a cache file as contiguous (memory-mappable) datasets.
+
+    Parameters:
+        path        path of the HDF5 file
+        arrays      dictionary of arrays
+        key         parameters defining the table, stored as attributes
+
+    Postcondition:
+        The file is written under a temporary name and then moved into
+        place so that concurrent jobs never read a partial file.
+    """
+    if isinstance(path, type(None)):
+        return
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = '{:s}.{:d}.tmp'.format(path, os.getpid())
+
+    with h5py.File(temp, 'w') as f:
+        for name, value in arrays.items():
+            f.create_dataset(name, data=np.ascontiguousarray(value))
+        if key:
+            for name, value in key.items():
+                f.attrs[name] = str(value)
+
+    os.replace(temp, path)
+
+
+# ===================================================
+# In-memory memoization of emissivity computations
+# ===================================================
+class LRUCache:
+    """
+    Least-recently-used cache bounded by the total size (bytes)
+    of the arrays it holds. The cache keeps its own (read-only) copies
+    of the arrays and hands back writable copies, so that the callers
+    never share an array with the cache or with each other.
+    """
+
+    def __init__(self, maxBytes=2**30):
+        """
+        Parameters:
+            maxBytes        maximum total size of the cached arrays
+        """
+        self.maxBytes = maxBytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.data = OrderedDict()
+
+    def get(self, key):
+        """
+        Returns the value stored under <key> (or None), marking it
+        as the most recently used and updating the hit/miss counters.
+        """
+        if key in self.data:
+            self.data.move_to_end(key)
+            self.hits += 1
+            return copyArrays(self.data[key][0])
+
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """
+        Stores a copy of <value> (an array or tuple of arrays and scalars)
+        under <key>, evicting the least recently used entries to stay
+        within <self.maxBytes>.
+        """
+        values = value if isinstance(value, tuple) else (value,)
+        nbytes = sum(v.nbytes for v in values if isinstance(v, np.ndarray))
+
+        if nbytes > self.maxBytes:
+            return
+
+        value = copyArrays(value)
+        for v in (value if isinstance(value, tuple) else (value,)):
+            if isinstance(v, np.ndarray):
+                v.flags.writeable = False
+
+        if key in self.data:
+            self.nbytes -= self.data.pop(key)[1]
+
+        while self.data and self.nbytes + nbytes > self.maxBytes:
+            self.nbytes -= self.data.popitem(last=False)[1][1]
+
+        self.data[key] = (value, nbytes)
+        self.nbytes += nbytes
+
+    def clear(self):
+        self.data.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+def copyArrays(value):
+    """
+    Returns a copy of the arrays in <value> (an array or a tuple of
+    arrays and scalars); the other values are returned as they are.
+    """
+    if isinstance(value, tuple):
+        return tuple(copyArrays(v) for v in value)
+    if isinstance(value, np.ndarray):
+        return np.array(value)
+    return value
+
+memo = None
+
+def enableMemo(maxBytes=2**30):
+    """
+    Enables memoization of ion.getEmissivity and ion.getSkyEmiss
+    with a LRU cache of at most <maxBytes> bytes; returns the cache,
+    whose <hits> and <misses> attributes count the lookups.
+    """
+    global memo
+    memo = LRUCache(maxBytes=maxBytes)
+    return memo
+
+def disableMemo():
+    global memo
+    memo = None
+
+def fingerprint(x):
+    """
+    Returns a hashable fingerprint of an input: a digest of the
+    contents of arrays (or tuples and lists of arrays, e.g. <loc>,
+    and SparseCubes), and the value itself otherwise.
+    """
+    from .sparse import SparseCube
+
+    if isinstance(x, tuple):
+        return tuple(fingerprint(v) for v in x)
+
+    if isinstance(x, list):
+        return ("list",) + tuple(fingerprint(v) for v in x)
+
+    if isinstance(x, SparseCube):
+        return ("sparse", x.dim, fingerprint(x.index))
+
+    if isinstance(x, np.ndarray):
+        x = np.ascontiguousarray(x)
+        digest = hashlib.blake2b(x.view(np.uint8).ravel(), digest_size=16).hexdigest()
+        return (x.shape, x.dtype.str, digest)
+
+    return x
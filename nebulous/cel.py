@@ -1,9 +1,54 @@
+from  .cache import getCachePath, loadCache, saveCache
 from  .ion   import ion
-from  .utils import convl2D
+from  .level import getLineEmissivity
+from  .table import interp2D, monotonicInverse, monotonicSurface
+from  .utils import broadcastLOS, convl2D, getSkyValues
 import pyneb as pn
 import numpy as np
+import sys
+
+def getFuncKey(func):
+    """
+    Returns a hashable key identifying the line ratio function <func>
+    (used to key the inverse tables and surfaces).
+
+    Postcondition:
+        The key holds the bytecode, the constants (nested functions are
+        keyed recursively), the global and attribute names, the default
+        arguments and the contents of the closure cells, so that e.g.
+        np.sum and np.max ratios or closures over different values give
+        different keys. Values without a stable repr (such as arrays in
+        a closure) are keyed by their bytes.
+    """
+    def getValueKey(value):
+        if hasattr(value, '__code__'):
+            return getFuncKey(value)
+        if hasattr(value, 'co_code'):
+            return getCodeKey(value)
+        if isinstance(value, np.ndarray):
+            return (value.dtype.str, value.shape, value.tobytes())
+        if isinstance(value, (tuple, list)):
+            return tuple(getValueKey(v) for v in value)
+        return repr(value)
+
+    def getCodeKey(code):
+        return (code.co_code, getValueKey(code.co_consts), code.co_names)
+
+    cells = func.__closure__ or ()
+    return (
+        getCodeKey(func.__code__),
+        getValueKey(func.__defaults__ or ()),
+        tuple(getValueKey(c.cell_contents) for c in cells),
+    )
 
 class CEL(ion):
+
+    # Solve the level populations with the batched NumPy solver
+    backend = "native"
+
+    # Invert the line ratios with precomputed tables {"table", "pyneb"}
+    inversion = "table"
+
     def __init__(self, atom, ion, wave):
 
         if not isinstance(wave, tuple):
@@ -14,26 +59,216 @@ class CEL(ion):
 
         self.wave = wave
         self.atom = pn.Atom(atom, ion)
+        self.inverse = {}
 
-    def getEmissivity(self, tem, n_e, n_i=None, loc=None):
+    def makeTable(self, **kwargs):
+        super(CEL, self).makeTable(wave_param="wave", **kwargs)
+
+    def getEmissivity(self, tem, n_e, n_i=None, loc=None, **kwargs):
         super(CEL, self).getEmissivity(wave_param="wave",
-            tem=tem, n_e=n_e, n_i=n_i, loc=loc)
+            tem=tem, n_e=n_e, n_i=n_i, loc=loc, **kwargs)
 
-    def getTemDen(self, func=None, skyTem=None, skyDen=None, to_eval=None, los=None):
+    def getInverseTable(self, func, tem=None, den=None, nGrid=1000,
+                        temRange=(1e3, 1e5), denRange=(1e0, 1e8)):
         """
-        Computes the temperature or density.
+        Returns a monotonic table for inverting the line ratio <func>
+        into a temperature (at fixed <den>) or a density (at fixed <tem>).
+
+        Parameters:
+            func            function combining the line intensities
+            tem             temperature for density diagnostics
+            den             electron density for temperature diagnostics
+            nGrid           number of grid points
+            temRange        (min, max) temperature of the grid
+            denRange        (min, max) electron density of the grid
+
+        Returns:
+            ratio           log10 line ratios, increasing
+            value           corresponding log10 temperatures or densities
+
+        Postcondition:
+            The ratio is evaluated on a log-spaced grid and restricted to
+            its longest strictly monotonic run. Tables are stored in the
+            variable <self.inverse> and reused by later calls.
         """
-        # ============================================================
-        # Default temperature and density values
-        # ============================================================
-        default_density = 1e3
-        default_temperature = 10e3
+        key = (tem, den, getFuncKey(func), nGrid, temRange, denRange)
 
-        # ============================================================
-        # Get the atom type, the wavelengths, and the emission (intensity)
-        # observed along the line of sight.
-        # ============================================================
-        atom = self.atom
+        if key not in self.inverse:
+            if isinstance(tem, type(None)):
+                grid = np.linspace(*np.log10(temRange), nGrid)
+                emiss = getLineEmissivity(atom=self.atom, wave=self.wave,
+                    wave_param="wave", tem=10**grid, den=den, solver="native")
+            else:
+                grid = np.linspace(*np.log10(denRange), nGrid)
+                emiss = getLineEmissivity(atom=self.atom, wave=self.wave,
+                    wave_param="wave", tem=tem, den=10**grid, solver="native")
+
+            ratio = np.log10(func(*emiss))
+            self.inverse[key] = monotonicInverse(x=grid, y=ratio)
+
+        return self.inverse[key]
+
+    def getInverseSurface(self, func, kind, nGrid=1000, nCompanion=None,
+                          temRange=(1e3, 1e5), denRange=(1e0, 1e8), cache=True):
+        """
+        Returns a surface for inverting the line ratio <func> into a
+        temperature or a density when the companion quantity varies
+        between lines of sight.
+
+        Parameters:
+            func            function combining the line intensities
+            kind            quantity returned by the surface {"tem", "den"}
+            nGrid           number of points of the inverted and ratio grids
+            nCompanion      number of points of the companion grid; defaults
+                            to 0.01 dex (temperature) or 0.05 dex (density)
+            temRange        (min, max) temperature of the grid
+            denRange        (min, max) electron density of the grid
+            cache           store the surface in the on-disk cache
+
+        Returns:
+            surface         dictionary holding the inverse surface "value"
+                            (log10), shape (nCompanion, nGrid), the grids
+                            "companion" and "ratio" as (first value, spacing),
+                            and the ratio range "lo", "hi" of each companion
+
+        Postcondition:
+            Surfaces are stored in the variable <self.inverse> and, if
+            caching is enabled, in the on-disk cache.
+        """
+        if kind == "den":
+            valueRange, companionRange = denRange, temRange
+        else:
+            valueRange, companionRange = temRange, denRange
+
+        if isinstance(nCompanion, type(None)):
+            step = 0.01 if kind == "den" else 0.05
+            nCompanion = int(round(np.ptp(np.log10(companionRange)) / step)) + 1
+
+        key = {
+            "wave": self.wave,
+            "kind": kind,
+            "func": getFuncKey(func),
+            "python": sys.version_info[:2],
+            "value": (valueRange, nGrid),
+            "companion": (companionRange, nCompanion),
+        }
+        memoKey = tuple(sorted((k, repr(v)) for k, v in key.items()))
+
+        if memoKey in self.inverse:
+            return self.inverse[memoKey]
+
+        path = getCachePath("inverse", self.atom, key) if cache else None
+        surface = loadCache(path, mmap=False)
+
+        if isinstance(surface, type(None)):
+            # ==================================================
+            # Forward ratios on the (companion, value) grid
+            # ==================================================
+            valueGrid = np.linspace(*np.log10(valueRange), nGrid)
+            companionGrid = np.linspace(*np.log10(companionRange), nCompanion)
+            c, v = np.meshgrid(10**companionGrid, 10**valueGrid, indexing='ij')
+
+            tem, den = (c, v) if kind == "den" else (v, c)
+            emiss = getLineEmissivity(atom=self.atom, wave=self.wave,
+                wave_param="wave", tem=tem, den=den, solver="native")
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ratio = np.log10(func(*emiss))
+
+            # ==================================================
+            # Invert each row onto a shared ratio grid
+            # ==================================================
+            r0, dr, value, lo, hi = monotonicSurface(x=valueGrid, y=ratio, nRatio=nGrid)
+            surface = {
+                "value": value,
+                "companion": np.array([companionGrid[0], companionGrid[1] - companionGrid[0]]),
+                "ratio": np.array([r0, dr]),
+                "lo": lo,
+                "hi": hi,
+            }
+            saveCache(path, surface, key=key)
+
+        self.inverse[memoKey] = surface
+        return surface
+
+    def invertRatio(self, lineRatio, func, tem=None, den=None):
+        """
+        Converts line ratios into temperatures (given <den>) or densities
+        (given <tem>) using the precomputed inverse tables.
+
+        Parameters:
+            lineRatio       observed line ratios
+            func            function combining the line intensities
+            tem             temperature for density diagnostics
+            den             electron density for temperature diagnostics
+
+        Returns:
+            values          temperatures or densities
+            outOfRange      boolean array flagging the ratios outside of
+                            the table (their values are NaN)
+
+        Postcondition:
+            A constant companion (<tem> or <den>) uses a 1D inverse table,
+            while an array of companions (one per ratio) uses the 2D
+            inverse surface. Companions outside of the surface are also
+            flagged as out of range.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            logRatio = np.log10(lineRatio)
+
+        companion = tem if isinstance(den, type(None)) else den
+
+        if np.ndim(companion) == 0:
+            ratio, value = self.getInverseTable(func=func,
+                tem=None if isinstance(tem, type(None)) else float(tem),
+                den=None if isinstance(den, type(None)) else float(den))
+
+            outOfRange = (logRatio < ratio[0]) | (logRatio > ratio[-1])
+            values = 10**np.interp(logRatio, ratio, value)
+
+        else:
+            kind = "den" if isinstance(den, type(None)) else "tem"
+            surface = self.getInverseSurface(func=func, kind=kind)
+            c0, dc = surface["companion"]
+            r0, dr = surface["ratio"]
+            nc = len(surface["lo"])
+
+            logRatio, logCompanion = np.broadcast_arrays(logRatio,
+                np.log10(np.asarray(companion, dtype='float')))
+
+            # ==================================================
+            # Ratio range covered at each companion value
+            # ==================================================
+            companionGrid = c0 + dc * np.arange(nc)
+            lo = np.interp(logCompanion, companionGrid, surface["lo"])
+            hi = np.interp(logCompanion, companionGrid, surface["hi"])
+
+            outOfRange = (logRatio < lo) | (logRatio > hi) \
+                       | (logCompanion < companionGrid[0]) | (logCompanion > companionGrid[-1])
+
+            values = 10**interp2D(surface["value"], x=logCompanion.ravel(),
+                y=logRatio.ravel(), x0=c0, dx=dc, y0=r0, dy=dr, order=1)
+            values = values.reshape(logRatio.shape)
+
+        values[outOfRange | ~np.isfinite(logRatio)] = np.nan
+
+        return values, outOfRange
+
+    def getSkyRatio(self, func=None, los=None):
+        """
+        Computes the line ratio along the lines of sight.
+
+        Parameters:
+            func            function combining the line intensities
+            los             lines of sight
+
+        Returns:
+            lineRatio       line ratio on each line of sight
+            func            function used (the default if none was passed)
+            los             lines of sight used (those with non-zero
+                            emission if none were passed), broadcast
+                            over the kernel axis of the sky maps if any
+        """
         wave = self.wave
         skyEmiss = self.skyEmiss
 
@@ -55,6 +290,7 @@ class CEL(ion):
         # ============================================================
         if isinstance(los, type(None)):
             los = np.where(skyEmiss[1] > 0)
+        los = broadcastLOS(los, np.shape(skyEmiss)[1:])
 
         # ============================================================
         # Get the line intensities for each line of sight
@@ -69,6 +305,51 @@ class CEL(ion):
         # ============================================================
         lineRatio = func(*lineIntensity)
 
+        return lineRatio, func, los
+
+    def getTemDen(self, func=None, skyTem=None, skyDen=None, to_eval=None, los=None,
+                  inversion=None):
+        """
+        Computes the temperature or density.
+
+        Parameters:
+            func            function combining the line intensities
+            skyTem          temperature(s) for density diagnostics
+            skyDen          electron densit(y/ies) for temperature diagnostics
+            to_eval         PyNeb expression of the line ratio
+            los             lines of sight
+            inversion       ratio inversion method {"table", "pyneb"};
+                            defaults to <self.inversion>
+
+        Postcondition:
+            The estimates have the shape of the sky maps, including the
+            kernel axis of a kernel sweep (see ion.getSkyEmiss); sky maps
+            of <skyTem> or <skyDen> are broadcast over it.
+            With the "table" inversion, lines of sight whose ratio is
+            outside of the range of the table are set to NaN and flagged
+            in the boolean sky map <self.outOfRange>.
+        """
+        if isinstance(inversion, type(None)):
+            inversion = self.inversion
+        # ============================================================
+        # Default temperature and density values
+        # ============================================================
+        default_density = 1e3
+        default_temperature = 10e3
+
+        # ============================================================
+        # Get the atom type, the wavelengths, and the emission (intensity)
+        # observed along the line of sight.
+        # ============================================================
+        atom = self.atom
+        wave = self.wave
+        skyEmiss = self.skyEmiss
+
+        # ============================================================
+        # Compute the line ratio on each line of sight
+        # ============================================================
+        lineRatio, func, los = self.getSkyRatio(func=func, los=los)
+
         # ============================================================
         # Estimate the temperature if there are three wavelengths
         # ============================================================
@@ -85,8 +366,7 @@ class CEL(ion):
             # If an array respresenting the electron density across
             # the sky is passed, extract the densities for each LoS.
             # ========================================================
-            if isinstance(skyDen, np.ndarray):
-                skyDen = skyDen[los]
+            skyDen = getSkyValues(skyDen, los, skyEmiss[0].shape)
 
             # ========================================================
             # If no evaluation function was passed, add the intensities
@@ -101,11 +381,16 @@ class CEL(ion):
             # sky. Insert temperature estimates for each line of sight.
             # ========================================================
             skyTem = np.zeros_like(skyEmiss[0])
-            skyTem[los] = atom.getTemDen(
-                int_ratio = lineRatio,          # Intensity ratio
-                den=skyDen,                     # Electron densities
-                to_eval=to_eval                 # Line ratio function
-            )
+            self.outOfRange = np.zeros(skyEmiss[0].shape, dtype=bool)
+            if inversion == "table":
+                skyTem[los], self.outOfRange[los] = self.invertRatio(
+                    lineRatio=lineRatio, func=func, den=skyDen)
+            else:
+                skyTem[los] = atom.getTemDen(
+                    int_ratio = lineRatio,          # Intensity ratio
+                    den=skyDen,                     # Electron densities
+                    to_eval=to_eval                 # Line ratio function
+                )
 
             self.skyTem = skyTem
 
@@ -123,24 +408,28 @@ class CEL(ion):
             # If a sky map of the temperatures was passed, extract
             # the values associated with each line of sight.
             # ========================================================
-            if isinstance(skyTem, np.ndarray):
-                skyTem = skyTem[los]
+            skyTem = getSkyValues(skyTem, los, skyEmiss[0].shape)
 
             # ========================================================
             # Create an array to hold the density estimates on the sky
             # Insert the density estimates for each line of sight.
             # ========================================================
             skyDen = np.zeros_like(skyEmiss[0])
-            skyDen[los] = atom.getTemDen(
-                int_ratio = lineRatio,
-                tem=skyTem,
-                wave1=wave[0],
-                wave2=wave[1]
-            )
+            self.outOfRange = np.zeros(skyEmiss[0].shape, dtype=bool)
+            if inversion == "table":
+                skyDen[los], self.outOfRange[los] = self.invertRatio(
+                    lineRatio=lineRatio, func=func, tem=skyTem)
+            else:
+                skyDen[los] = atom.getTemDen(
+                    int_ratio = lineRatio,
+                    tem=skyTem,
+                    wave1=wave[0],
+                    wave2=wave[1]
+                )
 
             self.skyDen = skyDen
 
-    def getIonAbundance(self, skyTem, skyDen, Hbeta, los=None):
+    def getIonAbundance(self, skyTem, skyDen, Hbeta, los=None, backend=None):
         """
         Estimate the ionic abundances relative to hydrogen.
 
@@ -149,13 +438,15 @@ class CEL(ion):
             skyDen             Electron densities
             Hbeta           H-beta intensity on sky
             los             lines of sight
+            backend         emissivity backend (see ion.getIonAbundance)
         """
         super(CEL,self).getIonAbundance(
             skyTem=skyTem,
             skyDen=skyDen,
             Hbeta=Hbeta,
             los=los,
-            wave_param = "wave"
+            wave_param = "wave",
+            backend=backend
         )
 
 class ArIV_den(CEL):
@@ -322,3 +613,116 @@ cel_tem_dict = {
     'OIII'  : OIII_tem(),
     'SIII'  : SIII_tem()
 }
+
+def makeInverseSurfaces(**kwargs):
+    """
+    Precomputes (and stores in the on-disk cache) the inverse surfaces
+    of the default line ratios of the diagnostics in <cel_den_dict>
+    and <cel_tem_dict>. Keyword arguments are passed to
+    CEL.getInverseSurface.
+    """
+    for diagnostic in cel_den_dict.values():
+        diagnostic.getInverseSurface(func=lambda x,y: x/y, kind="den", **kwargs)
+
+    for diagnostic in cel_tem_dict.values():
+        diagnostic.getInverseSurface(func=lambda x,y,z: (x+y)/z, kind="tem", **kwargs)
+
+def getCrossTemDen(celTem, celDen, skyDen=1e3, funcTem=None, funcDen=None,
+                   los=None, tol=1e-4, maxIter=50):
+    """
+    Jointly solves for the temperature and the electron density on every
+    line of sight from a temperature and a density diagnostic.
+
+    Parameters:
+        celTem          temperature diagnostic (e.g. OIII_tem())
+        celDen          density diagnostic (e.g. SII_den())
+        skyDen          initial electron densit(y/ies)
+        funcTem         function combining the intensities of <celTem>
+        funcDen         function combining the intensities of <celDen>
+        los             lines of sight; defaults to those where both
+                        diagnostics have non-zero emission
+        tol             relative change of the temperature and density
+                        below which a line of sight has converged
+        maxIter         maximum number of iterations
+
+    Returns:
+        skyTem          temperatures on the sky
+        skyDen          electron densities on the sky
+        nIter           number of iterations of each line of sight
+        converged       boolean sky map of the converged lines of sight
+
+    Postcondition:
+        Both diagnostics must have called getSkyEmiss (with the same
+        kernel or list of kernels). The temperature and density are
+        updated in turn (fixed-point iteration) with the inverse surfaces
+        of CEL.invertRatio, all the unconverged lines of sight at once;
+        lines of sight stop iterating once converged or out of range
+        (NaN). The results are also stored in <celTem.skyTem>,
+        <celDen.skyDen> and the <outOfRange> maps of both diagnostics.
+    """
+    shape = celTem.skyEmiss[0].shape
+
+    if isinstance(los, type(None)):
+        los = np.where((celTem.skyEmiss[1] > 0) & (celDen.skyEmiss[1] > 0))
+    los = broadcastLOS(los, shape)
+
+    ratioTem, funcTem, _ = celTem.getSkyRatio(func=funcTem, los=los)
+    ratioDen, funcDen, _ = celDen.getSkyRatio(func=funcDen, los=los)
+
+    # ============================================================
+    # Per line of sight state
+    # ============================================================
+    den = np.broadcast_to(np.asarray(skyDen, dtype='float'), shape)[los].copy() \
+        if np.ndim(skyDen) else np.full(ratioTem.shape, float(skyDen))
+    tem = np.full(ratioTem.shape, np.nan)
+    nIter = np.zeros(ratioTem.shape, dtype=int)
+    outTem = np.zeros(ratioTem.shape, dtype=bool)
+    outDen = np.zeros(ratioTem.shape, dtype=bool)
+    active = np.ones(ratioTem.shape, dtype=bool)
+    converged = np.zeros(ratioTem.shape, dtype=bool)
+
+    for _ in range(maxIter):
+        idx = np.flatnonzero(active)
+        if idx.size == 0:
+            break
+
+        # ========================================================
+        # Update the temperature at the current density, then
+        # the density at the new temperature
+        # ========================================================
+        newTem, outTem[idx] = celTem.invertRatio(ratioTem[idx], func=funcTem, den=den[idx])
+        newDen, outDen[idx] = celDen.invertRatio(ratioDen[idx], func=funcDen, tem=newTem)
+
+        with np.errstate(invalid='ignore'):
+            done = (np.abs(newTem / tem[idx] - 1) < tol) \
+                 & (np.abs(newDen / den[idx] - 1) < tol)
+
+        tem[idx] = newTem
+        den[idx] = newDen
+        nIter[idx] += 1
+
+        # ========================================================
+        # Stop the converged and the failed lines of sight
+        # ========================================================
+        failed = ~np.isfinite(newTem) | ~np.isfinite(newDen)
+        converged[idx[done]] = True
+        active[idx[done | failed]] = False
+
+    # ============================================================
+    # Insert the estimates into sky maps
+    # ============================================================
+    maps = []
+    for value, dtype in ((tem, float), (den, float), (nIter, int), (converged, bool)):
+        skyMap = np.zeros(shape, dtype=dtype)
+        skyMap[los] = value
+        maps.append(skyMap)
+    skyTem, skyDen, nIter, converged = maps
+
+    celTem.skyTem = skyTem
+    celDen.skyDen = skyDen
+    celTem.outOfRange = np.zeros(shape, dtype=bool)
+    celTem.outOfRange[los] = outTem
+    celDen.outOfRange = np.zeros(shape, dtype=bool)
+    celDen.outOfRange[los] = outDen
+
+    return skyTem, skyDen, nIter, converged
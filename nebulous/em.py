@@ -1,7 +1,11 @@
 import numpy as np
+import sys
+from .geom import NebulaGeometry
+from .sparse import SparseCube
 from .utils import convl2D, getDepthTrue
 
-def getEM(n_e, tem=None, skyTem=None, geomTem=False, depth=None, convl=True, kernel=1):
+def getEM(n_e, tem=None, skyTem=None, geomTem=False, depth=None, convl=True, kernel=1,
+          loc=None):
     """
     Computes the emission measure given a cube of elecron densities
     <n_e> and temperatures <tem>.
@@ -14,15 +18,27 @@ def getEM(n_e, tem=None, skyTem=None, geomTem=False, depth=None, convl=True, ker
         depth               depth along the line of sight
         convl               boolean to apply gaussian filter
         kernel              convolution kernel in standard deviations
+                            or PSF (see psf.PSF); a list of kernels
+                            gives one map per kernel
+        loc                 SparseCube; <n_e> and <tem> are then its
+                            per-cell values
 
     Returns:
         EM                  2D array of emission measures on the sky
     """
+    # ==================================================
+    # Sum along the line of sight
+    # ==================================================
+    def losSum(x):
+        if isinstance(loc, SparseCube):
+            return loc.project(x)
+        return np.sum(x, axis=-1, dtype=np.float64)
+
     # ==================================================
     # Constant nebular temperature
     # ==================================================
     if not isinstance(tem, np.ndarray):
-        EM = np.sum(n_e**2, axis=-1)
+        EM = losSum(n_e**2)
 
     # ==================================================
     # Temperature fluctuations
@@ -31,9 +47,9 @@ def getEM(n_e, tem=None, skyTem=None, geomTem=False, depth=None, convl=True, ker
         # ==============================================
         # Compute T^-0.5
         # ==============================================
-        loc = np.where(tem > 0)
+        cells = np.where(tem > 0)
         sqrt_t_inv = np.zeros_like(tem)
-        sqrt_t_inv[loc] = 1. / np.sqrt(tem[loc])
+        sqrt_t_inv[cells] = 1. / np.sqrt(tem[cells])
 
         # ==============================================
         # Estimate temperature along the line of sight
@@ -45,7 +61,10 @@ def getEM(n_e, tem=None, skyTem=None, geomTem=False, depth=None, convl=True, ker
             # Get LOS depth if none is passed
             # =========================================
             if isinstance(depth, (int, float, type(None))):
-                depth = getDepthTrue(tem)
+                if isinstance(loc, SparseCube):
+                    depth = loc.project(tem != 0).astype(int)
+                else:
+                    depth = getDepthTrue(tem)
 
             # =========================================
             # Create an array to hold the temperatures
@@ -58,13 +77,13 @@ def getEM(n_e, tem=None, skyTem=None, geomTem=False, depth=None, convl=True, ker
             # Define the temperature functions
             # =========================================
             def geom_tem(tem):
-                tem_sum = np.sum(tem, axis=-1)
+                tem_sum = losSum(tem)
                 skyTem[los] = tem_sum[los] / depth[los]
                 return skyTem
 
             def mean_tem(tem, n_e):
-                den_sum = np.sum(n_e, axis=-1)
-                den_tem_sum = np.sum(n_e*tem, axis=-1)
+                den_sum = losSum(n_e)
+                den_tem_sum = losSum(n_e*tem)
                 skyTem[los] = den_tem_sum[los] / den_sum[los]
                 return skyTem
 
@@ -82,7 +101,7 @@ def getEM(n_e, tem=None, skyTem=None, geomTem=False, depth=None, convl=True, ker
             # =========================================
             # Evaluate the emission measure.
             # =========================================
-            EM = np.sum(n_e**2 * sqrt_t_inv, axis=-1) * np.sqrt(skyTem)
+            EM = losSum(n_e**2 * sqrt_t_inv) * np.sqrt(skyTem)
 
         else:
             # ==============================================
@@ -90,26 +109,46 @@ def getEM(n_e, tem=None, skyTem=None, geomTem=False, depth=None, convl=True, ker
             # assumed post-convolving, the temperature
             # adjustment comes at the end
             # ==============================================
-            EM = np.sum(n_e**2 * sqrt_t_inv, axis=-1)
+            EM = losSum(n_e**2 * sqrt_t_inv)
             if convl:
                 EM = convl2D(EM, kernel)
             return EM * np.sqrt(skyTem)
 
     return convl2D(EM, kernel) if convl else EM
 
-def getSkyDenEM(EM, depth, depthMin=0):
+def getSkyDenEM(EM, depth, depthMin=0, analytic=False, supersample=1):
     """
     Returns the density estimate given the observed emission
     measure and the depth along the line of sight.
 
     Parameters:
         EM          emission measure
-        depth       cell depth along each line of sight
+        depth       cell depth along each line of sight, or the
+                    SparseCube (e.g. geom.NebulaGeometry) of the nebula
         depthMin    minimum cell depth to compute the emission measure
+        analytic    use the analytic path lengths through the shell of
+                    <depth>, a geom.NebulaGeometry, rather than the
+                    number of cells (see geom.getShellDepth)
+        supersample sub-pixels per sky axis of the analytic path lengths
 
     Returns:
-        skyDen      2D array of density esimates on the sky
+        skyDen      2D array of density esimates on the sky; the
+                    emission measures of a kernel sweep (nk, nx, ny)
+                    give one map per kernel
     """
+    if analytic:
+        if not isinstance(depth, NebulaGeometry):
+            print("The analytic depth requires a NebulaGeometry")
+            sys.exit(1)
+        depth = depth.getShellDepth(supersample=supersample)
+
+    elif isinstance(depth, SparseCube):
+        depth = depth.getDepth()
+
+    shape = np.broadcast_shapes(np.shape(EM), np.shape(depth))
+    EM = np.broadcast_to(EM, shape)
+    depth = np.broadcast_to(depth, shape)
+
     # ==================================================
     # Find lines of sight with sufficient depth
     # ==================================================
@@ -118,7 +157,7 @@ def getSkyDenEM(EM, depth, depthMin=0):
     # ==================================================
     # Estimate density, n_{e} ~ sqrt(EM / L)
     # ==================================================
-    skyDen = np.zeros_like(depth, dtype='float')
+    skyDen = np.zeros(shape, dtype='float')
     skyDen[los] = np.sqrt(EM[los] / depth[los])
 
     return skyDen
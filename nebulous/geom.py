@@ -1,7 +1,11 @@
-from .utils import getCoordinates, getRadialDistance, makeCube, parseCubeDimensions
+from abc import ABC, abstractmethod
+from .cache import getCachePath, loadCache, saveCache
+from functools import reduce
+from .sparse import SparseCube
+from .utils import getCoordinates, getOpenCoordinates, getRadialDistance, makeCube, parseCubeDimensions
 import numpy as np
 
-def sphere(dim, inRad=0.3, outRad=0.9, axis=0):
+def sphere(dim, inRad=0.3, outRad=0.9, axis=0, sparse=False):
     """
     Method for generating a spherical nebula.
 
@@ -10,9 +14,11 @@ def sphere(dim, inRad=0.3, outRad=0.9, axis=0):
         inRad       fractional inner radius (0 < inRad < outRad)
         outRad      fractional outer radius (inRad < outRad < 1)
         axis        axis of <dim> associated with <inRad, outRad>
+        sparse      return a SparseCube rather than a tuple
 
     Returns
         cells       tuple containing cell locations within the nebula
+                    (or a SparseCube)
 
     Postcondition:
         The cell locations that are within the inner and outer
@@ -47,8 +53,433 @@ def sphere(dim, inRad=0.3, outRad=0.9, axis=0):
     # Return the cell locations contained with the
     # boundary of the nebula
     # ==================================================
+    if sparse:
+        return SparseCube.fromLoc(dim, cells)
     return(cells)
 
+# ===================================================
+# Signed distance field (SDF) shapes. Lengths are in
+# units of half the cube size along <axis> (as the
+# radii of sphere), and distances are negative inside.
+# ===================================================
+class Shape(ABC):
+    """
+    Abstract base class of the SDF shapes. Subclasses define distance,
+    which returns the signed distance (in cells) of the points (x, y, z),
+    and getBounds, which returns the axis-aligned bounding box.
+    Shapes combine with | (union), & (intersection) and - (subtraction).
+    """
+
+    @abstractmethod
+    def distance(self, x, y, z, scale):
+        """
+        Returns the signed distance of the points (x, y, z), in cells
+        from the center of the cube, with lengths multiplied by <scale>.
+        """
+
+    @abstractmethod
+    def getBounds(self, scale):
+        """
+        Returns the bounding box (lower, upper), each of shape (3,),
+        in cells from the center of the cube.
+        """
+
+    def __or__(self, other):
+        return Union(self, other)
+
+    def __and__(self, other):
+        return Intersection(self, other)
+
+    def __sub__(self, other):
+        return Subtraction(self, other)
+
+    def getIndex(self, dim, scale, chunk=2**22):
+        """
+        Returns the sorted flat indices of the cells inside the shape,
+        evaluating the distance inside the bounding box only, a slab
+        of about <chunk> cells of the first axis at a time.
+        """
+        lower, upper = self.getBounds(scale)
+        start, stop = [], []
+        for n, lo, hi in zip(dim, lower, upper):
+            c = 0.5 * (n - 1)
+            start.append(max(int(np.floor(lo + c)), 0))
+            stop.append(min(int(np.ceil(hi + c)) + 1, n))
+
+        if any(b >= e for b, e in zip(start, stop)):
+            return np.zeros(0, dtype=np.int64)
+
+        x, y, z = (np.arange(b, e, dtype='float') - 0.5 * (n - 1)
+                   for b, e, n in zip(start, stop, dim))
+        y, z = y[:, None], z[None, :]
+
+        index = []
+        step = max(1, chunk // (y.size * z.size))
+        for i in range(0, len(x), step):
+            slab = self.distance(x[i:i + step, None, None], y[None], z[None], scale) <= 0
+            cells = np.nonzero(slab)
+            cells = tuple(c + s for c, s in zip(cells, (start[0] + i, start[1], start[2])))
+            index.append(np.ravel_multi_index(cells, dim))
+
+        return np.concatenate(index)
+
+    def getCells(self, dim, axis=0, sparse=False, chunk=2**22):
+        """
+        Method for generating a nebula of the shape.
+
+        Parameters:
+            dim         dimension of cube
+            axis        axis of <dim> whose half size is the unit of length
+            sparse      return a SparseCube rather than a tuple
+            chunk       approximate number of cells evaluated at once
+
+        Returns:
+            cells       tuple containing cell locations within the nebula
+                        (or a SparseCube), as returned by sphere
+        """
+        dim = parseCubeDimensions(dim)
+        index = self.getIndex(dim, scale=0.5 * dim[axis], chunk=chunk)
+
+        if sparse:
+            return SparseCube(dim, index)
+        return np.unravel_index(index, dim)
+
+def getLocal(x, y, z, center, symmetryAxis, scale):
+    """
+    Returns the coordinates along the symmetry axis and the distance
+    from it, relative to <center> (scaled).
+    """
+    p = [v - c * scale for v, c in zip((x, y, z), center)]
+    h = p.pop(symmetryAxis)
+    return h, np.sqrt(p[0]**2 + p[1]**2)
+
+class Ellipsoid(Shape):
+    """
+    Ellipsoid of semi-axes <radii> (a scalar for a sphere) centered on
+    <center>. The distance is exact for spheres and a bound otherwise;
+    its sign is always exact.
+    """
+    def __init__(self, radii, center=(0., 0., 0.)):
+        self.radii = np.broadcast_to(np.asarray(radii, dtype='float'), (3,))
+        self.center = np.asarray(center, dtype='float')
+
+    def distance(self, x, y, z, scale):
+        p = [v - c * scale for v, c in zip((x, y, z), self.center)]
+        r = self.radii * scale
+
+        if np.all(r == r[0]):
+            return np.sqrt(p[0]**2 + (p[1]**2 + p[2]**2)) - r[0]
+
+        k0 = np.sqrt(sum((v / a)**2 for v, a in zip(p, r)))
+        k1 = np.sqrt(sum((v / a**2)**2 for v, a in zip(p, r)))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(k1 > 0, k0 * (k0 - 1) / k1, -r.min())
+
+    def getBounds(self, scale):
+        return (self.center - self.radii) * scale, (self.center + self.radii) * scale
+
+class Cylinder(Shape):
+    """
+    Capped cylinder of the given radius and half length along the
+    axis <symmetryAxis> of the cube, centered on <center>.
+    """
+    def __init__(self, radius, halfLength, symmetryAxis=0, center=(0., 0., 0.)):
+        self.radius = float(radius)
+        self.halfLength = float(halfLength)
+        self.symmetryAxis = symmetryAxis
+        self.center = np.asarray(center, dtype='float')
+
+    def distance(self, x, y, z, scale):
+        h, rho = getLocal(x, y, z, self.center, self.symmetryAxis, scale)
+        dr = rho - self.radius * scale
+        dh = np.abs(h) - self.halfLength * scale
+        return np.minimum(np.maximum(dr, dh), 0) \
+             + np.sqrt(np.maximum(dr, 0)**2 + np.maximum(dh, 0)**2)
+
+    def getBounds(self, scale):
+        extent = np.full(3, self.radius)
+        extent[self.symmetryAxis] = self.halfLength
+        return (self.center - extent) * scale, (self.center + extent) * scale
+
+class Torus(Shape):
+    """
+    Torus of radius <majorRadius> (to the center of the tube) and tube
+    radius <minorRadius> around the axis <symmetryAxis> of the cube.
+    """
+    def __init__(self, majorRadius, minorRadius, symmetryAxis=0, center=(0., 0., 0.)):
+        self.majorRadius = float(majorRadius)
+        self.minorRadius = float(minorRadius)
+        self.symmetryAxis = symmetryAxis
+        self.center = np.asarray(center, dtype='float')
+
+    def distance(self, x, y, z, scale):
+        h, rho = getLocal(x, y, z, self.center, self.symmetryAxis, scale)
+        return np.sqrt((rho - self.majorRadius * scale)**2 + h**2) - self.minorRadius * scale
+
+    def getBounds(self, scale):
+        extent = np.full(3, self.majorRadius + self.minorRadius)
+        extent[self.symmetryAxis] = self.minorRadius
+        return (self.center - extent) * scale, (self.center + extent) * scale
+
+# ===================================================
+# Boolean combinations of shapes
+# ===================================================
+class Union(Shape):
+    """
+    Cells inside any of the shapes; each shape is evaluated inside its
+    own bounding box.
+    """
+    def __init__(self, *shapes):
+        self.shapes = shapes
+
+    def distance(self, x, y, z, scale):
+        return reduce(np.minimum, (s.distance(x, y, z, scale) for s in self.shapes))
+
+    def getBounds(self, scale):
+        bounds = [s.getBounds(scale) for s in self.shapes]
+        return np.min([b[0] for b in bounds], axis=0), np.max([b[1] for b in bounds], axis=0)
+
+    def getIndex(self, dim, scale, chunk=2**22):
+        index = [s.getIndex(dim, scale, chunk) for s in self.shapes]
+        return np.unique(np.concatenate(index))
+
+class Intersection(Shape):
+    """
+    Cells inside all of the shapes, evaluated inside the intersection
+    of their bounding boxes.
+    """
+    def __init__(self, *shapes):
+        self.shapes = shapes
+
+    def distance(self, x, y, z, scale):
+        return reduce(np.maximum, (s.distance(x, y, z, scale) for s in self.shapes))
+
+    def getBounds(self, scale):
+        bounds = [s.getBounds(scale) for s in self.shapes]
+        return np.max([b[0] for b in bounds], axis=0), np.min([b[1] for b in bounds], axis=0)
+
+class Subtraction(Shape):
+    """
+    Cells inside <shape> and outside (or on the surface of) <hole>,
+    evaluated inside the bounding box of <shape>.
+    """
+    def __init__(self, shape, hole):
+        self.shape = shape
+        self.hole = hole
+
+    def distance(self, x, y, z, scale):
+        return np.maximum(self.shape.distance(x, y, z, scale), -self.hole.distance(x, y, z, scale))
+
+    def getBounds(self, scale):
+        return self.shape.getBounds(scale)
+
+# ===================================================
+# Planetary nebula morphologies
+# ===================================================
+class EllipsoidalShell(Subtraction):
+    """
+    Shell between two concentric ellipsoids of semi-axes <inner> and
+    <outer> (scalars for a spherical shell, which gives the cells of
+    sphere(dim, inner, outer)).
+    """
+    def __init__(self, inner, outer, center=(0., 0., 0.)):
+        super(EllipsoidalShell, self).__init__(
+            Ellipsoid(outer, center), Ellipsoid(inner, center))
+
+class BipolarLobes(Shape):
+    """
+    Two ellipsoidal lobes of semi-axes <length> (along <symmetryAxis>)
+    and <width>, touching at <center>; with a <thickness>, the lobes
+    are hollow shells.
+    """
+    def __init__(self, length, width, thickness=None, symmetryAxis=0, center=(0., 0., 0.)):
+        center = np.asarray(center, dtype='float')
+        offset = np.zeros(3)
+        offset[symmetryAxis] = length
+
+        def lobes(length, width):
+            radii = np.full(3, width)
+            radii[symmetryAxis] = length
+            return Union(Ellipsoid(radii, center + offset), Ellipsoid(radii, center - offset))
+
+        self.lobes = lobes(length, width)
+        if not isinstance(thickness, type(None)):
+            self.lobes = Subtraction(self.lobes, lobes(length - thickness, width - thickness))
+
+    def distance(self, x, y, z, scale):
+        return self.lobes.distance(x, y, z, scale)
+
+    def getBounds(self, scale):
+        return self.lobes.getBounds(scale)
+
+    def getIndex(self, dim, scale, chunk=2**22):
+        return self.lobes.getIndex(dim, scale, chunk)
+
+
+def chordLength(b2, radius):
+    """
+    Returns the length of the chords through a sphere of the given
+    radius at squared impact parameters <b2> (zero outside).
+    """
+    return 2. * np.sqrt(np.maximum(radius**2 - b2, 0.))
+
+def getShellDepth(dim, inRad=0.3, outRad=0.9, axis=0, supersample=1):
+    """
+    Computes the path length along each line of sight (the last axis)
+    through a spherical shell, analytically.
+
+    Parameters:
+        dim             dimension of cube
+        inRad           fractional inner radius (see sphere)
+        outRad          fractional outer radius (see sphere)
+        axis            axis of <dim> associated with <inRad, outRad>
+        supersample     number of sub-pixels per sky axis over which
+                        the path length is averaged
+
+    Returns:
+        depth           2D array of the path lengths in cells
+
+    Postcondition:
+        The depth is the chord through the outer sphere minus the chord
+        through the inner one, at the pixel centers or averaged over the
+        <supersample>^2 sub-pixels. Unlike the cell count of getDepth,
+        which it approximates, it is not quantized. The cost is
+        O(N^2 supersample^2).
+    """
+    dim = parseCubeDimensions(dim)
+    inRad  = inRad  * (0.5 * dim[axis])
+    outRad = outRad * (0.5 * dim[axis])
+
+    x, y, _ = getOpenCoordinates(dim)
+    x, y = x[:, :, 0], y[:, :, 0]
+
+    # ==================================================
+    # Average over the sub-pixel centers
+    # ==================================================
+    offsets = (np.arange(supersample) + 0.5) / supersample - 0.5
+    depth = np.zeros(dim[:-1])
+    for dx in offsets:
+        for dy in offsets:
+            b2 = (x + dx)**2 + (y + dy)**2
+            depth += chordLength(b2, outRad) - chordLength(b2, inRad)
+
+    return depth / supersample**2
+
+# ===================================================
+# Geometry registry: the cells of a nebula and the
+# quantities derived from them, computed once
+# ===================================================
+class NebulaGeometry(SparseCube):
+    """
+    Spherical nebula (see sphere) together with the quantities that
+    the pipeline derives from its cells: the boolean mask, the flat
+    indices, the depth along each line of sight, the lines of sight
+    deep enough to be used, and the radial distances of the cells.
+
+    Being a SparseCube, a geometry can be passed as <loc> anywhere a
+    SparseCube is accepted; <self.loc> gives the cell locations for
+    the dense cubes.
+    """
+
+    def __init__(self, dim, inRad=0.3, outRad=0.9, axis=0, depthMin=5, cache=True):
+        """
+        Parameters:
+            dim         dimension of cube
+            inRad       fractional inner radius (see sphere)
+            outRad      fractional outer radius (see sphere)
+            axis        axis of <dim> associated with <inRad, outRad>
+            depthMin    lines of sight deeper than <depthMin> cells are
+                        selected in <self.los>
+            cache       store the arrays in the on-disk cache
+
+        Postcondition:
+            Sets <self.index> (and the other SparseCube attributes),
+            <self.depth> (cells along each line of sight), <self.los>
+            and <self.radius> (radial distance of each cell). The arrays
+            are loaded from the on-disk cache if available.
+        """
+        dim = parseCubeDimensions(dim)
+        self.params = {
+            "shape": "sphere",
+            "dim": dim,
+            "inRad": float(inRad),
+            "outRad": float(outRad),
+            "axis": int(axis),
+        }
+        path = getCachePath("geometry", None, self.params) if cache else None
+        arrays = loadCache(path, mmap=False)
+
+        if isinstance(arrays, type(None)):
+            cells = sphere(dim=dim, inRad=inRad, outRad=outRad, axis=axis)
+            index = np.ravel_multi_index(cells, dim)
+            arrays = {
+                "index": index,
+                "depth": np.bincount(index // dim[-1], minlength=dim[0]*dim[1]).reshape(dim[:-1]),
+                "radius": SparseCube(dim, index).getRadialDistance(),
+            }
+            saveCache(path, arrays, key=self.params)
+
+        super(NebulaGeometry, self).__init__(dim, arrays["index"])
+        self.depth = arrays["depth"]
+        self.radius = arrays["radius"]
+        self.depthMin = depthMin
+        self.los = self.depth > depthMin
+
+        self.cells = None
+        self.maskCube = None
+
+    def __repr__(self):
+        return 'NebulaGeometry({:s})'.format(', '.join(
+            '{:s}={}'.format(k, v) for k, v in self.params.items() if k != "shape"))
+
+    @property
+    def loc(self):
+        """
+        Cell locations as a tuple of index arrays (as returned by sphere).
+        """
+        if isinstance(self.cells, type(None)):
+            self.cells = np.unravel_index(self.index, self.dim)
+        return self.cells
+
+    @property
+    def mask(self):
+        """
+        Boolean cube of the cells of the nebula.
+        """
+        if isinstance(self.maskCube, type(None)):
+            mask = np.zeros(self.dim, dtype=bool)
+            mask.ravel()[self.index] = True
+            self.maskCube = mask
+        return self.maskCube
+
+    def getDepth(self):
+        return self.depth
+
+    def getShellDepth(self, supersample=1):
+        """
+        Returns the analytic path lengths through the shell (see
+        getShellDepth), an unquantized alternative to <self.depth>.
+        """
+        params = {k: v for k, v in self.params.items() if k != "shape"}
+        return getShellDepth(supersample=supersample, **params)
+
+    def getRadialDistance(self):
+        return self.radius.copy()
+
+geometry_dict = {}
+
+def getGeometry(dim, inRad=0.3, outRad=0.9, axis=0, depthMin=5, **kwargs):
+    """
+    Returns the NebulaGeometry of the given shape parameters, creating
+    it on first use. Geometries are shared within a process.
+    """
+    key = (parseCubeDimensions(dim), float(inRad), float(outRad), int(axis), depthMin)
+
+    if key not in geometry_dict:
+        geometry_dict[key] = NebulaGeometry(dim=dim, inRad=inRad, outRad=outRad,
+            axis=axis, depthMin=depthMin, **kwargs)
+
+    return geometry_dict[key]
 
 
 def partition(loc, pvals, seed):
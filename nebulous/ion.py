@@ -1,9 +1,26 @@
-from .utils import convl2D
+from .cache import fingerprint, getAtomicDataSet
+from .level import getLineEmissivity
+from .sparse import SparseCube
+from . import cache
+from .table import getTable, quantize
+from .utils import broadcastLOS, convl2D, getDtype, getSkyValues
+import pyneb as pn
 import numpy as np
 import sys
 
 class ion:
 
+    # =============================================================
+    # Default emissivity backend {"pyneb", "native", "table"} and the
+    # lookup table used by the "table" backend.
+    # =============================================================
+    backend = "pyneb"
+    table = None
+    emissKey = None
+
+    # H I atom shared by the instances for the H-beta emissivities
+    hbetaAtom = None
+
     def getLatexSymbol(self, delim='\;'):
         roman = {
             1: 'i',
@@ -22,7 +39,186 @@ class ion:
 
         return latex
 
-    def getEmissivity(self, wave_param, tem, n_e, n_i=None, loc=None):
+    def makeTable(self, wave_param, **kwargs):
+        """
+        Tabulates the emissivities of each wavelength on a (T, n_e)
+        grid and stores the table in the variable <self.table>
+
+        Parameters:
+            wave_param      indicator of self.wave values {"wave", "label"}
+            kwargs          grid parameters passed to EmissivityTable
+
+        Postcondition:
+            Tables are shared between the instances of a process with
+            the same atom, wavelengths and grid (see getTable).
+        """
+        self.table = getTable(
+            atom=self.atom,
+            wave=self.wave,
+            wave_param=wave_param,
+            **kwargs
+        )
+
+    def computeEmissivity(self, wave_param, tem, den, backend=None):
+        """
+        Returns the emissivities of each wavelength for the paired
+        (after broadcasting) temperatures and densities as an array
+        of shape (len(wave), *shape).
+
+        Parameters:
+            wave_param      indicator of self.wave values {"wave", "label"}
+            tem             temperature(s)
+            den             electron densit(y/ies)
+            backend         emissivity backend {"pyneb", "native", "table"};
+                            defaults to <self.backend>. "native" solves
+                            the CEL level populations with the batched
+                            solver in nebulous.level
+        """
+        if isinstance(backend, type(None)):
+            backend = self.backend
+
+        # =============================================================
+        # Interpolate the lookup table; the table is built on first use.
+        # =============================================================
+        if backend == "table":
+            if isinstance(self.table, type(None)):
+                ion.makeTable(self, wave_param=wave_param)
+            return self.table.getEmissivity(tem=tem, den=den)
+
+        # =============================================================
+        # Compute with the atomic data (sharing a single level
+        # population solve between the lines of a CEL)
+        # =============================================================
+        elif backend in ("pyneb", "native"):
+            return getLineEmissivity(atom=self.atom, wave=self.wave,
+                wave_param=wave_param, tem=tem, den=den, solver=backend)
+
+        else:
+            print("<backend> must be one of {'pyneb', 'native', 'table'}")
+            sys.exit(1)
+
+    def getQuantizedInputs(self, wave_param, tem, den, maxError=1e-4,
+                           backend=None, nSlope=17):
+        """
+        Snaps the temperatures and densities to log bins narrow enough
+        for the emissivities at the bin centers to be within <maxError>
+        of those at the inputs.
+
+        Parameters:
+            wave_param      indicator of self.wave values {"wave", "label"}
+            tem             temperature(s)
+            den             electron densit(y/ies)
+            maxError        maximum relative emissivity error
+            backend         emissivity backend (see computeEmissivity)
+            nSlope          grid size used to bound the log-slopes
+
+        Returns:
+            tem             snapped temperatures {1D array}
+            den             snapped densities {1D array}
+            error           bound on the relative emissivity error
+
+        Postcondition:
+            The log-slopes s_T = |dln(j)/dln(T)| and s_n = |dln(j)/dln(n_e)|
+            of all the lines are bounded on an <nSlope>^2 grid spanning the
+            inputs by the largest first difference plus half a grid step
+            times the largest second difference, which covers the slope
+            between the grid points as long as the grid resolves the
+            curvature. Half of the log budget ln(1 + maxError) goes to
+            each variable, so the bin widths are ln(1 + maxError) / s in
+            ln(T) and ln(n_e) (no value lies more than half a bin from its
+            center) and the error exp(s_T |dln T| + s_n |dln n_e|) - 1 is
+            at most <maxError>. Cells with non-positive (or non-finite)
+            T or n_e are left unchanged.
+        """
+        tem, den = np.broadcast_arrays(
+            np.asarray(tem, dtype='float'),
+            np.asarray(den, dtype='float')
+        )
+        tem, den = tem.ravel().copy(), den.ravel().copy()
+
+        # =============================================================
+        # Only cells with finite logarithms are quantized
+        # =============================================================
+        with np.errstate(divide='ignore', invalid='ignore'):
+            finite = np.isfinite(np.log(tem)) & np.isfinite(np.log(den))
+        if not np.any(finite):
+            return tem, den, 0.
+        x, y = np.log(tem[finite]), np.log(den[finite])
+
+        # =============================================================
+        # Bound the log-slopes over the range of the inputs
+        # =============================================================
+        gx = np.linspace(x.min(), x.max(), nSlope if np.ptp(x) > 0 else 1)
+        gy = np.linspace(y.min(), y.max(), nSlope if np.ptp(y) > 0 else 1)
+        gx, gy = np.meshgrid(gx, gy, indexing='ij')
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lnj = np.log(self.computeEmissivity(wave_param=wave_param,
+                tem=np.exp(gx), den=np.exp(gy), backend=backend))
+
+        slopes = []
+        for axis, g in ((1, gx), (2, gy)):
+            n = lnj.shape[axis]
+            if n > 1:
+                h = np.ptp(g) / (n - 1)
+                d1 = np.diff(lnj, axis=axis)
+                slope = np.nanmax(np.abs(d1)) / h
+                if n > 2:
+                    slope += 0.5 * np.nanmax(np.abs(np.diff(d1, axis=axis))) / h
+                slopes.append(slope)
+            else:
+                slopes.append(0.)
+
+        # =============================================================
+        # Snap the inputs to the bin centers; a variable whose slope
+        # could not be bounded is left exact
+        # =============================================================
+        budget = 0.5 * np.log1p(maxError)
+        error = 0.
+        for values, v, s in ((tem, x, slopes[0]), (den, y, slopes[1])):
+            if np.isfinite(s):
+                _, center = quantize(v, 2 * budget / s if s > 0 else np.inf)
+                values[finite] = np.exp(center)
+                error += s * np.max(np.abs(v - center))
+
+        return tem, den, np.expm1(error)
+
+    def getQuantizedEmissivity(self, wave_param, tem, den, maxError=1e-4,
+                               backend=None, nSlope=17):
+        """
+        Computes the emissivities with the temperatures and densities
+        snapped to log bins (see getQuantizedInputs), evaluating once
+        per occupied bin.
+
+        Parameters:
+            wave_param      indicator of self.wave values {"wave", "label"}
+            tem             temperature(s)
+            den             electron densit(y/ies)
+            maxError        maximum relative emissivity error
+            backend         emissivity backend (see computeEmissivity)
+            nSlope          grid size used to bound the log-slopes
+
+        Returns:
+            emiss           emissivities, shape (len(wave), ncells)
+            compression     ratio of the number of cells to evaluations
+            error           bound on the relative error achieved
+
+        Postcondition:
+            Cells with non-positive (or non-finite) T or n_e are
+            evaluated exactly.
+        """
+        tem, den, error = self.getQuantizedInputs(wave_param=wave_param,
+            tem=tem, den=den, maxError=maxError, backend=backend, nSlope=nSlope)
+
+        pairs, inverse = np.unique(np.column_stack((tem, den)), axis=0, return_inverse=True)
+        emiss = self.computeEmissivity(wave_param=wave_param,
+            tem=pairs[:, 0], den=pairs[:, 1], backend=backend)[:, inverse.ravel()]
+
+        return emiss, tem.size / len(pairs), error
+
+    def getEmissivity(self, wave_param, tem, n_e, n_i=None, loc=None,
+                      backend=None, unique=False, maxError=None, dtype=None,
+                      project=False, keep=False, chunk=2**16):
         """
         Computes the volume emissivities for each cell at each
         wavelengths and stores in the variable <self.emiss>
@@ -32,15 +228,83 @@ class ion:
             tem             temperature(s)
             n_e             electron densit(y/ies)
             n_i             ion densit(y/ies)
-            loc             cell locations within the nebula
+            loc             cell locations within the nebula, or a
+                            SparseCube whose per-cell values are given
+                            by <tem>, <n_e> and <n_i> (implies <project>)
+            backend         emissivity backend (see computeEmissivity)
+            unique          evaluate each distinct (T, n_e) pair once
+            maxError        if set, snap T and n_e to log bins so that
+                            the relative emissivity error is at most
+                            <maxError> (see getQuantizedEmissivity)
+            dtype           floating point type of <self.emiss>
+                            (see utils.setDtype)
+            project         accumulate the emission of the occupied cells
+                            directly into the sky map <self.skyProjection>
+                            rather than storing the cube <self.emiss>
+            keep            with <project>, also store the cube <self.emiss>
+            chunk           with <project>, number of cells whose
+                            emissivities are computed at once
+
+        Postcondition:
+            The ratio of the number of cells to the number of emissivity
+            evaluations is stored in the variable <self.compression>
+            and the bound on the relative error of the emissivities
+            in the variable <self.emissError>. With <project>, the cube
+            <self.emiss> is None (unless <keep>) and getSkyEmiss uses the
+            projection, so that memory scales with the number of occupied
+            cells rather than with the volume of the box. If memoization is
+            enabled (see cache.enableMemo) the result is looked up
+            in, or added to, the memo; the key includes the inputs, the
+            options and, for the "table" backend, the grid of the table.
         """
         # =============================================================
-        # Extract the PyNeb atom class as well as the wavelength values
-        # and the ionization state
+        # Look up the memo
+        # =============================================================
+        self.emissKey = None
+        if not isinstance(cache.memo, type(None)):
+            if isinstance(backend, type(None)):
+                backend = self.backend
+
+            # The "table" backend is keyed by the table it interpolates
+            if backend == "table" and isinstance(self.table, type(None)):
+                ion.makeTable(self, wave_param=wave_param)
+            table = self.table.key if backend == "table" else None
+
+            key = (
+                "emiss", self.atom.atom, getAtomicDataSet(self.atom), self.wave,
+                wave_param, backend, table, unique, maxError, getDtype(dtype),
+                project, keep, fingerprint(tem), fingerprint(n_e),
+                fingerprint(n_i), fingerprint(loc)
+            )
+            value = cache.memo.get(key)
+            self.emissKey = key
+            if not isinstance(value, type(None)):
+                (self.emiss, self.skyProjection, self.cellEmiss,
+                 self.compression, self.emissError) = value
+                return
+
+        # =============================================================
+        # Extract the wavelength values
         # =============================================================
-        atom = self.atom
         wave = self.wave
 
+        # =============================================================
+        # Sparse nebula: the inputs already are per-cell values, which
+        # are projected directly onto the sky.
+        # =============================================================
+        if isinstance(loc, SparseCube):
+            self.emiss = None
+            self.projectEmissivity(wave_param=wave_param, tem=tem, n_e=n_e,
+                n_i=n_e if isinstance(n_i, type(None)) else n_i, loc=loc,
+                shape=loc.dim, backend=backend, unique=unique, maxError=maxError,
+                dtype=dtype, keep=keep, chunk=chunk)
+
+            if not isinstance(self.emissKey, type(None)):
+                cache.memo.put(self.emissKey,
+                    (self.emiss, self.skyProjection, self.cellEmiss,
+                 self.compression, self.emissError))
+            return
+
         # =============================================================
         # Test to see if the density and/or temperatures are
         # stored as arrays.
@@ -71,9 +335,10 @@ class ion:
                 loc = np.where(n_e > 0)
 
             # =========================================================
-            # Create an array to hold the emissivities associated with each cell
+            # Record the shape of the array that holds the emissivities
+            # associated with each cell
             # =========================================================
-            emiss = np.zeros((len(wave), *n_e.shape))
+            shape = n_e.shape
 
             # =========================================================
             # Extract the densities
@@ -93,11 +358,11 @@ class ion:
                 loc = np.where(tem > 0)
 
             # =========================================================
-            # Test to see if an array has been created to hold the
-            # emissivities (see first if). If not, then make.
+            # Test to see if the shape of the emissivity array has been
+            # recorded (see first if). If not, then record.
             # =========================================================
-            try: emiss
-            except: emiss = np.zeros((len(wave), *tem.shape))
+            try: shape
+            except: shape = tem.shape
 
             # =========================================================
             # Extract the temperatures
@@ -117,11 +382,11 @@ class ion:
                 loc = np.where(n_i > 0)
 
             # =========================================================
-            # Test to see if an array has been created to hold the
-            # emissivities (see first if). If not, then make.
+            # Test to see if the shape of the emissivity array has been
+            # recorded (see first if). If not, then record.
             # =========================================================
-            try: emiss
-            except: emiss = np.zeros((len(wave), *n_i.shape))
+            try: shape
+            except: shape = n_i.shape
 
             # =========================================================
             # Extract the densities
@@ -149,57 +414,303 @@ class ion:
             """
 
         # =============================================================
-        # Create a dictionary for passing to the getEmissivity function.
-        # If the electron densities and temperatures are both arrays,
-        # then set the product term to false (as each cell is paired)
+        # Either accumulate the emission of the cells directly into the
+        # sky map, or compute all the cells and scatter them into a cube.
         # =============================================================
-        params = {
-            "tem": tem,
-            "den": n_e,
-            "product": False if (logical1 and logical2) else True
-        }
+        self.emiss = None
+        self.skyProjection = None
+        self.cellEmiss = None
+
+        if project:
+            self.projectEmissivity(wave_param=wave_param, tem=tem, n_e=n_e,
+                n_i=n_i, loc=loc, shape=shape, backend=backend, unique=unique,
+                maxError=maxError, dtype=dtype, keep=keep, chunk=chunk)
+
+        else:
+            lineEmiss = self.getCellEmissivity(wave_param=wave_param, tem=tem,
+                n_e=n_e, n_i=n_i, backend=backend, unique=unique, maxError=maxError)
+
+            emiss = np.zeros((len(wave), *shape), dtype=getDtype(dtype))
+            for i, _ in enumerate(wave):
+                emiss[i][loc] = lineEmiss[i]
+
+            self.emiss = emiss
 
         # =============================================================
-        # For each wave, update the dictionary and compute the line intensity
-        # by multiplying the emissivity by the electron and ion densities.
+        # Store the result in the memo.
         # =============================================================
-        for i, wl in enumerate(wave):
-            params[wave_param] = wl
-            emiss[i][loc] = atom.getEmissivity(**params) * n_e * n_i
+        if not isinstance(self.emissKey, type(None)):
+            cache.memo.put(self.emissKey,
+                (self.emiss, self.skyProjection, self.cellEmiss,
+                 self.compression, self.emissError))
+
+    def getCellEmissivity(self, wave_param, tem, n_e, n_i, backend=None,
+                          unique=False, maxError=None, den=None):
+        """
+        Computes the line intensities (emissivity times the electron and
+        ion densities) of a set of cells.
+
+        Parameters:
+            wave_param      indicator of self.wave values {"wave", "label"}
+            tem             temperature(s) of the cells
+            n_e             electron densit(y/ies) of the cells
+            n_i             ion densit(y/ies) of the cells
+            backend         emissivity backend (see computeEmissivity)
+            unique          evaluate each distinct (T, n_e) pair once
+            maxError        maximum relative error of quantized
+                            emissivities (see getQuantizedEmissivity)
+            den             electron densities at which the emissivities
+                            are evaluated (e.g. snapped by
+                            getQuantizedInputs); defaults to <n_e>
+
+        Returns:
+            lineEmiss       line intensities, shape (len(wave), ncells)
+
+        Postcondition:
+            Sets the variables <self.compression> and <self.emissError>
+            (see getEmissivity).
+        """
+        # =============================================================
+        # Compute the emissivities of all the wavelengths. If requested,
+        # evaluate each distinct (T, n_e) pair only once and scatter the
+        # results back to the cells through the inverse index.
+        # =============================================================
+        if isinstance(den, type(None)):
+            den = n_e
+
+        if not isinstance(maxError, type(None)):
+            lineEmiss, self.compression, self.emissError = self.getQuantizedEmissivity(
+                wave_param=wave_param, tem=tem, den=den, maxError=maxError, backend=backend)
+
+        elif unique:
+            pairs = np.column_stack([np.ravel(x) for x in np.broadcast_arrays(tem, den)])
+            pairs, inverse = np.unique(pairs, axis=0, return_inverse=True)
+            inverse = inverse.ravel()
+
+            lineEmiss = self.computeEmissivity(wave_param=wave_param,
+                tem=pairs[:,0], den=pairs[:,1], backend=backend)[:, inverse]
+
+            self.compression = len(inverse) / len(pairs)
+            self.emissError = 0.
+        else:
+            lineEmiss = self.computeEmissivity(wave_param=wave_param,
+                tem=tem, den=den, backend=backend)
+
+            self.compression = 1.
+            self.emissError = 0.
+
+        # =============================================================
+        # Compute the line intensity by multiplying the emissivity by
+        # the electron and ion densities.
+        # =============================================================
+        return np.stack([lineEmiss[i] * n_e * n_i for i, _ in enumerate(self.wave)])
+
+    def projectEmissivity(self, wave_param, tem, n_e, n_i, loc, shape,
+                          backend=None, unique=False, maxError=None, dtype=None,
+                          keep=False, chunk=2**16):
+        """
+        Computes the line intensities of the cells in chunks and sums
+        them along the line of sight (last axis) into the variable
+        <self.skyProjection>, without creating the emissivity cube.
+
+        Parameters:
+            wave_param      indicator of self.wave values {"wave", "label"}
+            tem             temperature(s) of the cells
+            n_e             electron densit(y/ies) of the cells
+            n_i             ion densit(y/ies) of the cells
+            loc             cell locations within the nebula or a SparseCube
+            shape           shape of the nebula
+            backend         emissivity backend (see computeEmissivity)
+            unique          evaluate each distinct (T, n_e) pair once
+            maxError        maximum relative error of quantized emissivities
+            dtype           floating point type of <self.emiss>
+            keep            also store the cube <self.emiss>
+            chunk           number of cells whose emissivities are
+                            computed at once
+
+        Postcondition:
+            The sky map is accumulated in float64 with np.bincount over
+            the pixel index of each cell; NaN intensities are ignored as
+            in getSkyEmiss. With <maxError>, all the cells are snapped to
+            the same bins before chunking (see getQuantizedInputs), and
+            each chunk evaluates its distinct bins once. The compression
+            is combined over the chunks. For a SparseCube the per-cell
+            intensities are also stored in the variable <self.cellEmiss>.
+        """
+        wave = self.wave
 
         # =============================================================
-        # Store the result.
+        # Flat index and sky pixel of each cell
         # =============================================================
-        self.emiss = emiss
+        if isinstance(loc, SparseCube):
+            flat, pixel = loc.index, loc.pixel
+        else:
+            if isinstance(loc, np.ndarray) and loc.dtype == bool:
+                loc = np.nonzero(loc)
+            flat = np.ravel_multi_index(loc, shape)
+            pixel = np.ravel_multi_index(loc[:-1], shape[:-1])
+
+        nPixel = int(np.prod(shape[:-1]))
+        nCells = len(pixel)
+
+        skyProjection = np.zeros((len(wave), nPixel))
+        if isinstance(loc, SparseCube):
+            self.cellEmiss = np.zeros((len(wave), nCells), dtype=getDtype(dtype))
+        if keep:
+            emiss = np.zeros((len(wave), int(np.prod(shape))), dtype=getDtype(dtype))
 
+        # =============================================================
+        # Quantize all the cells at once, so that the bins do not
+        # depend on the chunks
+        # =============================================================
+        den = n_e
+        emissError = 0.
+        if not isinstance(maxError, type(None)):
+            tem, den, emissError = self.getQuantizedInputs(wave_param=wave_param,
+                tem=np.broadcast_to(tem, (nCells,)), den=np.broadcast_to(n_e, (nCells,)),
+                maxError=maxError, backend=backend)
+            unique = True
+
+        nEval = 0.
+        for start in range(0, nCells, chunk):
+            cells = slice(start, start + chunk)
+            values = [x[cells] if np.ndim(x) else x for x in (tem, n_e, n_i, den)]
+
+            lineEmiss = self.getCellEmissivity(wave_param=wave_param,
+                tem=values[0], n_e=values[1], n_i=values[2], den=values[3],
+                backend=backend, unique=unique)
+            lineEmiss = np.broadcast_to(lineEmiss, (len(wave), len(pixel[cells])))
+
+            nEval += len(pixel[cells]) / self.compression
+
+            for i, _ in enumerate(wave):
+                weights = np.where(np.isnan(lineEmiss[i]), 0., lineEmiss[i])
+                skyProjection[i] += np.bincount(pixel[cells], weights=weights,
+                                                minlength=nPixel)
+                if isinstance(loc, SparseCube):
+                    self.cellEmiss[i][cells] = lineEmiss[i]
+                if keep:
+                    emiss[i][flat[cells]] = lineEmiss[i]
+
+        self.compression = nCells / nEval if nEval else 1.
+        self.emissError = emissError
+        self.skyProjection = skyProjection.reshape(len(wave), *shape[:-1])
+        if keep:
+            self.emiss = emiss.reshape(len(wave), *shape)
+
+
+    def getCellMaps(self):
+        """
+        Returns the per-cell line intensities of a SparseCube nebula,
+        shape (len(wave), ncells), to be projected by a ProjectionOperator.
+        """
+        if isinstance(getattr(self, 'cellEmiss', None), type(None)):
+            print("The emissivities must be computed on a SparseCube")
+            sys.exit(1)
+        return self.cellEmiss
 
-    def getSkyEmiss(self, convl=True, kernel=1):
+    def getSkyMaps(self):
+        """
+        Returns the sky maps of the ion, shape (len(wave), nx, ny).
+        """
+        return self.skyEmiss
+
+    def setSkyMaps(self, maps):
+        """
+        Stores the sky maps projected from getCellMaps (or convolved
+        from getSkyMaps).
+        """
+        self.skyEmiss = maps
+
+    def getSkyEmiss(self, convl=True, kernel=1, operator=None):
         """
         Computes the line instensity alone a line of sight and
         stores in the variable <self.skyEmiss>
 
         Parameters:
             convl       boolean to convole the intensity image
-            kernel      gaussian filter kernel value
+            kernel      gaussian filter kernel value or PSF (e.g.
+                        psf.MoffatPSF); a list of kernels gives one
+                        map per kernel, so that <self.skyEmiss> has
+                        the shape (len(wave), len(kernel), nx, ny)
+            operator    ProjectionOperator of the SparseCube nebula; if
+                        passed, it replaces the sum and the convolution
+                        (<convl> and <kernel> are then ignored)
         """
+        if not isinstance(operator, type(None)):
+            self.setSkyMaps(operator.project(self.getCellMaps()))
+            return
+
+        # =============================================================
+        # Look up the memo, keyed by the emissivity computation
+        # =============================================================
+        key = None
+        if not isinstance(cache.memo, type(None)) \
+                and not isinstance(getattr(self, 'emissKey', None), type(None)):
+            key = ("sky", self.emissKey, convl, fingerprint(kernel))
+            value = cache.memo.get(key)
+            if not isinstance(value, type(None)):
+                self.skyEmiss = value
+                return
+
         emiss = self.emiss
         wave = self.wave
+        skyProjection = getattr(self, 'skyProjection', None)
 
         # Create an array to hold the intensity values as observed
         # on the sky.
-        dim = np.shape(emiss)[1:-1]
+        if isinstance(skyProjection, type(None)):
+            dim = np.shape(emiss)[1:-1]
+        else:
+            dim = np.shape(skyProjection)[1:]
         skyEmiss = np.zeros((len(wave), *dim))
 
         # For each wavelength, compute the intensity by summing along
-        # the line of sight. Option to convolve the image with a
-        # gaussian filter.
+        # the line of sight (accumulating in float64), or use the sky
+        # map accumulated by getEmissivity(project=True). Option to
+        # convolve the image with a gaussian filter.
         for i, _ in enumerate(wave):
-            emission = np.nansum(self.emiss[i], axis=-1)
-            skyEmiss[i] = convl2D(emission, kernel) if convl else emission
+            if isinstance(skyProjection, type(None)):
+                skyEmiss[i] = np.nansum(self.emiss[i], axis=-1, dtype=np.float64)
+            else:
+                skyEmiss[i] = skyProjection[i]
+
+        # All the lines are convolved together (and the sky maps are
+        # transformed once for all the kernels of a list)
+        if convl:
+            skyEmiss = convl2D(skyEmiss, kernel)
 
         self.skyEmiss = skyEmiss
 
-    def getIonAbundance(self, skyTem, skyDen, Hbeta, los, wave_param):
+        if not isinstance(key, type(None)):
+            cache.memo.put(key, skyEmiss)
+
+    def getHbetaEmissivity(self, tem, den, backend=None):
+        """
+        Returns the H-beta (H I 4_2) emissivities for the paired (after
+        broadcasting) temperatures and densities.
+
+        Parameters:
+            tem             temperature(s)
+            den             electron densit(y/ies)
+            backend         emissivity backend {"pyneb", "native", "table"};
+                            defaults to <self.backend>. The "table" backend
+                            shares its table with the HI instances.
+        """
+        if isinstance(backend, type(None)):
+            backend = self.backend
+
+        if isinstance(ion.hbetaAtom, type(None)):
+            ion.hbetaAtom = pn.RecAtom('H', 1)
+
+        if backend == "table":
+            table = getTable(atom=ion.hbetaAtom, wave=("4_2",), wave_param="label")
+            return table.getEmissivity(tem=tem, den=den)[0]
+
+        return getLineEmissivity(atom=ion.hbetaAtom, wave=("4_2",),
+            wave_param="label", tem=tem, den=den)[0]
+
+    def getIonAbundance(self, skyTem, skyDen, Hbeta, los, wave_param, backend=None):
         """
         Computes the abudance estimates given the density and
         temperature along each line of sight and stores in the
@@ -214,7 +725,30 @@ class ion:
             Hbeta           H-beta intensities
             los             light of sight positions
             wave_param
+            backend         emissivity backend {"pyneb", "native", "table"};
+                            defaults to <self.backend>. "pyneb" calls
+                            PyNeb's getIonAbundance for each line.
+
+        Postcondition:
+            Except with the "pyneb" backend, the abundances are computed
+            as (I / I_Hbeta) * (emiss_Hbeta / emiss) for all the lines and
+            lines of sight at once, with the line emissivities from
+            computeEmissivity and the H-beta emissivities from
+            getHbetaEmissivity. The sky maps may carry a leading kernel
+            axis (see getSkyEmiss); they are broadcast against each other.
         """
+        if isinstance(backend, type(None)):
+            backend = self.backend
+
+        # ================================================
+        # Broadcast the line and H-beta sky maps (e.g. if
+        # only one of them was convolved with several
+        # kernels)
+        # ================================================
+        shape = np.broadcast_shapes(np.shape(self.skyEmiss)[1:], np.shape(Hbeta))
+        skyMaps = np.broadcast_to(self.skyEmiss, (len(self.wave), *shape))
+        Hbeta = np.broadcast_to(Hbeta, shape)
+
         # ================================================
         # If no line of sight positions have been passed,
         # use the lines of sight with non-zero H-beta
@@ -222,15 +756,14 @@ class ion:
         # ================================================
         if isinstance(los, type(None)):
             los = Hbeta > 0
+        los = broadcastLOS(los, shape)
 
         # ================================================
         # Extract the temperatures and densities along
         # the line of sights.
         # ================================================
-        if isinstance(skyDen, np.ndarray):
-            skyDen = skyDen[los]
-        if isinstance(skyTem, np.ndarray):
-            skyTem = skyTem[los]
+        skyDen = getSkyValues(skyDen, los, shape)
+        skyTem = getSkyValues(skyTem, los, shape)
 
         # ================================================
         # If either the temperature of density are constant,
@@ -242,13 +775,30 @@ class ion:
         if isinstance(skyTem, (int, float)):
             skyTem = np.repeat(skyTem, len(skyDen))
 
+        ionDen = np.zeros((len(self.wave), *shape))
+
+        # ================================================
+        # Vectorized estimate from the line and H-beta
+        # emissivities
+        # ================================================
+        if backend != "pyneb":
+            emiss = self.computeEmissivity(wave_param=wave_param,
+                tem=skyTem, den=skyDen, backend=backend)
+            hbeta = self.getHbetaEmissivity(tem=skyTem, den=skyDen, backend=backend)
+
+            skyEmiss = np.stack([sky[los] for sky in skyMaps])
+            for i, abundance in enumerate(skyEmiss / Hbeta[los] * hbeta / emiss):
+                ionDen[i][los] = abundance
+
+            self.ionAbundance = ionDen
+            return
+
         params = {
             "den": skyDen,
             "tem": skyTem,
         }
 
-        ionDen = np.zeros_like(self.skyEmiss)
-        for i, sky in enumerate(self.skyEmiss):
+        for i, sky in enumerate(skyMaps):
             lr = 100*sky[los] / Hbeta[los]
             params["int_ratio"] = lr
             params[wave_param] = self.wave[i]
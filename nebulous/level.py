@@ -0,0 +1,165 @@
+from pyneb.utils.physics import CST
+import numpy as np
+
+__all__ = [
+    'getLineEmissivity',
+    'getLineFactor',
+    'getPopulations',
+]
+
+def getLineEmissivity(atom, wave, wave_param, tem, den, solver="pyneb"):
+    """
+    Computes the emissivities of several lines of an atom for the
+    paired (after broadcasting) temperatures and densities.
+
+    Parameters:
+        atom            PyNeb Atom or RecAtom
+        wave            wavelengths or labels of the lines {tuple}
+        wave_param      indicator of wave values {"wave", "label"}
+        tem             temperature(s)
+        den             electron densit(y/ies)
+        solver          level population solver {"pyneb", "native"}
+
+    Returns:
+        emiss           emissivities, shape (len(wave), *shape)
+
+    Postcondition:
+        For collisionally excited lines the level populations are
+        solved once per cell and every line is derived from that
+        single solution. Recombination lines are interpolated from
+        the atomic data, one line at a time.
+    """
+    tem, den = np.broadcast_arrays(
+        np.asarray(tem, dtype='float'),
+        np.asarray(den, dtype='float')
+    )
+    shape = tem.shape
+    tem = tem.ravel()
+    den = den.ravel()
+
+    emiss = np.zeros((len(wave), tem.size))
+
+    # ==================================================
+    # Collisionally excited lines: a single population
+    # solve shared by all the lines
+    # ==================================================
+    if atom.type == 'coll' and wave_param == 'wave':
+        if solver == "native":
+            pops = getPopulations(atom=atom, tem=tem, den=den)
+        else:
+            pops = atom.getPopulations(tem=tem, den=den, product=False)
+            pops = np.reshape(pops, (-1, tem.size))
+
+        for i, wl in enumerate(wave):
+            lev_i, lev_j = atom.getTransition(wl)
+            emiss[i] = pops[lev_i-1] * getLineFactor(atom, lev_i, lev_j) / den
+
+    # ==================================================
+    # Otherwise, call PyNeb once for each line
+    # ==================================================
+    else:
+        for i, wl in enumerate(wave):
+            params = {
+                "tem": tem,
+                "den": den,
+                "product": False,
+                wave_param: wl
+            }
+            emiss[i] = atom.getEmissivity(**params)
+
+    return emiss.reshape(len(wave), *shape)
+
+def getLineFactor(atom, lev_i, lev_j):
+    """
+    Returns the energy of the transition <lev_i> -> <lev_j> times
+    its transition probability (erg s^-1), which converts the upper
+    level population into the line emission.
+    """
+    deltaE = (atom.getEnergy(lev_i) - atom.getEnergy(lev_j)) \
+           * CST.HPLANCK * CST.CLIGHT * 1.e8
+    return deltaE * atom.getA(lev_i, lev_j)
+
+def getPopulations(atom, tem, den, maxMemory=2**26):
+    """
+    Batched N-level population solver for a collisionally excited atom.
+
+    Parameters:
+        atom            PyNeb Atom
+        tem             temperatures {1D array}
+        den             electron densities {1D array}
+        maxMemory       maximum size (bytes) of the rate matrices
+                        assembled at once
+
+    Returns:
+        pops            level populations, shape (NLevels, len(tem))
+
+    Postcondition:
+        The collision and radiative rate matrices of all the cells in
+        a chunk are assembled at once and solved with a single call to
+        np.linalg.solve, using the same atomic data and equations as
+        Atom.getPopulations(product=False). Cells whose matrix is
+        singular are assigned NaN.
+    """
+    tem = np.asarray(tem, dtype='float').ravel()
+    den = np.asarray(den, dtype='float').ravel()
+
+    # ==================================================
+    # Radiative pumping is not handled; defer to PyNeb
+    # ==================================================
+    if not isinstance(getattr(atom, 'pumpingSED', None), type(None)):
+        pops = atom.getPopulations(tem=tem, den=den, product=False)
+        return np.reshape(pops, (-1, tem.size))
+
+    # ==================================================
+    # Radiative rates out of each level
+    # ==================================================
+    n_level = atom.NLevels
+    A = atom.getA()[:n_level, :n_level]
+    sum_A = A.sum(axis=1)
+
+    # ==================================================
+    # Number of cells solved at once
+    # ==================================================
+    chunk = max(1, int(maxMemory // (8 * n_level**2)))
+
+    pops = np.zeros((n_level, tem.size))
+    for start in range(0, tem.size, chunk):
+        t = tem[start:start+chunk]
+        d = den[start:start+chunk]
+
+        # ==============================================
+        # Collision rates, shape (cells, n_level, n_level)
+        # ==============================================
+        q = np.reshape(atom.getCollRates(t, n_level), (n_level, n_level, t.size))
+        q = np.moveaxis(q, -1, 0)
+
+        # ==============================================
+        # Rate matrix: element [row, col] is the rate
+        # from level <col> into level <row>
+        # ==============================================
+        matrix = d[:, None, None] * np.swapaxes(q, 1, 2) + A.T
+        diag = -(d[:, None] * q.sum(axis=2) + sum_A)
+        idx = np.arange(n_level)
+        matrix[:, idx, idx] = diag
+
+        # ==============================================
+        # Replace the first equation by the normalization
+        # ==============================================
+        matrix[:, 0, :] = 1.
+        vect = np.zeros((t.size, n_level, 1))
+        vect[:, 0] = 1.
+
+        # ==============================================
+        # Solve; if any matrix is singular, solve the
+        # chunk cell by cell.
+        # ==============================================
+        try:
+            pops[:, start:start+chunk] = np.linalg.solve(matrix, vect)[..., 0].T
+        except np.linalg.LinAlgError:
+            for i in range(t.size):
+                try:
+                    pops[:, start+i] = np.linalg.solve(matrix[i], vect[i])[:, 0]
+                except np.linalg.LinAlgError:
+                    pops[:, start+i] = np.nan
+
+    return pops
@@ -1,11 +1,18 @@
 import pyneb as pn, sys
 import numpy as np
 from scipy.interpolate import interp1d
+from .cache import getCachePath, loadCache, saveCache
 from .ion import ion
-from .utils import convl2D
+from .level import getLineEmissivity
+from .sparse import SparseCube
+from .table import interp2D, monotonicSurface
+from .utils import broadcastLOS, convl2D, getSkyValues
 
 class ORL(ion):
 
+    # Interpolate the precomputed recombination emissivity tables
+    backend = "table"
+
     def __init__(self, atom, ion, wave_label):
 
         if not isinstance(wave_label, tuple):
@@ -17,28 +24,35 @@ class ORL(ion):
         self.wave = wave_label
         self.atom = pn.RecAtom(atom, ion)
 
-    def getEmissivity(self, tem, n_e, n_i=None, loc=None):
+    def makeTable(self, **kwargs):
+        super(ORL,self).makeTable(wave_param='label', **kwargs)
+
+    def getEmissivity(self, tem, n_e, n_i=None, loc=None, **kwargs):
         super(ORL,self).getEmissivity(wave_param='label',
-            tem=tem, n_e=n_e, n_i=n_i, loc=loc)
+            tem=tem, n_e=n_e, n_i=n_i, loc=loc, **kwargs)
 
-    def getSkyEmiss(self, convl, kernel=1):
-        super(ORL,self).getSkyEmiss(convl=convl, kernel=kernel)
+    def getSkyEmiss(self, convl, kernel=1, operator=None):
+        super(ORL,self).getSkyEmiss(convl=convl, kernel=kernel, operator=operator)
 
-    def getIonAbundance(self, skyTem, skyDen, Hbeta, los=None):
+    def getIonAbundance(self, skyTem, skyDen, Hbeta, los=None, backend=None):
         super(ORL,self).getIonAbundance(skyTem=skyTem, skyDen=skyDen,
-            Hbeta=Hbeta, los=los, wave_param = "label")
+            Hbeta=Hbeta, los=los, wave_param = "label", backend=backend)
 
 
 class HI(ORL):
     def __init__(self):
         super(HI,self).__init__(atom='H', ion=1, wave_label = ("4_2",))
 
-    def getEmissivity(self, tem, n_e, loc=None):
-        super(HI, self).getEmissivity(tem=tem, n_e=n_e, n_i=n_e, loc=loc)
-        self.jBeta = self.emiss[0]
+    def getEmissivity(self, tem, n_e, loc=None, **kwargs):
+        super(HI, self).getEmissivity(tem=tem, n_e=n_e, n_i=n_e, loc=loc, **kwargs)
+        self.jBeta = None if isinstance(self.emiss, type(None)) else self.emiss[0]
 
-    def getSkyEmiss(self, convl=True, kernel=1):
-        super(HI, self).getSkyEmiss(convl=convl, kernel=kernel)
+    def getSkyEmiss(self, convl=True, kernel=1, operator=None):
+        super(HI, self).getSkyEmiss(convl=convl, kernel=kernel, operator=operator)
+        self.skyBeta = self.skyEmiss[0]
+
+    def setSkyMaps(self, maps):
+        super(HI, self).setSkyMaps(maps)
         self.skyBeta = self.skyEmiss[0]
 
 
@@ -46,11 +60,11 @@ class OII(ORL):
     def __init__(self):
         super(OII,self).__init__(atom='O', ion=2, wave_label = ('4089.29', '4638.86', '4641.81', '4649.13'))
 
-    def getEmissivity(self, tem, n_e, n_i=None, loc=None):
-        super(OII, self).getEmissivity(tem=tem, n_e=n_e, n_i=n_i, loc=loc)
+    def getEmissivity(self, tem, n_e, n_i=None, loc=None, **kwargs):
+        super(OII, self).getEmissivity(tem=tem, n_e=n_e, n_i=n_i, loc=loc, **kwargs)
 
-    def getSkyEmiss(self, convl=True, kernel=1):
-        super(OII,self).getSkyEmiss(convl=convl, kernel=kernel)
+    def getSkyEmiss(self, convl=True, kernel=1, operator=None):
+        super(OII,self).getSkyEmiss(convl=convl, kernel=kernel, operator=operator)
 
 
 
@@ -61,20 +75,58 @@ class OII(ORL):
 class BJ(ORL):
     def __init__(self, transition="11_2"):
         super(BJ,self).__init__(atom='H', ion=1, wave_label = (transition,))
+        self.splines = {}
 
-    def getEmissivity(self, tem, n_e, loc=None):
-        super(BJ, self).getEmissivity(tem=tem, n_e=n_e, n_i=n_e, loc=loc)
+    def getEmissivity(self, tem, n_e, loc=None, **kwargs):
+        super(BJ, self).getEmissivity(tem=tem, n_e=n_e, n_i=n_e, loc=loc, **kwargs)
         self.__getBalmerEmissivity(tem=tem, n_e=n_e, loc=loc)
 
-    def getSkyEmiss(self, convl=True, kernel=1):
-        super(BJ, self).getSkyEmiss(convl=convl, kernel=kernel)
-        self.__getSkyBalmer(convl=convl, kernel=kernel)
+    def getSkyEmiss(self, convl=True, kernel=1, operator=None):
+        super(BJ, self).getSkyEmiss(convl=convl, kernel=kernel, operator=operator)
+        if isinstance(operator, type(None)):
+            self.__getSkyBalmer(convl=convl, kernel=kernel)
+
+    # ======================================================
+    # The balmer jump is projected along with the line
+    # ======================================================
+    def getCellMaps(self):
+        return np.vstack([super(BJ, self).getCellMaps(), self.BJ])
+
+    def getSkyMaps(self):
+        return np.concatenate([super(BJ, self).getSkyMaps(), self.skyBJ[None]])
+
+    def setSkyMaps(self, maps):
+        super(BJ, self).setSkyMaps(maps[:-1])
+        self.skyBJ = maps[-1]
 
-    def getSkyTem(self, skyDen=1000, los=None, **kwargs):
+    def getSkyTem(self, skyDen=1000, los=None, kind='slinear', grid=1000,
+                  nTem=1000, nDen=None, cache=True):
+        """
+        Estimates the temperature on each line of sight from the ratio
+        of the balmer jump to the recombination line and stores it in
+        the variable <self.skyTem>.
+
+        Parameters:
+            skyDen      electron density, constant or a sky map
+            los         lines of sight
+            kind        kind of interpolation of the 1D spline
+                        (constant <skyDen>, see spline1D)
+            grid        temperature grid size of the 1D spline
+            nTem        temperature grid size of the 2D surface
+                        (sky map <skyDen>, see surface2D)
+            nDen        density grid size of the 2D surface
+            cache       store the 2D surface in the on-disk cache
+
+        Postcondition:
+            Both the 1D spline and the 2D surface span the log-spaced
+            temperatures of the atomic data. The lines of sight whose
+            ratio falls outside of them are set to NaN and flagged in
+            <self.outOfRange>, whether <skyDen> is a constant or a map.
+        """
         if isinstance(los, type(None)):
             los = self.skyEmiss[0] > 0
-        if isinstance(skyDen, np.ndarray):
-            skyDen = skyDen[los]
+        los = broadcastLOS(los, self.skyBJ.shape)
+        skyDen = getSkyValues(skyDen, los, self.skyBJ.shape)
 
         # ======================================================
         # Compute the ratio of the balmer jump to the
@@ -87,12 +139,14 @@ class BJ(ORL):
         # then use the 2D spline to estimate the temperature;
         # else use the 1D spline.
         # ======================================================
+        self.outOfRange = np.zeros(self.skyBJ.shape, dtype=bool)
         if isinstance(skyDen, np.ndarray):
-            print('<skyDen> must be a single value, not an array.' )
-            sys.exit(1)
+            tems, self.outOfRange[los] = self.invertSurface(ratio=ratio, den=skyDen,
+                nTem=nTem, nDen=nDen, cache=cache)
         else:
-            tem_func = self.spline1D(den=skyDen, **kwargs)
+            tem_func = self.spline1D(den=skyDen, kind=kind, grid=grid)
             tems = tem_func(ratio)
+            self.outOfRange[los] = (ratio < tem_func.x[0]) | (ratio > tem_func.x[-1])
 
         temBJ = np.zeros_like(self.skyBJ)
         temBJ[los] = tems
@@ -103,6 +157,15 @@ class BJ(ORL):
     # ======================================================
     def __getBalmerEmissivity(self, tem, n_e, loc=None):
 
+        # ==================================================
+        # Sparse nebula: per-cell values of <loc>
+        # ==================================================
+        if isinstance(loc, SparseCube):
+            self.BJ = np.broadcast_to(n_e**2 * np.power(tem, -1.5), loc.index.shape)
+            self.BJloc = loc
+            return
+        self.BJloc = None
+
         # ==================================================
         # Determine the cube size; if <loc> is not passed,
         # then find the cells that have non-zero values.
@@ -140,7 +203,10 @@ class BJ(ORL):
         self.BJ = emiss
 
     def __getSkyBalmer(self, convl=True, kernel=1):
-        skyBJ = np.sum(self.BJ, axis=-1)
+        if isinstance(self.BJloc, SparseCube):
+            skyBJ = self.BJloc.project(self.BJ)
+        else:
+            skyBJ = np.sum(self.BJ, axis=-1, dtype=np.float64)
         if convl:
             skyBJ = convl2D(skyBJ, kernel)
         self.skyBJ = skyBJ
@@ -159,13 +225,25 @@ class BJ(ORL):
         Parameters:
             den         Electron density to evaluate at (cm^3)
             kind        Kind of interpolation to use
-            grid        Linear grid spacing for temperatures
+            grid        Number of log-spaced temperatures
+
+        Postcondition:
+            The temperatures span the range of the atomic data, as
+            the surface of surface2D does; ratios outside of the
+            spline return NaN. The function is stored in the variable
+            <self.splines> and reused by later calls with the same
+            parameters.
         """
+        key = (float(den), kind, grid)
+        if key in self.splines:
+            return self.splines[key]
+
         # ===================================================
         # Create a grid over the temperature range.
         # The range of values over which PyNeb works is given
+        # by the atomic data.
         # ===================================================
-        tems = np.linspace(500, 30e3, grid)
+        tems = np.geomspace(np.min(self.atom.temp), np.max(self.atom.temp), grid)
 
         # ===================================================
         # Compute the ratio of the balmer jump strength to the
@@ -180,15 +258,123 @@ class BJ(ORL):
         # ===================================================
         # Perform an interpolation of the ratio and temperature
         # to create a function that will compute the temperature
-        # given a ratio.
+        # given a ratio (NaN outside of the grid).
         # ===================================================
-        tem_func = interp1d(ratio, tems, kind=kind, fill_value='extrapolate')
+        tem_func = interp1d(ratio, tems, kind=kind, bounds_error=False, fill_value=np.nan)
+        self.splines[key] = tem_func
 
         # ===================================================
         # Return the temperature function
         # ===================================================
         return tem_func
 
+    def surface2D(self, nTem=1000, nDen=None, cache=True):
+        """
+        Creates a surface giving the (log) temperature as a function of
+        the log electron density and the log of the ratio of the balmer
+        jump strength to the strength of the recombination line.
+
+        Parameters:
+            nTem        number of points of the temperature and ratio grids
+            nDen        number of points of the density grid; defaults to
+                        a spacing of 0.05 dex
+            cache       store the surface in the on-disk cache
+
+        Returns:
+            surface     dictionary holding the surface "value", shape
+                        (nDen, nTem), the grids "den" and "ratio" as
+                        (first value, spacing), and the ratio range
+                        "lo", "hi" at each density
+
+        Postcondition:
+            The grids cover the temperatures and densities of the
+            atomic data. The surface is stored in the variable
+            <self.splines> and, if caching is enabled, in the
+            on-disk cache.
+        """
+        logTem = np.log10([np.min(self.atom.temp), np.max(self.atom.temp)])
+        logDen = [np.min(self.atom.log_dens), np.max(self.atom.log_dens)]
+
+        if isinstance(nDen, type(None)):
+            nDen = int(round((logDen[1] - logDen[0]) / 0.05)) + 1
+
+        key = {
+            "label": self.wave[0],
+            "logTem": (float(logTem[0]), float(logTem[1]), nTem),
+            "logDen": (float(logDen[0]), float(logDen[1]), nDen),
+        }
+        memoKey = tuple(sorted(key.items()))
+
+        if memoKey in self.splines:
+            return self.splines[memoKey]
+
+        path = getCachePath("bj", self.atom, key) if cache else None
+        surface = loadCache(path, mmap=False)
+
+        if isinstance(surface, type(None)):
+            temGrid = np.linspace(*logTem, nTem)
+            denGrid = np.linspace(*logDen, nDen)
+            den, tem = np.meshgrid(10**denGrid, 10**temGrid, indexing='ij')
+
+            # ===============================================
+            # The n_e^2 dependence of both strengths cancels
+            # ===============================================
+            j_H = getLineEmissivity(atom=self.atom, wave=self.wave,
+                wave_param="label", tem=tem, den=den)[0]
+            ratio = np.log10(tem**(-1.5) / j_H)
+
+            r0, dr, value, lo, hi = monotonicSurface(x=temGrid, y=ratio, nRatio=nTem)
+            surface = {
+                "value": value,
+                "den": np.array([denGrid[0], denGrid[1] - denGrid[0]]),
+                "ratio": np.array([r0, dr]),
+                "lo": lo,
+                "hi": hi,
+            }
+            saveCache(path, surface, key=key)
+
+        self.splines[memoKey] = surface
+        return surface
+
+    def invertSurface(self, ratio, den, **kwargs):
+        """
+        Estimates the temperatures from the observed ratios of the
+        balmer jump strength to the recombination line strength and
+        the electron densities of each line of sight.
+
+        Parameters:
+            ratio       observed ratios
+            den         electron densities, same shape as <ratio>
+            kwargs      arguments passed to surface2D
+
+        Returns:
+            tems        temperatures (NaN where out of range)
+            outOfRange  boolean array flagging the ratios outside of
+                        the surface
+
+        Postcondition:
+            Densities are clipped to the range of the atomic data, as
+            is done by PyNeb when computing the emissivities.
+        """
+        surface = self.surface2D(**kwargs)
+        d0, dd = surface["den"]
+        r0, dr = surface["ratio"]
+        denGrid = d0 + dd * np.arange(len(surface["lo"]))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            logRatio = np.log10(ratio)
+            logDen = np.clip(np.log10(den), denGrid[0], denGrid[-1])
+
+        lo = np.interp(logDen, denGrid, surface["lo"])
+        hi = np.interp(logDen, denGrid, surface["hi"])
+        outOfRange = (logRatio < lo) | (logRatio > hi)
+
+        tems = 10**interp2D(surface["value"], x=logDen, y=logRatio,
+            x0=d0, dx=dd, y0=r0, dy=dr, order=1)
+        tems[outOfRange | ~np.isfinite(logRatio) | ~np.isfinite(logDen)] = np.nan
+
+        return tems, outOfRange
+
 
 
 
@@ -1,22 +1,25 @@
-from .utils import makeCube, getCoordinates, getRadialDistance
+from .sparse import SparseCube, countCells, fillCells
+from .utils import getCoordinates, getRadialDistance
 from scipy.stats import beta, expon, lognorm, powerlognorm
 import numpy as np, sys
 
-def beta(dim, loc, mean, alpha, beta, seed=82921):
+def beta(dim, loc, mean, alpha, beta, seed=82921, dtype=None):
     """
     Fills cells at <loc> with numbers sampled from the beta distribution
     with <mu=mean> and parameters <alpha> and <beta>; returns the cube.
 
     Parameters:
         dim         cube dimensions {tuple}
-        loc         array containing cells representing the nebula {np.ndarray}
+        loc         cells representing the nebula {tuple or SparseCube}
         mean        mean value {float}
         alpha       parameter value {float > 0}
         beta        parameter value {float > 0}
         seed        random number seed {int}
+        dtype       floating point type of the cube (see utils.setDtype)
 
     Returns:
-        cube        cube containing random values {3D array}
+        cube        cube containing random values {3D array}, or the
+                    per-cell values if <loc> is a SparseCube
     """
 
     # ==========================================================
@@ -34,7 +37,7 @@ def beta(dim, loc, mean, alpha, beta, seed=82921):
     # ==========================================================
     # Determine the number of cells that need to be filled
     # ==========================================================
-    numCells = len(loc[0])
+    numCells = countCells(loc)
 
     # ==========================================================
     # Sample values from beta distribution
@@ -50,8 +53,7 @@ def beta(dim, loc, mean, alpha, beta, seed=82921):
     # Make a cube to hold the values and fill the cells
     # indicated by <loc> with the random values
     # ==========================================================
-    cube = makeCube(dim)
-    cube[loc] = values
+    cube = fillCells(dim, loc, values, dtype)
 
     # ==========================================================
     # Return the cube
@@ -59,19 +61,21 @@ def beta(dim, loc, mean, alpha, beta, seed=82921):
     return(cube)
 
 
-def exponential(dim, loc, mean, seed=1000):
+def exponential(dim, loc, mean, seed=1000, dtype=None):
     """
     Fills cells at <loc> with numbers sampled from an exponential distribution
     with <mu=mean> and returns the cube.
 
     Parameters:
         dim         cube dimensions {tuple}
-        loc         array containing cells representing the nebula {np.ndarray}
+        loc         cells representing the nebula {tuple or SparseCube}
         mean        mean value {float}
         seed        random number seed {int}
+        dtype       floating point type of the cube (see utils.setDtype)
 
     Returns:
-        cube        cube containing random values {3D array}
+        cube        cube containing random values {3D array}, or the
+                    per-cell values if <loc> is a SparseCube
     """
     # ==========================================================
     # Set the random number seed
@@ -81,7 +85,7 @@ def exponential(dim, loc, mean, seed=1000):
     # ==========================================================
     # Determine the number of cells that need to be filled
     # ==========================================================
-    numCells = len(loc[0])
+    numCells = countCells(loc)
 
     # ==========================================================
     # Sample values from exponential distribution with
@@ -93,8 +97,7 @@ def exponential(dim, loc, mean, seed=1000):
     # Make a cube to hold the values and fill the cells
     # indicated by <loc> with the random values
     # ==========================================================
-    cube = makeCube(dim)
-    cube[loc] = values
+    cube = fillCells(dim, loc, values, dtype)
 
     # ==========================================================
     # Return the cube
@@ -102,7 +105,7 @@ def exponential(dim, loc, mean, seed=1000):
     return(cube)
 
 
-def lognormal(dim, loc, mean, sigma, seed=5007):
+def lognormal(dim, loc, mean, sigma, seed=5007, dtype=None):
     """
 
     """
@@ -114,7 +117,7 @@ def lognormal(dim, loc, mean, sigma, seed=5007):
     # ==========================================================
     # Determine the number of cells that need to be filled
     # ==========================================================
-    numCells = len(loc[0])
+    numCells = countCells(loc)
 
     # ==========================================================
     # Determine the <scale> parameter: <mean = scale exp(s^2/2)>
@@ -129,8 +132,7 @@ def lognormal(dim, loc, mean, sigma, seed=5007):
     # ==========================================================
     # Make cube and fill
     # ==========================================================
-    cube = makeCube(dim)
-    cube[loc] = values
+    cube = fillCells(dim, loc, values, dtype)
 
     # ==========================================================
     # Return the cube
@@ -138,7 +140,7 @@ def lognormal(dim, loc, mean, sigma, seed=5007):
     return(cube)
 
 
-def lognormalPareto(dim, loc, mean, sigma, c, seed=7007):
+def lognormalPareto(dim, loc, mean, sigma, c, seed=7007, dtype=None):
     """
 
     """
@@ -150,7 +152,7 @@ def lognormalPareto(dim, loc, mean, sigma, c, seed=7007):
     # ==========================================================
     # Determine the number of cells that need to be filled
     # ==========================================================
-    numCells = len(loc[0])
+    numCells = countCells(loc)
 
     # ==========================================================
     # Sample values from distribution
@@ -161,8 +163,7 @@ def lognormalPareto(dim, loc, mean, sigma, c, seed=7007):
     # ==========================================================
     # Make cube and fill
     # ==========================================================
-    cube = makeCube(dim)
-    cube[loc] = values
+    cube = fillCells(dim, loc, values, dtype)
 
     # ==========================================================
     # Return the cube
@@ -171,7 +172,7 @@ def lognormalPareto(dim, loc, mean, sigma, c, seed=7007):
 
 
 
-def mlp(dim, loc, mean, sigma, alpha, seed=3923):
+def mlp(dim, loc, mean, sigma, alpha, seed=3923, dtype=None):
     """
     Fills cells at <loc> with numbers sampled from the modified lognormal
     pareto distribution with <mu=mean> and parameters <sigma> and <alpha>
@@ -179,14 +180,16 @@ def mlp(dim, loc, mean, sigma, alpha, seed=3923):
 
     Parameters:
         dim         cube dimensions {tuple}
-        loc         array containing cells representing the nebula {np.ndarray}
+        loc         cells representing the nebula {tuple or SparseCube}
         mean        mean value {float}
         sigma       distribution parameter {float}
         alpha       distribution parameter {float>1}
         seed        random number seed {int}
+        dtype       floating point type of the cube (see utils.setDtype)
 
     Returns:
-        cube        cube containing random values {3D array}
+        cube        cube containing random values {3D array}, or the
+                    per-cell values if <loc> is a SparseCube
     """
 
     # ==========================================================
@@ -204,7 +207,7 @@ def mlp(dim, loc, mean, sigma, alpha, seed=3923):
     # ==========================================================
     # Determine the number of cells that need to be filled
     # ==========================================================
-    numCells = len(loc[0])
+    numCells = countCells(loc)
 
     # ==========================================================
     # Determine the parameter <mu> to have a mean density
@@ -222,15 +225,14 @@ def mlp(dim, loc, mean, sigma, alpha, seed=3923):
     # ==========================================================
     # Make cube and fill
     # ==========================================================
-    cube = makeCube(dim)
-    cube[loc] = values
+    cube = fillCells(dim, loc, values, dtype)
 
     # ==========================================================
     # Return the cube
     # ==========================================================
     return(cube)
 
-def normal(dim, loc, mean, sigma, seed=8938):
+def normal(dim, loc, mean, sigma, seed=8938, dtype=None):
     """
 
     """
@@ -242,7 +244,7 @@ def normal(dim, loc, mean, sigma, seed=8938):
     # ==========================================================
     # Determine the number of cells that need to be filled
     # ==========================================================
-    numCells = len(loc[0])
+    numCells = countCells(loc)
 
     # ==========================================================
     # Sample values from the distribution
@@ -258,15 +260,14 @@ def normal(dim, loc, mean, sigma, seed=8938):
     # ==========================================================
     # Make cube and fill
     # ==========================================================
-    cube = makeCube(dim)
-    cube[loc] = sample
+    cube = fillCells(dim, loc, sample, dtype)
 
     # ==========================================================
     # Return the cube
     # ==========================================================
     return(cube)
 
-def polytrope(cube, index, mean, geom=False, loc=None):
+def polytrope(cube, index, mean, geom=False, loc=None, dtype=None):
     """
     Given a cube containing values, returns another cube
     with values based on a polytropic relation with index
@@ -279,7 +280,14 @@ def polytrope(cube, index, mean, geom=False, loc=None):
         mean            mean value of returned array {float}
         geom            method by which the mean value is calculated
                         (by volume {true} or particles {false}) {boolean}
-        loc             cell locations
+        loc             cell locations, or a SparseCube (<cube> may then
+                        also hold the per-cell values)
+        dtype           floating point type of the returned cube
+                        (defaults to that of <cube>)
+
+    Returns:
+        new_cube        cube of the new values, or the per-cell values
+                        if <loc> is a SparseCube (see sparse.fillCells)
     """
     # ==========================================================
     # Make sure <cube> is a numpy array
@@ -295,36 +303,52 @@ def polytrope(cube, index, mean, geom=False, loc=None):
         loc = cube > 0
 
     # ==========================================================
-    # Create a new cube to hold the new values.
+    # Extract the values of the cells
     # ==========================================================
-    new_cube = np.zeros_like(cube)
+    if isinstance(loc, SparseCube):
+        values = cube if np.ndim(cube) == 1 else loc.getValues(cube)
+    else:
+        values = cube[loc]
 
     # ==========================================================
-    # Apply the polytrope transformation to the values in <cube>
+    # Apply the polytrope transformation to the values
     # ==========================================================
-    new_cube[loc] = cube[loc]**(index-1)
+    new_values = values**(index-1)
 
     # ==========================================================
     # Normalize to the correct mean temperature, which are
     # either the volumetric mean or by the particle numbers.
     # ==========================================================
     if geom:
-        new_cube[loc] *= mean / new_cube[loc].mean()
+        new_values *= mean / new_values.mean(dtype=np.float64)
     else:
-        weighted = np.sum(cube[loc] * new_cube[loc]) / np.sum(cube[loc])
-        new_cube[loc] *= mean / weighted
+        weighted = np.sum(values * new_values, dtype=np.float64) \
+                 / np.sum(values, dtype=np.float64)
+        new_values *= mean / weighted
+
+    # ==========================================================
+    # Return the per-cell values or a new cube holding them
+    # ==========================================================
+    if isinstance(loc, SparseCube):
+        return new_values.astype(values.dtype if isinstance(dtype, type(None)) else dtype)
+
+    new_cube = np.zeros_like(cube, dtype=dtype)
+    new_cube[loc] = new_values
 
     return(new_cube)
 
 
-def radialGradient(dim, loc, func, mean=None):
+def radialGradient(dim, loc, func, mean=None, dtype=None):
     """
     Function that applies a radial gradient
     """
     # ==========================================================
     # Get the (scaled) radial distances
     # ==========================================================
-    distances = getRadialDistance(dim=dim)[loc]
+    if isinstance(loc, SparseCube):
+        distances = loc.getRadialDistance()
+    else:
+        distances = getRadialDistance(dim=dim)[loc]
     distances /= np.max(distances)
 
     # ==========================================================
@@ -341,8 +365,7 @@ def radialGradient(dim, loc, func, mean=None):
     # ==========================================================
     # Create a cube; insert the values
     # ==========================================================
-    cube = makeCube(dim)
-    cube[loc] = values
+    cube = fillCells(dim, loc, values, dtype)
 
     # ==========================================================
     # Return the cube
@@ -0,0 +1,396 @@
+from abc import ABC, abstractmethod
+from scipy.ndimage import gaussian_filter, maximum_filter
+from .cache import fingerprint
+import scipy.fft
+import numpy as np
+
+__all__ = [
+    'gaussianKernel',
+    'PSF',
+    'GaussianPSF',
+    'MoffatPSF',
+    'ImagePSF',
+    'getKernelImage',
+    'getKernelKey',
+    'getPaddedShape',
+    'getKernelTransform',
+    'convolve',
+    'clipSupport',
+    'convolveMany',
+    'convolveIons',
+]
+
+# ===================================================
+# Number of workers used by scipy.fft (-1: all cores)
+# and smallest gaussian kernel radius (4 sigma, pixels)
+# convolved by FFT rather than by the separable spatial
+# filter (method='auto'). On one core, the spatial
+# filter is faster for radii up to 24 px: for 1-30
+# maps of 128^2-512^2 pixels it takes 0.3-0.5 of the
+# FFT time at radius 2-4 and 0.5-0.9 at radius 24.
+# Set fftRadius = 0 to always use the FFT (e.g. with
+# many cores); PSFs and kernel lists always use it.
+# ===================================================
+workers = -1
+fftRadius = 24
+
+# ===================================================
+# Padding modes of np.pad equivalent to the boundary
+# modes of scipy.ndimage
+# ===================================================
+pad_modes = {
+    'constant': 'constant',
+    'reflect' : 'symmetric',
+    'mirror'  : 'reflect',
+    'nearest' : 'edge',
+    'wrap'    : 'wrap',
+}
+
+def gaussianKernel(sigma, truncate=4.0):
+    """
+    Returns the normalized 1D gaussian kernel used by
+    scipy.ndimage.gaussian_filter for a standard deviation <sigma>.
+    """
+    radius = int(truncate * float(sigma) + 0.5)
+    if sigma <= 0:
+        return np.ones(1)
+
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * (x / sigma)**2)
+    return kernel / kernel.sum()
+
+# ===================================================
+# Point spread functions accepted as the convolution
+# kernel of the sky maps (in place of a gaussian width)
+# ===================================================
+class PSF(ABC):
+    """
+    Abstract base class of the point spread functions. Subclasses set
+    the tuple <self.params> and define makeImage, which returns the
+    (unnormalized) PSF sampled on the pixel grid, centered on the
+    pixel (nx//2, ny//2).
+
+    PSFs with the same parameters compare equal, so that their
+    transforms (see getKernelTransform) and the memoized sky maps
+    are shared.
+    """
+    def __init__(self):
+        image = np.asarray(self.makeImage(), dtype=np.float64)
+
+        # ==============================================
+        # Give the image odd dimensions, keeping the center
+        # ==============================================
+        image = np.pad(image, [(0, 1 - n % 2) for n in image.shape])
+        self.image = image / image.sum()
+
+    @abstractmethod
+    def makeImage(self):
+        """
+        Returns the (unnormalized) PSF sampled on the pixel grid.
+        """
+
+    @property
+    def key(self):
+        return (type(self).__name__, self.params)
+
+    def __eq__(self, other):
+        return isinstance(other, PSF) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return '{:s}{}'.format(type(self).__name__, self.params)
+
+    def getGrid(self, radius):
+        """
+        Returns the open grid (x, y) of pixel offsets within <radius>.
+        """
+        rx, ry = np.broadcast_to(radius, (2,))
+        return np.ogrid[-rx:rx + 1, -ry:ry + 1]
+
+class GaussianPSF(PSF):
+    """
+    Elliptical gaussian PSF.
+
+    Parameters:
+        sigmaX      standard deviation along the major axis (pixels)
+        sigmaY      standard deviation along the minor axis; defaults
+                    to <sigmaX> (circular)
+        angle       angle of the major axis from the x-axis toward the
+                    y-axis (degrees)
+        truncate    truncation radius in units of the standard deviation
+    """
+    def __init__(self, sigmaX, sigmaY=None, angle=0., truncate=4.0):
+        if isinstance(sigmaY, type(None)):
+            sigmaY = sigmaX
+        self.params = (float(sigmaX), float(sigmaY), float(angle), float(truncate))
+        super(GaussianPSF, self).__init__()
+
+    def makeImage(self):
+        sigmaX, sigmaY, angle, truncate = self.params
+        theta = np.radians(angle)
+
+        # ==============================================
+        # Extent of the truncated ellipse on each axis
+        # ==============================================
+        extent = np.hypot(sigmaX * np.array([np.cos(theta), np.sin(theta)]),
+                          sigmaY * np.array([np.sin(theta), np.cos(theta)]))
+        x, y = self.getGrid([int(truncate * e + 0.5) for e in extent])
+
+        u = x*np.cos(theta) + y*np.sin(theta)
+        v = y*np.cos(theta) - x*np.sin(theta)
+        return np.exp(-0.5 * ((u / sigmaX)**2 + (v / sigmaY)**2))
+
+class MoffatPSF(PSF):
+    """
+    Circular Moffat PSF, (1 + r^2/alpha^2)^(-beta).
+
+    Parameters:
+        fwhm        full width at half maximum (pixels)
+        beta        power index; the default is the value for
+                    atmospheric turbulence (Trujillo et al. 2001)
+        truncate    truncation radius in units of the FWHM
+    """
+    def __init__(self, fwhm, beta=4.765, truncate=4.0):
+        self.params = (float(fwhm), float(beta), float(truncate))
+        super(MoffatPSF, self).__init__()
+
+    def makeImage(self):
+        fwhm, beta, truncate = self.params
+        alpha = fwhm / (2. * np.sqrt(2.**(1. / beta) - 1.))
+
+        x, y = self.getGrid(int(truncate * fwhm + 0.5))
+        return (1. + (x**2 + y**2) / alpha**2)**(-beta)
+
+class ImagePSF(PSF):
+    """
+    PSF given as an image (e.g. measured on a field star), centered on
+    the pixel (nx//2, ny//2); it is normalized to unit sum.
+    """
+    def __init__(self, image):
+        self.image = np.array(image, dtype=np.float64)
+        self.params = fingerprint(self.image)
+        super(ImagePSF, self).__init__()
+
+    def makeImage(self):
+        return self.image
+
+def getKernelImage(kernel):
+    """
+    Returns the kernel sampled on the pixel grid: the image of a PSF,
+    or the (separable) gaussian of standard deviation(s) <kernel>.
+    """
+    if isinstance(kernel, PSF):
+        return kernel.image
+    kx, ky = (gaussianKernel(s) for s in np.broadcast_to(kernel, (2,)))
+    return np.outer(kx, ky)
+
+def getKernelKey(kernel):
+    """
+    Returns a hashable key of a PSF or gaussian width(s).
+    """
+    if isinstance(kernel, PSF):
+        return kernel.key
+    return tuple(float(s) for s in np.broadcast_to(kernel, (2,)))
+
+def getPaddedShape(shape, pad):
+    """
+    Returns the shape of the FFT grid for maps of the given shape
+    padded by <pad> pixels on each side: the smallest size at least as
+    large that is fast for the FFT.
+    """
+    return tuple(scipy.fft.next_fast_len(n + 2*p, real=True) for n, p in zip(shape, pad))
+
+kernel_dict = {}
+
+def getKernelTransform(shape, kernel, mode='constant', pad=None):
+    """
+    Returns the (real) Fourier transform of a kernel, a PSF or the
+    gaussian of standard deviation(s) <kernel> (a scalar or one per
+    axis), for maps of the given shape.
+
+    Parameters:
+        shape       shape (nx, ny) of the maps
+        kernel      PSF or standard deviation(s) in pixels
+        mode        boundary mode (see scipy.ndimage)
+        pad         padding of the maps; defaults to the kernel radius.
+                    A larger padding lets kernels share a padded grid.
+
+    Returns:
+        transform   Fourier transform of the kernel on the padded grid
+        pad         padding (px, py) added on each side of the maps;
+                    the grid is further extended with zeros to a size
+                    that is fast for the FFT
+
+    Postcondition:
+        Transforms are stored in <kernel_dict>, keyed by (shape,
+        kernel, mode, pad), and reused by later calls.
+    """
+    image = getKernelImage(kernel)
+    if isinstance(pad, type(None)):
+        pad = tuple(n // 2 for n in image.shape)
+    pad = tuple(int(p) for p in pad)
+    key = (tuple(shape), getKernelKey(kernel), mode, pad)
+
+    if key not in kernel_dict:
+        padded = getPaddedShape(shape, pad)
+
+        # ==============================================
+        # Kernel centered on the origin of the padded grid
+        # ==============================================
+        grid = np.zeros(padded)
+        grid[:image.shape[0], :image.shape[1]] = image
+        grid = np.roll(grid, tuple(-(n // 2) for n in image.shape), axis=(0, 1))
+
+        kernel_dict[key] = (scipy.fft.rfft2(grid, workers=workers), pad)
+
+    return kernel_dict[key]
+
+def convolve(maps, kernel=1.0, mode='constant', method='auto'):
+    """
+    Convolves a stack of maps with a gaussian kernel or a PSF.
+
+    Parameters:
+        maps        2D map or stack of maps, shape (..., nx, ny)
+        kernel      standard deviation(s) of the gaussian in pixels,
+                    or a PSF (always applied by FFT)
+        mode        boundary mode (see scipy.ndimage)
+        method      "fft", "direct" (separable spatial filter), or "auto":
+                    FFT for gaussian kernels of radius >= <fftRadius>
+
+    Returns:
+        maps        convolved maps, same shape as the input (see
+                    convolveMany if <kernel> is a list)
+
+    Postcondition:
+        All the maps are convolved together and the result equals
+        scipy.ndimage.gaussian_filter (or scipy.ndimage.convolve with
+        the PSF image) applied to each map (to round-off). With FFTs,
+        pixels outside the kernel footprint of the non-zero pixels are
+        set to exactly zero, and non-negative maps stay non-negative
+        with non-negative kernels, as with the spatial filter.
+    """
+    if isinstance(kernel, list):
+        return convolveMany(maps, kernels=kernel, mode=mode)
+
+    maps = np.asarray(maps, dtype=np.float64)
+    shape = maps.shape[-2:]
+
+    if isinstance(kernel, PSF):
+        method = 'fft'
+    elif method == 'auto':
+        radius = max(int(4.0 * float(s) + 0.5) for s in np.broadcast_to(kernel, (2,)))
+        method = 'fft' if radius >= fftRadius else 'direct'
+
+    if method == 'direct':
+        sigma = tuple(np.broadcast_to(kernel, (2,)))
+        return gaussian_filter(maps, sigma=(0,) * (maps.ndim - 2) + sigma, mode=mode)
+
+    transform, pad = getKernelTransform(shape, kernel, mode)
+    if pad == (0, 0):
+        return maps.copy()
+
+    # ==================================================
+    # Pad according to the boundary mode and convolve
+    # ==================================================
+    width = [(0, 0)] * (maps.ndim - 2) + [(pad[0], pad[0]), (pad[1], pad[1])]
+    padded = np.pad(maps, width, mode=pad_modes[mode])
+
+    size = getPaddedShape(shape, pad)
+    spectrum = scipy.fft.rfft2(padded, s=size, workers=workers)
+    result = scipy.fft.irfft2(spectrum * transform, s=size, workers=workers)
+    result = result[..., pad[0]:pad[0] + shape[0], pad[1]:pad[1] + shape[1]]
+
+    return clipSupport(result, maps, getKernelImage(kernel), mode)
+
+def clipSupport(result, maps, image, mode='constant'):
+    """
+    Sets to zero the pixels of the convolved maps <result> outside of
+    the footprint of the kernel <image> around the non-zero pixels of
+    <maps>, removing the FFT round-off there, and clamps the result to
+    zero if both <maps> and the kernel are non-negative.
+    """
+    footprint = (image != 0)[::-1, ::-1].reshape((1,) * (maps.ndim - 2) + image.shape)
+    support = maximum_filter(maps != 0, footprint=footprint, mode=mode)
+    result[~support] = 0.
+
+    if np.all(image >= 0) and np.all(maps >= 0):
+        np.maximum(result, 0., out=result)
+
+    return result
+
+def convolveMany(maps, kernels, mode='constant'):
+    """
+    Convolves a stack of maps with several kernels, e.g. to study the
+    effect of the seeing without recomputing the sky maps.
+
+    Parameters:
+        maps        2D map or stack of maps, shape (..., nx, ny)
+        kernels     list of PSFs or standard deviations in pixels
+                    (each a scalar or one per axis)
+        mode        boundary mode (see scipy.ndimage)
+
+    Returns:
+        maps        convolved maps, shape (..., len(kernels), nx, ny)
+
+    Postcondition:
+        The maps are padded for the widest kernel and transformed once;
+        each kernel then costs a multiplication and an inverse FFT.
+        Each result equals convolve(maps, kernel).
+    """
+    maps = np.asarray(maps, dtype=np.float64)
+    shape = maps.shape[-2:]
+
+    # ==================================================
+    # Pad for the widest kernel and transform once
+    # ==================================================
+    images = [getKernelImage(k) for k in kernels]
+    pad = tuple(max([i.shape[axis] // 2 for i in images], default=0) for axis in (0, 1))
+
+    width = [(0, 0)] * (maps.ndim - 2) + [(pad[0], pad[0]), (pad[1], pad[1])]
+    padded = np.pad(maps, width, mode=pad_modes[mode])
+
+    size = getPaddedShape(shape, pad)
+    spectrum = scipy.fft.rfft2(padded, s=size, workers=workers)
+
+    result = np.zeros((*maps.shape[:-2], len(kernels), *shape))
+    for i, (k, image) in enumerate(zip(kernels, images)):
+        if image.size == 1:
+            result[..., i, :, :] = maps
+            continue
+
+        transform, _ = getKernelTransform(shape, k, mode, pad=pad)
+        sky = scipy.fft.irfft2(spectrum * transform, s=size, workers=workers)
+        sky = sky[..., pad[0]:pad[0] + shape[0], pad[1]:pad[1] + shape[1]]
+        result[..., i, :, :] = clipSupport(sky, maps, image, mode)
+
+    return result
+
+def convolveIons(ions, kernel=1.0, mode='constant', method='auto'):
+    """
+    Computes the sky maps of several ions and convolves all of them
+    (every line, the balmer jump of BJ) in a single FFT.
+
+    Parameters:
+        ions        ions whose emissivities have been computed
+        kernel      standard deviation(s) of the gaussian in pixels, a
+                    PSF, or a list of them (see convolveMany)
+        mode        boundary mode (see scipy.ndimage)
+        method      convolution method (see convolve)
+
+    Postcondition:
+        Equivalent to calling ion.getSkyEmiss(convl=True, kernel=kernel)
+        for each ion.
+    """
+    maps = []
+    for i in ions:
+        i.getSkyEmiss(convl=False)
+        maps.append(np.reshape(i.getSkyMaps(), (-1, *np.shape(i.skyEmiss)[1:])))
+
+    sky = convolve(np.concatenate(maps), kernel=kernel, mode=mode, method=method)
+
+    start = 0
+    for i, m in zip(ions, maps):
+        i.setSkyMaps(sky[start:start + len(m)])
+        start += len(m)
@@ -0,0 +1,411 @@
+from .utils import getDtype, makeCube, parseCubeDimensions
+from scipy.ndimage import gaussian_filter1d
+import scipy.sparse as sp
+from .cache import fingerprint, getCachePath, loadCache, saveCache
+from .psf import PSF
+import numpy as np
+import sys
+
+__all__ = [
+    'SparseCube',
+    'countCells',
+    'fillCells',
+    'ProjectionOperator',
+    'getOperator',
+    'projectIons',
+]
+
+class SparseCube:
+    """
+    Sparse representation of a nebula: the flat indices of the occupied
+    cells of the cube and, for each quantity, a vector of per-cell values.
+    The line of sight is along the last axis.
+    """
+
+    def __init__(self, dim, index):
+        """
+        Parameters:
+            dim         cube dimensions {tuple}
+            index       flat (C-order) indices of the occupied cells
+
+        Postcondition:
+            The indices are stored as int32 (int64 if the cube has more
+            than 2^31 cells) in the order given, so per-cell values
+            aligned with <index> (or with the <loc> of fromLoc) stay
+            aligned. Masks, geom.sphere and Shape.getIndex give sorted
+            indices, which keep the cell accesses in memory order.
+        """
+        self.dim = parseCubeDimensions(dim)
+        itype = np.int32 if np.prod(self.dim) < 2**31 else np.int64
+        self.index = np.asarray(index, dtype=itype).ravel()
+        self.pixel = self.index // itype(self.dim[-1])
+        self.nPixel = int(np.prod(self.dim[:-1]))
+
+    @classmethod
+    def fromLoc(cls, dim, loc):
+        """
+        Creates a SparseCube from cell locations (e.g. those returned by
+        geom.sphere or geom.partition) or a boolean mask. The cells keep
+        the order of <loc>.
+        """
+        dim = parseCubeDimensions(dim)
+        if isinstance(loc, np.ndarray) and loc.dtype == bool:
+            return cls(dim, np.flatnonzero(loc))
+        return cls(dim, np.ravel_multi_index(loc, dim))
+
+    @classmethod
+    def fromCube(cls, cube):
+        """
+        Creates a SparseCube from the non-zero cells of a cube.
+        """
+        return cls(np.shape(cube), np.flatnonzero(cube))
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def loc(self):
+        """
+        Cell locations as a tuple of index arrays.
+        """
+        return np.unravel_index(self.index, self.dim)
+
+    def getValues(self, cube):
+        """
+        Returns the values of a cube at the occupied cells.
+        """
+        return np.ravel(cube)[self.index]
+
+    def toCube(self, values, dtype=None):
+        """
+        Returns a cube with the occupied cells filled with <values>.
+        """
+        cube = makeCube(self.dim, dtype)
+        cube.ravel()[self.index] = values
+        return cube
+
+    def project(self, values):
+        """
+        Sums per-cell values along the line of sight.
+
+        Parameters:
+            values      per-cell values (a scalar counts as a constant)
+
+        Returns:
+            sky         2D float64 array of the sums on the sky
+        """
+        weights = np.broadcast_to(np.asarray(values, dtype=np.float64), self.index.shape)
+        sky = np.bincount(self.pixel, weights=weights, minlength=self.nPixel)
+        return sky.reshape(self.dim[:-1])
+
+    def getDepth(self):
+        """
+        Returns the number of occupied cells along each line of sight.
+        """
+        depth = np.bincount(self.pixel, minlength=self.nPixel)
+        return depth.reshape(self.dim[:-1])
+
+    def getCoordinates(self):
+        """
+        Returns the coordinates of the occupied cells with the center
+        of the cube as the origin (see utils.getCoordinates).
+        """
+        return tuple(l - 0.5 * (d - 1) for l, d in zip(self.loc, self.dim))
+
+    def getRadialDistance(self):
+        """
+        Returns the distance of the occupied cells from the center
+        of the cube.
+        """
+        x, y, z = self.getCoordinates()
+        return np.sqrt(x**2 + y**2 + z**2)
+
+    def getRayMap(self, inclination=0., positionAngle=0., skyShape=None):
+        """
+        Computes the sky pixels onto which each cell is projected when the
+        nebula is viewed at an arbitrary orientation.
+
+        Parameters:
+            inclination     rotation (degrees) about the first axis, tilting
+                            the line of sight (last axis) toward the second
+            positionAngle   rotation (degrees) of the sky plane about the
+                            line of sight
+            skyShape        shape of the sky map; defaults to dim[:-1]
+
+        Returns:
+            pixel           flat sky pixel of the four neighbours of each
+                            cell, shape (4, ncells); -1 outside of the map
+            weights         bilinear weights, shape (4, ncells)
+
+        Postcondition:
+            The weights of each cell sum to one, so that the flux is
+            conserved except for the cells projected outside of the map.
+            With both angles zero the cells fall on the pixel centers and
+            the map reduces to the sum along the last axis.
+        """
+        if isinstance(skyShape, type(None)):
+            skyShape = self.dim[:-1]
+
+        x, y, z = self.getCoordinates()
+        inc = np.radians(inclination)
+        pa = np.radians(positionAngle)
+
+        # ==================================================
+        # Tilt the line of sight, then rotate the sky plane
+        # ==================================================
+        y = y * np.cos(inc) - z * np.sin(inc)
+        u = x * np.cos(pa) - y * np.sin(pa) + 0.5 * (skyShape[0] - 1)
+        v = x * np.sin(pa) + y * np.cos(pa) + 0.5 * (skyShape[1] - 1)
+
+        # ==================================================
+        # Bilinear weights of the four surrounding pixels
+        # ==================================================
+        u0 = np.floor(u).astype(int)
+        v0 = np.floor(v).astype(int)
+        du = u - u0
+        dv = v - v0
+
+        pixel = np.empty((4, len(self)), dtype=np.int64)
+        weights = np.empty((4, len(self)))
+        for k, (a, b) in enumerate(((0, 0), (0, 1), (1, 0), (1, 1))):
+            iu = u0 + a
+            iv = v0 + b
+            inside = (iu >= 0) & (iu < skyShape[0]) & (iv >= 0) & (iv < skyShape[1])
+            pixel[k] = np.where(inside, iu * skyShape[1] + iv, -1)
+            weights[k] = (du if a else 1 - du) * (dv if b else 1 - dv)
+
+        return pixel, weights
+
+def countCells(loc):
+    """
+    Returns the number of cells at <loc> (cell locations or a SparseCube).
+    """
+    if isinstance(loc, SparseCube):
+        return len(loc)
+    return len(loc[0])
+
+def fillCells(dim, loc, values, dtype=None):
+    """
+    Assigns <values> to the cells at <loc>.
+
+    Parameters:
+        dim         cube dimensions {tuple}
+        loc         cell locations or a SparseCube
+        values      per-cell values
+        dtype       floating point type (see utils.setDtype)
+
+    Returns:
+        values      the per-cell values if <loc> is a SparseCube,
+                    else a cube with the cells at <loc> filled
+    """
+    if isinstance(loc, SparseCube):
+        return np.asarray(values, dtype=getDtype(dtype))
+
+    cube = makeCube(dim, dtype)
+    cube[loc] = values
+    return cube
+
+
+# ===================================================
+# Linear operator from per-cell values to sky maps
+# ===================================================
+class ProjectionOperator:
+    """
+    Sparse linear operator mapping the per-cell values of a SparseCube to
+    the (optionally convolved) sky map: the sum along the line of sight
+    followed by the gaussian filter of utils.convl2D.
+    """
+
+    def __init__(self, geometry, kernel=1, convl=True, mode='constant', cache=True,
+                 inclination=0., positionAngle=0., skyShape=None):
+        """
+        Parameters:
+            geometry        SparseCube
+            kernel          gaussian filter kernel value (standard deviation
+                            in pixels, or a list or tuple of one per sky
+                            axis); PSF objects are not supported
+            convl           include the convolution
+            mode            boundary mode of the filter (see convl2D)
+            cache           store the operator in the on-disk cache
+            inclination     viewing inclination (degrees, see
+                            SparseCube.getRayMap)
+            positionAngle   viewing position angle (degrees)
+            skyShape        shape of the sky map; defaults to dim[:-1]
+
+        Postcondition:
+            The operator is stored in factored form: the CSR projection
+            <self.projection> (sky pixels x cells, one element per cell)
+            and the banded 1D filters <self.filterX> and <self.filterY>,
+            whose Kronecker product is the convolution. Applying the
+            factors costs O(ncells + npixels (8 kernel + 1)) rather than
+            the O(ncells (8 kernel + 1)^2) of the explicit operator
+            <self.matrix>, which is only formed on request.
+        """
+        self.geometry = geometry
+        self.kernel = parseKernel(kernel) if convl else 0
+        self.mode = mode
+        self.shape = tuple(geometry.dim[:-1] if isinstance(skyShape, type(None)) else skyShape)
+        self.nPixel = int(np.prod(self.shape))
+
+        key = {
+            "dim": geometry.dim,
+            "index": fingerprint(geometry.index),
+            "kernel": self.kernel,
+            "mode": mode,
+            "view": (float(inclination), float(positionAngle), self.shape),
+        }
+        path = getCachePath("projection", None, key) if cache else None
+        arrays = loadCache(path)
+
+        if isinstance(arrays, type(None)):
+            arrays = {}
+
+            # ==============================================
+            # Projection along the last axis, or along the
+            # rays of the requested orientation
+            # ==============================================
+            if inclination == 0 and positionAngle == 0 and self.shape == geometry.dim[:-1]:
+                rows, weights = geometry.pixel, np.ones(len(geometry))
+                cols = np.arange(len(geometry))
+            else:
+                rows, weights = geometry.getRayMap(inclination=inclination,
+                    positionAngle=positionAngle, skyShape=self.shape)
+                cols = np.broadcast_to(np.arange(len(geometry)), rows.shape)
+                keep = (rows >= 0) & (weights > 0)
+                rows, weights, cols = rows[keep], weights[keep], cols[keep]
+
+            projection = sp.csr_matrix((weights, (rows, cols)),
+                shape=(self.nPixel, len(geometry)))
+            for name, matrix in (("projection", projection),
+                                 ("filterX", self.getFilter(0)),
+                                 ("filterY", self.getFilter(1))):
+                arrays[name + "_data"] = matrix.data
+                arrays[name + "_indices"] = matrix.indices
+                arrays[name + "_indptr"] = matrix.indptr
+            saveCache(path, arrays, key=key)
+
+        def csr(name, shape):
+            return sp.csr_matrix((arrays[name + "_data"],
+                arrays[name + "_indices"], arrays[name + "_indptr"]), shape=shape)
+
+        nx, ny = self.shape
+        self.projection = csr("projection", (self.nPixel, len(geometry)))
+        self.filterX = csr("filterX", (nx, nx))
+        self.filterY = csr("filterY", (ny, ny))
+
+    def getFilter(self, axis):
+        """
+        Returns the sparse (banded) matrix of the 1D gaussian filter
+        along an axis of the sky map.
+        """
+        n = self.shape[axis]
+        sigma = np.broadcast_to(self.kernel, (2,))[axis]
+
+        if sigma > 0:
+            f = gaussian_filter1d(np.eye(n), sigma=sigma, axis=0, mode=self.mode)
+            return sp.csr_matrix(f)
+        return sp.identity(n, format='csr')
+
+    @property
+    def convolution(self):
+        """
+        Gaussian filter acting on the flattened sky map, a CSR matrix
+        of shape (sky pixels, sky pixels).
+        """
+        return sp.kron(self.filterX, self.filterY, format='csr')
+
+    @property
+    def matrix(self):
+        """
+        Explicit operator, a CSR matrix of shape (sky pixels, cells).
+        """
+        return (self.convolution @ self.projection).tocsr()
+
+    def project(self, values):
+        """
+        Maps per-cell values to sky maps.
+
+        Parameters:
+            values          per-cell values, shape (ncells,) or (nmaps, ncells)
+
+        Returns:
+            sky             sky maps, shape (*skyShape) or (nmaps, *skyShape)
+        """
+        values = np.asarray(values, dtype=np.float64)
+        missing = np.isnan(values)
+        if missing.any():
+            values = np.where(missing, 0., values)
+        nx, ny = self.shape
+
+        # ==================================================
+        # Sum along the line of sight, shape (nx, ny, nmaps)
+        # ==================================================
+        sky = (self.projection @ np.atleast_2d(values).T).reshape(nx, ny, -1)
+
+        # ==================================================
+        # Separable convolution along each sky axis
+        # ==================================================
+        sky = (self.filterX @ sky.reshape(nx, -1)).reshape(nx, ny, -1)
+        sky = self.filterY @ sky.transpose(1, 0, 2).reshape(ny, -1)
+        sky = sky.reshape(ny, nx, -1).transpose(2, 1, 0)
+
+        return sky[0] if values.ndim == 1 else sky
+
+def parseKernel(kernel):
+    """
+    Returns the gaussian width(s) of a ProjectionOperator as a scalar or
+    a tuple with one width per sky axis (lists are converted).
+    """
+    if isinstance(kernel, PSF):
+        print("ProjectionOperator only supports gaussian kernels; "
+              "use getSkyEmiss without an operator for PSFs")
+        sys.exit(1)
+
+    if isinstance(kernel, (list, tuple, np.ndarray)):
+        kernel = tuple(float(k) for k in np.ravel(kernel))
+        if len(kernel) != 2:
+            print("The kernel of a ProjectionOperator must be a width or one per sky axis")
+            sys.exit(1)
+
+    return kernel
+
+operator_dict = {}
+
+def getOperator(geometry, kernel=1, convl=True, mode='constant', inclination=0.,
+                positionAngle=0., skyShape=None, **kwargs):
+    """
+    Returns the ProjectionOperator of a geometry, kernel and orientation,
+    creating it on first use. Operators are shared within a process, so
+    that an orientation is mapped once for all the lines and ions.
+    """
+    key = (geometry.dim, fingerprint(geometry.index), parseKernel(kernel) if convl else 0,
+           mode, inclination, positionAngle, skyShape)
+
+    if key not in operator_dict:
+        operator_dict[key] = ProjectionOperator(geometry=geometry,
+            kernel=kernel, convl=convl, mode=mode, inclination=inclination,
+            positionAngle=positionAngle, skyShape=skyShape, **kwargs)
+
+    return operator_dict[key]
+
+def projectIons(ions, operator):
+    """
+    Projects the per-cell emission of several ions onto the sky with a
+    single sparse matrix product.
+
+    Parameters:
+        ions            ions whose emissivities were computed on the
+                        geometry of <operator> (see ion.getCellMaps)
+        operator        ProjectionOperator
+
+    Postcondition:
+        The sky maps of each ion are set with ion.setSkyMaps, as done by
+        ion.getSkyEmiss(operator=operator).
+    """
+    maps = [np.atleast_2d(i.getCellMaps()) for i in ions]
+    sky = operator.project(np.concatenate(maps))
+
+    start = 0
+    for i, m in zip(ions, maps):
+        i.setSkyMaps(sky[start:start + len(m)])
+        start += len(m)
@@ -0,0 +1,476 @@
+from .cache import getAtomicDataSet, getCachePath, loadCache, saveCache
+from .level import getLineEmissivity
+import numpy as np
+import sys
+
+__all__ = [
+    'interp2D',
+    'quantize',
+    'monotonicInverse',
+    'monotonicSurface',
+    'cubicWeights',
+    'bicubicCoefficients',
+    'evalCoefficients',
+    'EmissivityTable',
+    'getTable',
+]
+
+def interp2D(table, x, y, x0, dx, y0, dy, order=3):
+    """
+    Vectorized interpolation of values tabulated on a uniform 2D grid.
+
+    Parameters:
+        table       tabulated values, shape (..., nx, ny), or a list
+                    of (nx, ny) tables sharing the same grid
+        x           x-coordinates to evaluate at {1D array}
+        y           y-coordinates to evaluate at {1D array}
+        x0, dx      first value and spacing of the x-grid
+        y0, dy      first value and spacing of the y-grid
+        order       1 (bilinear) or 3 (bicubic)
+
+    Returns:
+        values      interpolated values, shape (..., len(x))
+
+    Postcondition:
+        Coordinates outside of the grid are extrapolated from the
+        nearest grid cell; the caller is responsible for masking them.
+    """
+    nx, ny = np.shape(table)[-2:]
+
+    # ==================================================
+    # Fractional grid position of each coordinate
+    # ==================================================
+    fx = (x - x0) / dx
+    fy = (y - y0) / dy
+
+    with np.errstate(invalid='ignore'):
+        ix = np.clip(np.floor(fx).astype(int), 0, nx - 2)
+        iy = np.clip(np.floor(fy).astype(int), 0, ny - 2)
+
+    tx = fx - ix
+    ty = fy - iy
+
+    # ==================================================
+    # Interpolation weights (bilinear or cubic convolution)
+    # ==================================================
+    if order == 1:
+        offsets = (0, 1)
+        wx = (1 - tx, tx)
+        wy = (1 - ty, ty)
+    elif order == 3:
+        offsets = (-1, 0, 1, 2)
+        wx = cubicWeights(tx)
+        wy = cubicWeights(ty)
+    else:
+        print("<order> must be 1 (bilinear) or 3 (bicubic)")
+        sys.exit(1)
+
+    # ==================================================
+    # Gather the neighbouring grid values and sum
+    # ==================================================
+    def gather(ia, ib):
+        if isinstance(table, (list, tuple)):
+            return np.stack([t[ia, ib] for t in table])
+        return table[..., ia, ib]
+
+    values = 0.
+    for a, wa in zip(offsets, wx):
+        ia = np.clip(ix + a, 0, nx - 1)
+        for b, wb in zip(offsets, wy):
+            ib = np.clip(iy + b, 0, ny - 1)
+            values = values + gather(ia, ib) * (wa * wb)
+
+    return values
+
+def quantize(x, width):
+    """
+    Snaps values to uniform bins spanning their range.
+
+    Parameters:
+        x           values to bin {1D array}
+        width       maximum bin width (may be inf)
+
+    Returns:
+        index       bin index of each value
+        center      bin center of each value
+
+    Postcondition:
+        The range of <x> is split into the smallest number of equal
+        bins no wider than <width>, so no value is further than half
+        a bin width from its center.
+    """
+    lo, hi = np.min(x), np.max(x)
+    nbins = max(1, int(np.ceil((hi - lo) / width)))
+    width = (hi - lo) / nbins
+
+    if width > 0:
+        index = np.minimum(((x - lo) / width).astype(int), nbins - 1)
+    else:
+        index = np.zeros(np.shape(x), dtype=int)
+
+    center = lo + (index + 0.5) * width
+
+    return index, center
+
+def monotonicInverse(x, y):
+    """
+    Inverts a tabulated function y(x) over its longest strictly
+    monotonic run.
+
+    Parameters:
+        x           tabulated abscissae (increasing) {1D array}
+        y           tabulated values {1D array}
+
+    Returns:
+        yp          values of the monotonic run, increasing
+        xp          corresponding abscissae, suitable for np.interp(y, yp, xp)
+    """
+    # ==================================================
+    # Label the runs of constant slope sign
+    # ==================================================
+    sign = np.sign(np.diff(y))
+    breaks = np.flatnonzero((sign[1:] != sign[:-1]) | (sign[1:] == 0)) + 1
+    starts = np.concatenate(([0], breaks))
+    stops = np.concatenate((breaks, [len(sign)]))
+
+    # ==================================================
+    # Keep the longest strictly monotonic run
+    # ==================================================
+    lengths = np.where(sign[starts] != 0, stops - starts, 0)
+    k = np.argmax(lengths)
+    run = slice(starts[k], stops[k] + 1)
+
+    xp, yp = x[run], y[run]
+    if yp[0] > yp[-1]:
+        xp, yp = xp[::-1], yp[::-1]
+
+    return yp, xp
+
+def monotonicSurface(x, y, nRatio=1000):
+    """
+    Inverts each row of a tabulated surface y(c, x) onto a shared
+    uniform grid of y values.
+
+    Parameters:
+        x           tabulated abscissae (increasing) {1D array}
+        y           tabulated values, shape (nc, len(x))
+        nRatio      number of points of the y-grid
+
+    Returns:
+        y0, dy      first value and spacing of the y-grid
+        surface     inverse x(c, y), shape (nc, nRatio)
+        lo, hi      range of y covered by each row {1D arrays}
+
+    Postcondition:
+        Each row is restricted to its longest strictly monotonic run.
+        Outside of [lo, hi] the rows are extended with their edge values
+        so that interpolation near the edges stays finite; the caller is
+        responsible for masking the values outside of the range.
+    """
+    runs = [monotonicInverse(x=x, y=row) for row in y]
+    lo = np.array([yp[0] for yp, _ in runs])
+    hi = np.array([yp[-1] for yp, _ in runs])
+
+    grid = np.linspace(lo.min(), hi.max(), nRatio)
+    surface = np.stack([np.interp(grid, yp, xp) for yp, xp in runs])
+
+    return grid[0], grid[1] - grid[0], surface, lo, hi
+
+def cubicWeights(t):
+    """
+    Cubic convolution (Catmull-Rom) weights for the four grid
+    nodes surrounding the fractional position <t>.
+    """
+    t2 = t * t
+    t3 = t2 * t
+    return (
+        0.5 * (-t3 + 2*t2 - t),
+        0.5 * (3*t3 - 5*t2 + 2),
+        0.5 * (-3*t3 + 4*t2 + t),
+        0.5 * (t3 - t2)
+    )
+
+
+# ===================================================
+# Cubic convolution weights as polynomials in t: the
+# weight of node a is sum_p CUBIC[a, p] t^p
+# ===================================================
+CUBIC = np.array([
+    [0.0, -0.5,  1.0, -0.5],
+    [1.0,  0.0, -2.5,  1.5],
+    [0.0,  0.5,  2.0, -1.5],
+    [0.0,  0.0, -0.5,  0.5]
+])
+
+def bicubicCoefficients(table):
+    """
+    Precomputes the bicubic (cubic convolution) polynomial coefficients
+    of every cell of a uniformly gridded table.
+
+    Parameters:
+        table       tabulated values, shape (nx, ny)
+
+    Returns:
+        coeffs      coefficients, shape (nx-1, ny-1, 4, 4), such that
+                    within cell (i, j) the interpolant is
+                    sum_pq coeffs[i, j, p, q] t^p u^q
+    """
+    nx, ny = np.shape(table)
+    table = np.asarray(table)
+
+    # ==================================================
+    # 4x4 neighbourhood of each cell (edge nodes repeated)
+    # ==================================================
+    ia = np.clip(np.arange(nx - 1)[:, None] + np.arange(-1, 3), 0, nx - 1)
+    ib = np.clip(np.arange(ny - 1)[:, None] + np.arange(-1, 3), 0, ny - 1)
+    nodes = table[ia[:, None, :, None], ib[None, :, None, :]]
+
+    return np.einsum('ap,ijab,bq->ijpq', CUBIC, nodes, CUBIC)
+
+def evalCoefficients(coeffs, x, y, x0, dx, y0, dy):
+    """
+    Evaluates precomputed bicubic coefficients of several tables
+    sharing the same grid.
+
+    Parameters:
+        coeffs      coefficients, shape (nx-1, ny-1, ntables, 4, 4)
+        x, y        coordinates to evaluate at {1D arrays}
+        x0, dx      first value and spacing of the x-grid
+        y0, dy      first value and spacing of the y-grid
+
+    Returns:
+        values      interpolated values, shape (ntables, len(x))
+    """
+    nx, ny, ntables = np.shape(coeffs)[:3]
+
+    fx = (x - x0) / dx
+    fy = (y - y0) / dy
+
+    with np.errstate(invalid='ignore'):
+        ix = np.clip(np.floor(fx).astype(int), 0, nx - 1)
+        iy = np.clip(np.floor(fy).astype(int), 0, ny - 1)
+
+    t = fx - ix
+    u = fy - iy
+
+    # ==================================================
+    # Monomials t^p u^q of each coordinate, shape (n, 16)
+    # ==================================================
+    tp = np.stack((np.ones_like(t), t, t*t, t*t*t), axis=-1)
+    uq = np.stack((np.ones_like(u), u, u*u, u*u*u), axis=-1)
+    basis = (tp[:, :, None] * uq[:, None, :]).reshape(-1, 16, 1)
+
+    # ==================================================
+    # Gather the coefficients of each cell (one contiguous
+    # row per cell) and contract with the monomials
+    # ==================================================
+    coeffs = np.reshape(coeffs, (nx * ny, ntables, 16))
+    values = np.matmul(np.take(coeffs, ix * ny + iy, axis=0), basis)[..., 0]
+
+    return values.T
+
+
+class EmissivityTable:
+    """
+    Emissivities of a set of lines tabulated on a log-spaced (T, n_e)
+    grid, evaluated with vectorized bilinear or bicubic interpolation
+    in log-space. The bicubic coefficients of every grid cell are
+    precomputed so evaluation is a single gather and a polynomial.
+    """
+
+    def __init__(self, atom, wave, wave_param, temRange=(5e2, 3e4),
+                 denRange=(1e0, 1e8), nTem=200, nDen=161, order=3, cache=True):
+        """
+        Parameters:
+            atom            PyNeb Atom or RecAtom
+            wave            wavelengths or labels of the lines {tuple}
+            wave_param      indicator of wave values {"wave", "label"}
+            temRange        (min, max) temperature of the grid
+            denRange        (min, max) electron density of the grid
+            nTem            number of temperature grid points
+            nDen            number of density grid points
+            order           interpolation order (1 or 3)
+            cache           load/save the table from/to the on-disk cache
+        """
+        # ==================================================
+        # Recombination data are only defined over a limited
+        # range; PyNeb clamps the density and does not
+        # extrapolate the temperature, so limit the grid.
+        # ==================================================
+        self.clampDen = False
+        if atom.type == 'rec' and hasattr(atom, 'temp'):
+            temRange = (max(temRange[0], np.min(atom.temp)),
+                        min(temRange[1], np.max(atom.temp)))
+            denRange = (max(denRange[0], 10**np.min(atom.log_dens)),
+                        min(denRange[1], 10**np.max(atom.log_dens)))
+            self.clampDen = True
+
+        self.atom = atom
+        self.wave = tuple(wave)
+        self.wave_param = wave_param
+        self.order = order
+        self.cache = cache
+        self.temRange = temRange
+        self.denRange = denRange
+
+        # ==================================================
+        # Parameters identifying the table (used to key the
+        # memoized emissivities, see ion.getEmissivity)
+        # ==================================================
+        self.key = (atom.atom, getAtomicDataSet(atom), self.wave, wave_param,
+            tuple(map(float, temRange)), tuple(map(float, denRange)), nTem, nDen, order)
+
+        # ==================================================
+        # Log-spaced grid in temperature and density
+        # ==================================================
+        self.logTem = np.linspace(*np.log10(temRange), nTem)
+        self.logDen = np.linspace(*np.log10(denRange), nDen)
+
+        # ==================================================
+        # Tabulate log10 of the emissivities (or load them
+        # from the cache)
+        # ==================================================
+        self.table = self.tabulate()
+
+        if order == 3:
+            self.coeffs = np.stack([bicubicCoefficients(t) for t in self.table], axis=2)
+
+    def tabulate(self):
+        """
+        Computes log10 of the emissivity of each line over the grid;
+        returns a list of (nTem, nDen) arrays, one per line.
+
+        Postcondition:
+            When caching is enabled, each line is loaded (memory-mapped)
+            from the on-disk cache if present. The missing lines are
+            computed together and saved to the cache.
+        """
+        # ==================================================
+        # Try the on-disk cache first
+        # ==================================================
+        table, paths, keys = [], [], []
+        for wl in self.wave:
+            key = {
+                self.wave_param: wl,
+                "logTem": (float(self.logTem[0]), float(self.logTem[-1]), len(self.logTem)),
+                "logDen": (float(self.logDen[0]), float(self.logDen[-1]), len(self.logDen))
+            }
+            path = getCachePath("emiss", self.atom, key) if self.cache else None
+            cached = loadCache(path)
+
+            table.append(None if isinstance(cached, type(None)) else cached["table"])
+            paths.append(path)
+            keys.append(key)
+
+        # ==================================================
+        # Compute the missing lines over the grid at once
+        # and store them
+        # ==================================================
+        missing = [i for i, t in enumerate(table) if isinstance(t, type(None))]
+        if missing:
+            tems, dens = np.meshgrid(10**self.logTem, 10**self.logDen, indexing='ij')
+            values = np.log10(getLineEmissivity(
+                atom=self.atom,
+                wave=[self.wave[i] for i in missing],
+                wave_param=self.wave_param,
+                tem=tems,
+                den=dens,
+                solver="native"
+            ))
+            for i, value in zip(missing, values):
+                saveCache(paths[i], {"table": value}, key=keys[i])
+                table[i] = value
+
+        return table
+
+    def getEmissivity(self, tem, den):
+        """
+        Returns the emissivity of each line for the paired (after
+        broadcasting) temperatures and densities as an array of
+        shape (len(wave), *shape).
+
+        Parameters:
+            tem         temperature(s)
+            den         electron densit(y/ies)
+
+        Postcondition:
+            Values outside of the tabulated grid, or those for which
+            the interpolation is not finite, are computed directly
+            with the atom.
+        """
+        tem, den = np.broadcast_arrays(
+            np.asarray(tem, dtype='float'),
+            np.asarray(den, dtype='float')
+        )
+        shape = tem.shape
+        tem = tem.ravel()
+        den = den.ravel()
+
+        # ==================================================
+        # Clamp the densities as PyNeb does for recombination data
+        # ==================================================
+        if self.clampDen:
+            den = np.clip(den, *self.denRange)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = np.log10(tem)
+            y = np.log10(den)
+
+        # ==================================================
+        # Interpolate the table
+        # ==================================================
+        grid = {
+            "x0": self.logTem[0], "dx": self.logTem[1] - self.logTem[0],
+            "y0": self.logDen[0], "dy": self.logDen[1] - self.logDen[0]
+        }
+        if self.order == 3:
+            emiss = 10**evalCoefficients(coeffs=self.coeffs, x=x, y=y, **grid)
+        else:
+            emiss = 10**interp2D(table=self.table, x=x, y=y, order=self.order, **grid)
+
+        # ==================================================
+        # Fall back on the atom outside of the grid
+        # ==================================================
+        eps = 1e-9
+        out = (x < self.logTem[0] - eps) | (x > self.logTem[-1] + eps) \
+            | (y < self.logDen[0] - eps) | (y > self.logDen[-1] + eps) \
+            | ~np.isfinite(emiss).all(axis=0)
+
+        if out.any():
+            emiss[:, out] = getLineEmissivity(
+                atom=self.atom,
+                wave=self.wave,
+                wave_param=self.wave_param,
+                tem=tem[out],
+                den=den[out],
+                solver="native"
+            )
+
+        return emiss.reshape(len(self.wave), *shape)
+
+
+# ===================================================
+# Emissivity tables shared by all the ion instances
+# of a process, keyed by atom, lines and grid.
+# ===================================================
+table_dict = {}
+
+def getTable(atom, wave, wave_param, **kwargs):
+    """
+    Returns the EmissivityTable for the lines <wave> of <atom>,
+    building it only if it is not already in <table_dict>.
+
+    Parameters:
+        atom            PyNeb Atom or RecAtom
+        wave            wavelengths or labels of the lines {tuple}
+        wave_param      indicator of wave values {"wave", "label"}
+        kwargs          grid parameters passed to EmissivityTable
+    """
+    key = (atom.atom, getAtomicDataSet(atom), tuple(wave), wave_param,
+           tuple(sorted(kwargs.items())))
+
+    if key not in table_dict:
+        table_dict[key] = EmissivityTable(atom=atom, wave=wave,
+            wave_param=wave_param, **kwargs)
+
+    return table_dict[key]
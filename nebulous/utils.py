@@ -1,9 +1,131 @@
-from scipy.ndimage import gaussian_filter
+from .psf import convolve
 import numpy as np
 
+__all__ = [
+    'convl2D',
+    'broadcastLOS',
+    'getSkyValues',
+    'setGridCacheSize',
+    'clearGridCache',
+    'getOpenCoordinates',
+    'getCoordinates',
+    'getDepthTrue',
+    'getDepth',
+    'getRadialDistance',
+    'makeCube',
+    'setDtype',
+    'getDtype',
+    'parseCubeDimensions',
+]
 
-def convl2D(image, kernel=1.0, mode='constant'):
-    return gaussian_filter(image, sigma=kernel, mode=mode)
+
+def convl2D(image, kernel=1.0, mode='constant', method='auto'):
+    """
+    Convolves a map, or a stack of maps (..., nx, ny), with a gaussian
+    kernel (standard deviation in pixels) or a PSF (see psf.convolve).
+    With <method> "auto", gaussian kernels of radius (4 sigma) below
+    psf.fftRadius (24 pixels, from a benchmark against the FFT) use the
+    separable gaussian_filter; wider ones, PSFs and kernel lists use
+    FFTs. "fft" or "direct" select the method explicitly. A list of
+    kernels returns one map per kernel, with shape (..., nk, nx, ny).
+    """
+    return convolve(image, kernel=kernel, mode=mode, method=method)
+
+def broadcastLOS(los, shape):
+    """
+    Broadcasts lines of sight to the shape of a sky map, which may
+    carry leading axes (e.g. one map per kernel, see convl2D).
+
+    Parameters:
+        los         boolean sky map or index tuple (as from np.where)
+        shape       shape of the sky map (..., nx, ny)
+
+    Returns:
+        los         boolean map or index tuple selecting the lines of
+                    sight in every leading plane of the sky map
+    """
+    if isinstance(los, tuple) and len(los) < len(shape):
+        mask = np.zeros(shape[-len(los):], dtype=bool)
+        mask[los] = True
+        los = mask
+
+    if isinstance(los, np.ndarray) and los.ndim < len(shape):
+        los = np.broadcast_to(los, shape)
+
+    return los
+
+def getSkyValues(x, los, shape):
+    """
+    Returns the values of <x> (a constant or a sky map broadcastable
+    to <shape>) on the lines of sight <los> (see broadcastLOS).
+    """
+    if not isinstance(x, np.ndarray):
+        return x
+    return np.broadcast_to(x, shape)[los]
+
+# ==================================================
+# Coordinate grids and radial distances, cached per
+# cube dimension (at most <gridCacheSize> of each)
+# ==================================================
+gridCacheSize = 2
+coordinate_dict = {}
+radius_dict = {}
+
+def cacheGrid(cache, key, value):
+    """
+    Stores a (read-only) grid in one of the grid caches, evicting the
+    oldest entries beyond <gridCacheSize>.
+    """
+    for v in (value if isinstance(value, tuple) else (value,)):
+        v.flags.writeable = False
+
+    cache[key] = value
+    while len(cache) > gridCacheSize:
+        cache.pop(next(iter(cache)))
+
+    return value
+
+def setGridCacheSize(size):
+    """
+    Sets the number of coordinate grids and radial distance cubes kept
+    in the grid caches (0 disables the caching).
+
+    Parameters:
+        size        Number of cube dimensions to cache
+
+    Postcondition:
+        A radial distance cube takes 8 bytes per cell (1 GB at 512^3),
+        so large cubes may warrant a size of 1 or 0. Entries beyond the
+        new size are evicted.
+    """
+    global gridCacheSize
+    gridCacheSize = max(0, int(size))
+
+    for cache in (coordinate_dict, radius_dict):
+        while len(cache) > gridCacheSize:
+            cache.pop(next(iter(cache)))
+
+def clearGridCache():
+    """
+    Empties the coordinate grid and radial distance caches.
+    """
+    coordinate_dict.clear()
+    radius_dict.clear()
+
+def getOpenCoordinates(dim):
+    """
+    Returns the coordinates of the cells, with the center of the cube
+    as the origin, as open grids of shapes (nx,1,1), (1,ny,1) and
+    (1,1,nz) that broadcast against each other (see np.ogrid).
+    """
+    dim = parseCubeDimensions(dim)
+
+    if dim not in coordinate_dict:
+        x, y, z = (np.arange(n, dtype='float') - 0.5 * (n - 1) for n in dim)
+        return cacheGrid(coordinate_dict, dim,
+            (x[:, None, None], y[None, :, None], z[None, None, :]))
+
+    return coordinate_dict[dim]
 
 def getCoordinates(dim):
     """
@@ -17,30 +139,16 @@ def getCoordinates(dim):
         x   x-coordinate
         y   y-coordinate
         z   z-coordinate (depth)
-    """
 
-    # ==================================================
-    # Make sure <dim> has the proper size
-    # ==================================================
-    dim = parseCubeDimensions(dim)
-
-    # ==================================================
-    # Center the coordinates at the center of the sphere
-    # ==================================================
-    x = np.arange(dim[0], dtype='float')
-    y = np.arange(dim[1], dtype='float')
-    z = np.arange(dim[2], dtype='float')
-
-    x -= np.mean(x)
-    y -= np.mean(y)
-    z -= np.mean(z)
-
-    y, x, z = np.meshgrid(y, x, z)
-
-    # ==================================================
-    # Return the coordinates
-    # ==================================================
-    return(x, y, z)
+    Postcondition:
+        The coordinates are read-only views of the open grids of
+        getOpenCoordinates broadcast to the cube dimensions, so
+        that no cube is allocated. Unlike the meshgrid arrays
+        returned previously, they cannot be modified in place
+        (doing so raises a ValueError); use np.array(x) for a
+        writable copy.
+    """
+    return tuple(np.broadcast_arrays(*getOpenCoordinates(dim)))
 
 def getDepthTrue(cube):
     """
@@ -64,6 +172,9 @@ def getDepth(dim, loc):
 
     To call:
         getDepth(dim, loc)
+
+    The depth of a SparseCube (e.g. a geom.NebulaGeometry) is
+    given by its getDepth method, without making a cube.
     """
     # ==================================================
     # Make a cube with the provided dimensions
@@ -80,32 +191,76 @@ def getDepth(dim, loc):
     # ==================================================
     return getDepthTrue(cube)
 
-def getRadialDistance(dim):
+def getRadialDistance(dim, chunk=2**22):
     """
     Given the dimensions of the cube, computes the distance
     of each cell from the center of the cube.
+
+    Parameters:
+        dim         cube dimensions
+        chunk       approximate number of cells computed at once
+
+    Returns:
+        dist        read-only cube of the radial distances
+
+    Postcondition:
+        The squared distances are accumulated in place from the open
+        coordinate grids, a slab of the first axis at a time, so that
+        the only cube allocated is the result. The result is cached
+        per <dim>.
     """
-    # ==================================================
-    # Get the cell coordinates
-    # ==================================================
-    x, y, z = getCoordinates(dim)
+    dim = parseCubeDimensions(dim)
 
-    # ==================================================
-    # Compute the radial distance
-    # ==================================================
-    dist = np.sqrt(x**2 + y**2 + z**2)
+    if dim not in radius_dict:
+        x, y, z = getOpenCoordinates(dim)
+        yz = y**2 + z**2
 
-    # ==================================================
-    # Return the radial distances
-    # ==================================================
-    return(dist)
+        dist = np.empty(dim)
+        step = max(1, chunk // yz.size)
+        for start in range(0, dim[0], step):
+            slab = dist[start:start + step]
+            np.add(x[start:start + step]**2, yz, out=slab)
+            np.sqrt(slab, out=slab)
+
+        return cacheGrid(radius_dict, dim, dist)
 
+    return radius_dict[dim]
 
-def makeCube(dim):
+def makeCube(dim, dtype=None):
     dim = parseCubeDimensions(dim)
-    cube = np.zeros(dim)
+    cube = np.zeros(dim, dtype=getDtype(dtype))
     return(cube)
 
+# ==================================================
+# Floating point type used to store the cubes
+# ==================================================
+dtype = np.float64
+
+def setDtype(value):
+    """
+    Sets the default floating point type of the cubes (density,
+    temperature and emissivity). Sums along the line of sight are
+    always accumulated in float64.
+
+    Parameters:
+        value       np.float32 or np.float64
+
+    Postcondition:
+        Using np.float32 halves the memory and bandwidth of the cubes.
+        On a 60^3 lognormal shell (sigma=0.8) the float32 sky maps,
+        H-beta and emission measures differ from the float64 ones by
+        < 1e-6 (relative); the [O III] temperatures and [S II] densities
+        derived from them are unchanged.
+    """
+    global dtype
+    dtype = np.dtype(value).type
+
+def getDtype(value=None):
+    """
+    Returns <value> if set, else the default floating point type.
+    """
+    return dtype if isinstance(value, type(None)) else value
+
 
 def parseCubeDimensions(dim):
     """
@@ -17,19 +17,19 @@ import sys, os; sys.path.append(os.path.join('..', '..'))
 import numpy  as np
 import pandas as pd
 
-from nebulous.geom  import sphere
+from nebulous.geom  import getGeometry
 from nebulous.cel   import cel_den_dict, cel_tem_dict
 from nebulous.orl   import orl_dict
 from nebulous.misc  import den_dict, fix_params, mkdir
 from nebulous.pdf   import pdfs
-from nebulous.utils import getDepth
 
 # ==================================================
 # Set the nebula parameters
 # ==================================================
 dim   = (30,)
-loc   = sphere(dim=dim, inRad=0.3, outRad=0.9)
-los   = getDepth(loc=loc, dim=dim) > 5
+geometry = getGeometry(dim=dim, inRad=0.3, outRad=0.9, depthMin=5)
+loc   = geometry.loc
+los   = geometry.los
 convl = True
 
 # ==================================================
@@ -16,21 +16,21 @@ import numpy  as np
 import pandas as pd
 
 from nebulous.em    import getEM, getSkyDenEM
-from nebulous.geom  import sphere
+from nebulous.geom  import getGeometry
 from nebulous.cel   import cel_den_dict, cel_tem_dict
 from nebulous.orl   import orl_dict
 from nebulous.misc  import den_dict, fix_params, mkdir
 from nebulous.pdf   import pdfs
-from nebulous.utils import getDepth
 
 
 # ==================================================
 # set the nebula parameters
 # ==================================================
 dim   = (30,30,30)
-loc   = sphere(dim=dim, inRad=0.3, outRad=0.9)
-depth = getDepth(loc=loc, dim=dim)
-los   = depth > 5
+geometry = getGeometry(dim=dim, inRad=0.3, outRad=0.9, depthMin=5)
+loc   = geometry.loc
+depth = geometry.depth
+los   = geometry.los
 convl = True
 
 # ==================================================
@@ -20,20 +20,20 @@ import sys, os; sys.path.append(os.path.join('..', '..'))
 import numpy  as np
 import pandas as pd
 
-from nebulous.geom  import sphere
+from nebulous.geom  import getGeometry
 from nebulous.cel   import cel_den_dict, cel_tem_dict
 from nebulous.orl   import orl_dict
 from nebulous.pdf   import pdfs
-from nebulous.utils import getDepth
 from nebulous.misc  import fix_params, mkdir
 
 # ==================================================
 # set the nebula parameters
 # ==================================================
 dim = (30,30,30)
-loc   = sphere(dim=dim, inRad=0.3, outRad=0.9)
-depth = getDepth(loc=loc, dim=dim)
-los   = depth > 5
+geometry = getGeometry(dim=dim, inRad=0.3, outRad=0.9, depthMin=5)
+loc   = geometry.loc
+depth = geometry.depth
+los   = geometry.los
 
 # ==================================================
 # Function that runs the simulation
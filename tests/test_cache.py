@@ -0,0 +1,66 @@
+import os, sys; sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import numpy as np
+import pyneb as pn
+import pytest
+
+from nebulous import cache
+from nebulous.cache import getCachePath, loadCache, saveCache, setCacheDir
+from nebulous.table import EmissivityTable
+
+
+@pytest.fixture
+def cacheDir(tmp_path):
+    previous = cache.cacheDir
+    setCacheDir(str(tmp_path))
+    yield tmp_path
+    setCacheDir(previous)
+
+def test_cache_round_trip(cacheDir):
+    key = {"shape": "sphere", "dim": (8, 8, 8)}
+    arrays = {"index": np.arange(10), "radius": np.linspace(0., 1., 10).reshape(2, 5)}
+
+    path = getCachePath("geometry", None, key)
+    assert os.path.dirname(path) == str(cacheDir)
+    assert loadCache(path) is None
+
+    saveCache(path, arrays, key=key)
+    assert os.listdir(cacheDir) == [os.path.basename(path)]
+
+    for mmap in (True, False):
+        loaded = loadCache(path, mmap=mmap)
+        assert sorted(loaded) == sorted(arrays)
+        for name, value in arrays.items():
+            assert isinstance(loaded[name], np.memmap) == mmap
+            assert np.array_equal(loaded[name], value)
+
+def test_cache_key_invalidation(cacheDir):
+    key = {"wave": 5007, "logTem": (3., 4., 11)}
+    path = getCachePath("emiss", pn.Atom('O', 3), key)
+    saveCache(path, {"table": np.ones(3)}, key=key)
+
+    assert getCachePath("emiss", pn.Atom('O', 3), dict(key)) == path
+    assert loadCache(getCachePath("emiss", pn.Atom('O', 3), dict(key, wave=4959))) is None
+    assert loadCache(getCachePath("emiss", pn.Atom('O', 3), dict(key, logTem=(3., 4., 12)))) is None
+    assert loadCache(getCachePath("emiss", pn.Atom('S', 2), key)) is None
+
+def test_cache_disabled():
+    previous = cache.cacheDir
+    setCacheDir(None)
+    try:
+        assert getCachePath("emiss", pn.Atom('O', 3), {"wave": 5007}) is None
+        assert loadCache(None) is None
+        saveCache(None, {"table": np.ones(3)})
+    finally:
+        setCacheDir(previous)
+
+def test_cached_table_is_memory_mapped(cacheDir):
+    atom = pn.Atom('S', 2)
+    kwargs = {"wave": (6716, 6731), "wave_param": "wave", "nTem": 20, "nDen": 15}
+
+    built = EmissivityTable(atom, **kwargs)
+    loaded = EmissivityTable(atom, **kwargs)
+
+    assert len(os.listdir(cacheDir)) == 2
+    for a, b in zip(built.table, loaded.table):
+        assert isinstance(b, np.memmap)
+        assert np.array_equal(a, b)
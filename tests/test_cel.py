@@ -0,0 +1,44 @@
+import os, sys; sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import numpy as np
+
+from nebulous import cache
+from nebulous.cache import setCacheDir
+from nebulous.cel import SII_den, getFuncKey
+
+
+def makeRatio(scale):
+    return lambda a, b: scale * a / b
+
+def test_func_key_distinguishes_ratios():
+    assert getFuncKey(lambda a, b: a / b) == getFuncKey(lambda a, b: a / b)
+    assert getFuncKey(lambda a, b: np.sum(a) / b) != getFuncKey(lambda a, b: np.max(a) / b)
+    assert getFuncKey(makeRatio(2.)) == getFuncKey(makeRatio(2.))
+    assert getFuncKey(makeRatio(2.)) != getFuncKey(makeRatio(3.))
+    assert getFuncKey(makeRatio(np.ones(2))) != getFuncKey(makeRatio(np.zeros(2)))
+
+def test_inverse_table_keyed_on_closure():
+    cel = SII_den()
+    ratio2, value2 = cel.getInverseTable(makeRatio(2.), tem=1e4, nGrid=200)
+    ratio3, value3 = cel.getInverseTable(makeRatio(3.), tem=1e4, nGrid=200)
+
+    assert len(cel.inverse) == 2
+    assert np.allclose(ratio3 - ratio2, np.log10(1.5))
+    assert np.array_equal(value2, value3)
+
+def test_inverse_surface_keyed_on_closure(tmp_path):
+    previous = cache.cacheDir
+    setCacheDir(str(tmp_path))
+    try:
+        kwargs = {"kind": "den", "nGrid": 100, "nCompanion": 11}
+        surface2 = SII_den().getInverseSurface(makeRatio(2.), **kwargs)
+        surface3 = SII_den().getInverseSurface(makeRatio(3.), **kwargs)
+        assert len(os.listdir(tmp_path)) == 2
+
+        # A new instance reloads its own surface from disk
+        reloaded = SII_den().getInverseSurface(makeRatio(3.), **kwargs)
+        assert len(os.listdir(tmp_path)) == 2
+    finally:
+        setCacheDir(previous)
+
+    assert np.allclose(surface3["lo"] - surface2["lo"], np.log10(1.5))
+    assert np.array_equal(reloaded["lo"], surface3["lo"])
@@ -0,0 +1,87 @@
+import os, sys; sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import numpy as np
+import pytest
+
+from nebulous.geom import (BipolarLobes, Cylinder, Ellipsoid, EllipsoidalShell,
+    NebulaGeometry, Shape, Torus, sphere)
+from nebulous.utils import getCoordinates, getDepth, getRadialDistance
+
+
+def getDenseCells(shape, dim, axis=0):
+    """
+    Evaluates the distance of <shape> on the whole cube.
+    """
+    x, y, z = getCoordinates(dim)
+    return np.nonzero(shape.distance(x, y, z, 0.5 * dim[axis]) <= 0)
+
+def assertSameCells(a, b):
+    assert len(a) == len(b) == 3
+    assert all(np.array_equal(u, v) for u, v in zip(a, b))
+
+def test_shape_is_abstract():
+    with pytest.raises(TypeError):
+        Shape()
+
+    class Incomplete(Shape):
+        def distance(self, x, y, z, scale):
+            return x
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+@pytest.mark.parametrize('dim, inRad, outRad, axis', [
+    (32, 0.3, 0.9, 0),
+    ((31, 36, 28), 0.3, 0.9, 0),
+    ((31, 36, 28), 0.2, 0.7, 2),
+    (25, 0., 1., 0),
+])
+def test_shell_matches_sphere(dim, inRad, outRad, axis):
+    assertSameCells(EllipsoidalShell(inRad, outRad).getCells(dim, axis=axis),
+                    sphere(dim, inRad, outRad, axis=axis))
+
+def test_shapes_match_dense_evaluation():
+    dim = (30, 34, 26)
+    shapes = [
+        Ellipsoid((0.8, 0.5, 0.3), center=(0.1, -0.2, 0.)),
+        Cylinder(0.3, 0.7, symmetryAxis=1),
+        Torus(0.6, 0.2, symmetryAxis=2),
+        BipolarLobes(0.45, 0.3, thickness=0.1),
+        EllipsoidalShell(0.3, 0.9) & Cylinder(0.5, 1.0, symmetryAxis=0),
+        Ellipsoid(0.4, center=(-0.5, 0., 0.)) | Ellipsoid(0.4, center=(0.5, 0., 0.)),
+        Ellipsoid(0.9) - Torus(0.5, 0.2),
+    ]
+    for shape in shapes:
+        assertSameCells(shape.getCells(dim), getDenseCells(shape, dim))
+
+def test_empty_shapes():
+    dim = 20
+    disjoint = Ellipsoid(0.3, center=(-0.5, 0., 0.)) & Ellipsoid(0.3, center=(0.5, 0., 0.))
+    outside = Ellipsoid(0.2, center=(3., 0., 0.))
+
+    for shape in (disjoint, outside):
+        cells = shape.getCells(dim)
+        assert all(len(c) == 0 for c in cells)
+        assert len(shape.getCells(dim, sparse=True)) == 0
+
+def test_chunk_boundaries():
+    """
+    The slabs of the first axis do not change the cells, whatever the
+    chunk size (one row per slab, slabs not dividing the box, one slab).
+    """
+    dim = (33, 30, 28)
+    shape = EllipsoidalShell(0.3, 0.9) | Torus(0.6, 0.2, symmetryAxis=1)
+    reference = shape.getIndex(dim, scale=0.5 * dim[0])
+
+    for chunk in (1, 30 * 28, 7 * 30 * 28 + 5, 2**30):
+        assert np.array_equal(shape.getIndex(dim, scale=0.5 * dim[0], chunk=chunk), reference)
+
+def test_nebula_geometry_matches_sphere():
+    dim = (14, 12, 10)
+    loc = sphere(dim, inRad=0.3, outRad=0.9)
+    geometry = NebulaGeometry(dim, inRad=0.3, outRad=0.9, depthMin=3, cache=False)
+
+    assertSameCells(geometry.loc, loc)
+    assert np.array_equal(geometry.depth, getDepth(dim, loc))
+    assert np.array_equal(geometry.los, getDepth(dim, loc) > 3)
+    assert np.allclose(geometry.radius, getRadialDistance(dim)[loc], rtol=1e-12)
+    assert np.array_equal(geometry.mask, geometry.toCube(np.ones(len(geometry))) > 0)
@@ -0,0 +1,71 @@
+import os, sys; sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import numpy as np
+import pytest
+
+from nebulous.cel import OIII_tem, SII_den
+from nebulous.geom import partition, sphere
+from nebulous.orl import HI
+from nebulous.pdf import lognormal
+from nebulous.sparse import SparseCube
+
+
+dim = (14, 12, 10)
+
+def getNebula(seed=0):
+    """
+    Returns the cells of a shell and the dense T, n_e and n_i cubes.
+    """
+    loc = sphere(dim, inRad=0.3, outRad=0.9)
+    den = lognormal(dim, loc, mean=1e3, sigma=0.8, seed=seed, dtype=np.float64)
+    tem = np.where(den > 0, 10**np.random.default_rng(seed).uniform(3.8, 4.2, dim), 0.)
+    n_i = 1e-4 * den
+    return loc, tem, den, n_i
+
+@pytest.mark.parametrize('Ion', [OIII_tem, SII_den, HI])
+@pytest.mark.parametrize('convl, kernel', [(False, 1), (True, 1), (True, (1.5, 0.5))])
+def test_projection_matches_full_cube(Ion, convl, kernel):
+    """
+    The sky maps streamed in chunks of cells equal the sky maps
+    summed from the full emissivity cube.
+    """
+    loc, tem, den, n_i = getNebula()
+    kwargs = {} if Ion is HI else {"n_i": n_i}
+
+    full = Ion()
+    full.getEmissivity(tem=tem, n_e=den, loc=loc, **kwargs)
+    full.getSkyEmiss(convl=convl, kernel=kernel)
+
+    streamed = Ion()
+    streamed.getEmissivity(tem=tem, n_e=den, loc=loc, project=True, chunk=97, **kwargs)
+    assert streamed.emiss is None
+    streamed.getSkyEmiss(convl=convl, kernel=kernel)
+
+    assert streamed.skyEmiss.shape == full.skyEmiss.shape
+    assert np.allclose(streamed.skyEmiss, full.skyEmiss, rtol=1e-10, atol=0)
+
+def test_projection_of_unsorted_cells():
+    """
+    The cells of a partition, in any order, project like the cube of
+    the partition, whether given as a <loc> tuple or as a SparseCube.
+    """
+    loc, tem, den, n_i = getNebula(seed=1)
+    loc = partition(loc, pvals=[0.6, 0.4], seed=2)[1]
+    order = np.random.default_rng(3).permutation(len(loc[0]))
+    loc = tuple(l[order] for l in loc)
+
+    full = SII_den()
+    full.getEmissivity(tem=tem, n_e=den, n_i=n_i, loc=loc)
+    full.getSkyEmiss(convl=False)
+
+    streamed = SII_den()
+    streamed.getEmissivity(tem=tem, n_e=den, n_i=n_i, loc=loc, project=True, keep=True, chunk=50)
+    streamed.getSkyEmiss(convl=False)
+
+    sparse = SII_den()
+    sparse.getEmissivity(tem=tem[loc], n_e=den[loc], n_i=n_i[loc],
+        loc=SparseCube.fromLoc(dim, loc), chunk=50)
+    sparse.getSkyEmiss(convl=False)
+
+    assert np.allclose(streamed.emiss, full.emiss, rtol=1e-12, atol=0, equal_nan=True)
+    assert np.allclose(streamed.skyEmiss, full.skyEmiss, rtol=1e-10, atol=0)
+    assert np.allclose(sparse.skyEmiss, full.skyEmiss, rtol=1e-10, atol=0)
@@ -0,0 +1,51 @@
+import os, sys; sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import numpy as np
+import pyneb as pn
+import pytest
+
+from nebulous.level import getLineEmissivity, getPopulations
+
+ions = [('O', 3, (4363, 5007)), ('S', 2, (6716, 6731)), ('N', 2, (5755, 6584)), ('Ar', 4, (4711, 4740))]
+
+def getGrid():
+    tem, den = np.meshgrid(np.geomspace(5e3, 2e4, 7), np.geomspace(1e1, 1e5, 9))
+    return tem.ravel(), den.ravel()
+
+@pytest.mark.parametrize('elem, spec, wave', ions)
+def test_native_populations_match_pyneb(elem, spec, wave):
+    atom = pn.Atom(elem, spec)
+    tem, den = getGrid()
+
+    pops = getPopulations(atom, tem, den)
+    ref = np.reshape(atom.getPopulations(tem=tem, den=den, product=False), (-1, tem.size))
+
+    assert pops.shape == ref.shape
+    assert np.allclose(pops, ref, rtol=1e-10, atol=1e-300)
+    assert np.allclose(pops.sum(axis=0), 1.)
+
+@pytest.mark.parametrize('elem, spec, wave', ions)
+def test_native_emissivities_match_pyneb(elem, spec, wave):
+    atom = pn.Atom(elem, spec)
+    tem, den = getGrid()
+
+    emiss = getLineEmissivity(atom, wave, 'wave', tem.reshape(9, 7), den.reshape(9, 7), solver="native")
+    assert emiss.shape == (len(wave), 9, 7)
+
+    for i, wl in enumerate(wave):
+        ref = atom.getEmissivity(tem=tem, den=den, wave=wl, product=False)
+        assert np.allclose(emiss[i].ravel(), ref, rtol=1e-10)
+
+def test_native_populations_chunked():
+    """
+    Splitting the cells into many chunks (including a short last one)
+    must not change the solution.
+    """
+    atom = pn.Atom('O', 3)
+    tem, den = getGrid()
+
+    whole = getPopulations(atom, tem, den)
+    chunkBytes = 8 * atom.NLevels**2 * 10
+    chunked = getPopulations(atom, tem, den, maxMemory=chunkBytes)
+
+    assert tem.size % 10 != 0
+    assert np.allclose(chunked, whole, rtol=1e-13, atol=0)
@@ -0,0 +1,89 @@
+import os, sys; sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import numpy as np
+import pytest
+
+from nebulous.cache import LRUCache, disableMemo, enableMemo
+from nebulous.cel import SII_den
+
+
+@pytest.fixture
+def memo():
+    memo = enableMemo()
+    yield memo
+    disableMemo()
+
+def getCube(seed=0, shape=(6, 6, 6)):
+    rng = np.random.default_rng(seed)
+    return 10**rng.uniform(3.8, 4.2, shape), 10**rng.uniform(1, 4, shape)
+
+def test_lru_eviction():
+    lru = LRUCache(maxBytes=3 * 800)
+    for i in range(4):
+        lru.put(i, np.full(100, float(i)))
+
+    assert list(lru.data) == [1, 2, 3] and lru.nbytes == 3 * 800
+    assert lru.get(0) is None
+
+    # Using 1 makes 2 the least recently used entry
+    assert np.array_equal(lru.get(1), np.full(100, 1.))
+    lru.put(4, np.zeros(100))
+    assert list(lru.data) == [3, 1, 4]
+    assert (lru.hits, lru.misses) == (1, 1)
+
+    # Values larger than the cache are not stored
+    lru.put(5, np.zeros(1000))
+    assert 5 not in lru.data
+
+def test_lru_returns_private_copies():
+    lru = LRUCache()
+    value = np.arange(5.)
+    lru.put("a", (value, 2))
+    value[0] = -1.
+
+    first, second = lru.get("a"), lru.get("a")
+    assert first[0][0] == 0. and first[1] == 2
+    first[0][1] = -1.
+    assert second[0][1] == 1.
+
+def test_memo_hits_and_misses(memo):
+    tem, den = getCube()
+    cel = SII_den()
+
+    cel.getEmissivity(tem=tem, n_e=den, backend="native")
+    assert (memo.hits, memo.misses) == (0, 1)
+    emiss = cel.emiss
+
+    other = SII_den()
+    other.getEmissivity(tem=tem.copy(), n_e=den.copy(), backend="native")
+    assert (memo.hits, memo.misses) == (1, 1)
+    assert np.array_equal(other.emiss, emiss)
+
+    # The memoized arrays are not shared between instances
+    assert other.emiss is not cel.emiss and other.emiss.flags.writeable
+    other.emiss[:] = 0.
+    assert np.array_equal(cel.emiss, emiss)
+
+    # Changing an input or an option misses
+    other.getEmissivity(tem=tem * 1.01, n_e=den, backend="native")
+    other.getEmissivity(tem=tem, n_e=den, backend="pyneb")
+    assert (memo.hits, memo.misses) == (1, 3)
+
+def test_memo_keyed_by_table(memo):
+    tem, den = getCube()
+
+    coarse = SII_den()
+    coarse.makeTable(nTem=5, nDen=5, order=1, cache=False)
+    coarse.getEmissivity(tem=tem, n_e=den, backend="table")
+
+    fine = SII_den()
+    fine.makeTable(cache=False)
+    fine.getEmissivity(tem=tem, n_e=den, backend="table")
+
+    assert (memo.hits, memo.misses) == (0, 2)
+    assert not np.allclose(coarse.emiss, fine.emiss, rtol=1e-3, atol=0)
+
+    again = SII_den()
+    again.makeTable(nTem=5, nDen=5, order=1, cache=False)
+    again.getEmissivity(tem=tem, n_e=den, backend="table")
+    assert memo.hits == 1
+    assert np.array_equal(again.emiss, coarse.emiss)
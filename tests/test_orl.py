@@ -0,0 +1,34 @@
+import os, sys; sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import numpy as np
+
+from nebulous.orl import BJ
+
+
+def test_bj_temperature_paths_agree():
+    """
+    A constant density and a map of the same density give the same
+    temperatures, and the same NaN / outOfRange for ratios outside of
+    the atomic data.
+    """
+    bj = BJ()
+    tem = np.array([[400., 3e3, 8e3], [1.2e4, 2e4, 4e4]])
+    j_H = bj.atom.getEmissivity(tem=np.clip(tem, 500, 3e4), den=1e3, label=bj.wave[0])
+    ratio = tem**(-1.5) / j_H
+    ratio[0, 0] *= 2.
+    ratio[1, 2] /= 2.
+
+    bj.skyEmiss = np.ones((1, *tem.shape))
+    bj.skyBJ = ratio
+
+    results = []
+    for skyDen in (1e3, np.full(tem.shape, 1e3)):
+        bj.getSkyTem(skyDen=skyDen, cache=False)
+        results.append((bj.skyTem.copy(), bj.outOfRange.copy()))
+
+    (tem1, out1), (tem2, out2) = results
+    expected = np.array([[True, False, False], [False, False, True]])
+    assert np.array_equal(out1, expected) and np.array_equal(out2, expected)
+    assert np.all(np.isnan(tem1[expected])) and np.all(np.isnan(tem2[expected]))
+
+    assert np.allclose(tem1[~expected], tem[~expected], rtol=1e-3)
+    assert np.allclose(tem2[~expected], tem[~expected], rtol=1e-2)
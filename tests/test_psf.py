@@ -0,0 +1,81 @@
+import os, sys; sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import numpy as np
+import pytest
+from scipy.ndimage import convolve as ndconvolve
+
+from nebulous import psf
+from nebulous.psf import PSF, GaussianPSF, ImagePSF, MoffatPSF, convolve, getKernelTransform
+
+
+def getMaps(seed=0):
+    maps = np.random.default_rng(seed).uniform(0, 1, (3, 40, 32))
+    maps[:, :5] = 0.
+    return maps
+
+def test_psf_is_abstract():
+    with pytest.raises(TypeError):
+        PSF()
+
+    class Incomplete(PSF):
+        params = ()
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+@pytest.mark.parametrize('kernel', [
+    GaussianPSF(1.5),
+    GaussianPSF(2.0, 1.0, angle=30.),
+    MoffatPSF(2.5),
+    ImagePSF(np.outer([1., 3., 4., 2.], [1., 2., 1.])),
+])
+def test_psf_normalized(kernel):
+    image = kernel.image
+    assert np.all(np.array(image.shape) % 2 == 1)
+    assert np.all(image >= 0)
+    assert np.isclose(image.sum(), 1., rtol=1e-14)
+
+def test_psf_equality():
+    assert GaussianPSF(1.5) == GaussianPSF(1.5, 1.5)
+    assert GaussianPSF(1.5) != GaussianPSF(1.5, angle=10.)
+    assert MoffatPSF(2.) != GaussianPSF(2.)
+    assert ImagePSF(np.ones((3, 3))) == ImagePSF(np.ones((3, 3)))
+
+def test_kernel_transform_is_cached():
+    shape = (40, 32)
+    kernel = MoffatPSF(2.5)
+
+    first = getKernelTransform(shape, kernel)
+    size = len(psf.kernel_dict)
+
+    assert getKernelTransform(shape, MoffatPSF(2.5))[0] is first[0]
+    assert len(psf.kernel_dict) == size
+
+    getKernelTransform(shape, MoffatPSF(3.0))
+    assert len(psf.kernel_dict) == size + 1
+
+def test_psf_convolution_matches_ndimage():
+    maps = getMaps()
+    kernel = GaussianPSF(2.0, 1.0, angle=30.)
+
+    result = convolve(maps, kernel=kernel)
+    for m, r in zip(maps, result):
+        assert np.allclose(r, ndconvolve(m, kernel.image, mode='constant'), rtol=1e-9, atol=1e-12)
+
+@pytest.mark.parametrize('mode', ['constant', 'reflect', 'mirror', 'nearest', 'wrap'])
+@pytest.mark.parametrize('kernel', [0.7, 1.5, (2.0, 0.5), 7.0])
+def test_fft_matches_direct(kernel, mode):
+    maps = getMaps()
+
+    direct = convolve(maps, kernel=kernel, mode=mode, method='direct')
+    fft = convolve(maps, kernel=kernel, mode=mode, method='fft')
+
+    assert fft.shape == direct.shape == maps.shape
+    assert np.allclose(fft, direct, rtol=1e-9, atol=1e-12)
+    assert np.all(fft >= 0)
+
+def test_auto_dispatch(monkeypatch):
+    maps = getMaps()
+    assert np.array_equal(convolve(maps, 1.5), convolve(maps, 1.5, method='direct'))
+
+    monkeypatch.setattr(psf, 'fftRadius', 0)
+    assert np.array_equal(convolve(maps, 1.5), convolve(maps, 1.5, method='fft'))
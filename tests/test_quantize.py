@@ -0,0 +1,69 @@
+import os, sys; sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import numpy as np
+import pytest
+
+from nebulous.cel import ArIV_den, NII_tem, OIII_tem, SII_den
+from nebulous.sparse import SparseCube
+
+
+def test_quantized_emissivity_nonpositive_cells():
+    """
+    Cells with non-positive or non-finite T or n_e must not break the
+    quantized path: they are evaluated exactly, as by the default path.
+    """
+    cel = SII_den()
+    tem = np.array([1e4, 0., 8e3, 1.2e4, -5., np.nan])
+    den = np.array([1e3, 1e3, 0., 5e2, 1e2, 1e3])
+    finite = np.array([True, False, False, True, False, False])
+
+    with np.errstate(all='ignore'):
+        exact = cel.computeEmissivity(wave_param='wave', tem=tem, den=den, backend='pyneb')
+        emiss, compression, error = cel.getQuantizedEmissivity(wave_param='wave',
+            tem=tem, den=den, maxError=1e-4, backend='pyneb')
+
+    assert emiss.shape == exact.shape
+    assert np.allclose(emiss[:, finite], exact[:, finite], rtol=2e-4)
+    assert np.array_equal(emiss[:, ~finite], exact[:, ~finite], equal_nan=True)
+    assert compression > 0 and np.isfinite(error)
+
+
+def getCells(n=20000, seed=0):
+    rng = np.random.default_rng(seed)
+    tem = 1e4 * rng.lognormal(0., 0.4, n)
+    den = 1e3 * rng.lognormal(0., 1.5, n)
+    return tem, den
+
+@pytest.mark.parametrize('cel', [OIII_tem(), SII_den(), NII_tem(), ArIV_den()])
+@pytest.mark.parametrize('maxError', [1e-2, 1e-3, 1e-4])
+def test_quantized_emissivity_error_bound(cel, maxError):
+    """
+    The realized error on real emissivities stays within <maxError>,
+    and within the returned bound.
+    """
+    tem, den = getCells()
+    exact = cel.computeEmissivity(wave_param='wave', tem=tem, den=den)
+    emiss, compression, error = cel.getQuantizedEmissivity(wave_param='wave',
+        tem=tem, den=den, maxError=maxError)
+
+    realized = np.max(np.abs(emiss / exact - 1))
+    assert realized <= error <= maxError
+    assert compression >= 1
+
+def test_quantized_projection_independent_of_chunks():
+    """
+    Under <project> the cells are quantized once, so the chunk size
+    does not change the bins (nor the sky map).
+    """
+    tem, den = getCells(n=6000)
+    sparse = SparseCube((20, 20, 15), np.arange(6000))
+
+    maps = []
+    for chunk in (6000, 1000, 777):
+        cel = OIII_tem()
+        cel.getEmissivity(tem=tem, n_e=den, loc=sparse, maxError=1e-3, chunk=chunk)
+        maps.append((cel.cellEmiss, cel.skyProjection, cel.emissError))
+
+    for cellEmiss, sky, error in maps[1:]:
+        assert np.array_equal(cellEmiss, maps[0][0])
+        assert np.allclose(sky, maps[0][1], rtol=1e-12)
+        assert error == maps[0][2] <= 1e-3
@@ -0,0 +1,87 @@
+import os, sys; sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import numpy as np
+
+from nebulous.cel import SII_den
+from nebulous.geom import partition, sphere
+from nebulous.pdf import lognormal, polytrope
+from nebulous.sparse import ProjectionOperator, SparseCube, countCells, fillCells
+
+
+dim = (12, 10, 8)
+
+def test_sparse_round_trip():
+    loc = sphere(dim)
+    cube = np.random.default_rng(0).uniform(1, 2, dim)
+
+    sparse = SparseCube.fromLoc(dim, loc)
+    assert len(sparse) == countCells(sparse) == countCells(loc)
+    assert all(np.array_equal(a, b) for a, b in zip(sparse.loc, loc))
+
+    values = sparse.getValues(cube)
+    assert np.array_equal(values, cube[loc])
+    assert np.array_equal(sparse.toCube(values, dtype=np.float64), fillCells(dim, loc, values, np.float64))
+
+    mask = SparseCube.fromLoc(dim, sparse.toCube(values) > 0)
+    assert np.array_equal(mask.index, sparse.index)
+
+def test_sparse_keeps_cell_order():
+    """
+    Per-cell values aligned with an unsorted <loc> (here a partition)
+    stay aligned with the cells of the SparseCube.
+    """
+    loc = partition(sphere(dim), pvals=[0.5, 0.5], seed=3)[0]
+    order = np.random.default_rng(1).permutation(len(loc[0]))
+    loc = tuple(l[order] for l in loc)
+
+    values = np.arange(len(loc[0]), dtype=float)
+    sparse = SparseCube.fromLoc(dim, loc)
+
+    assert all(np.array_equal(a, b) for a, b in zip(sparse.loc, loc))
+    assert np.array_equal(sparse.toCube(values, dtype=np.float64), fillCells(dim, loc, values, np.float64))
+
+def test_sparse_projection():
+    loc = sphere(dim)
+    sparse = SparseCube.fromLoc(dim, loc)
+
+    cube = lognormal(dim, loc, mean=1e2, sigma=0.5, dtype=np.float64)
+    values = lognormal(dim, sparse, mean=1e2, sigma=0.5, dtype=np.float64)
+
+    assert values.shape == (len(sparse),)
+    assert np.array_equal(values, cube[loc])
+    assert np.allclose(sparse.project(values), cube.sum(axis=-1), rtol=1e-12)
+    assert np.array_equal(sparse.getDepth(), (cube > 0).sum(axis=-1))
+    assert np.array_equal(sparse.project(1.), sparse.getDepth())
+
+def test_polytrope_sparse():
+    loc = sphere(dim)
+    sparse = SparseCube.fromLoc(dim, loc)
+    den = lognormal(dim, loc, mean=1e2, sigma=0.5, dtype=np.float64)
+
+    for geom in (True, False):
+        tem = polytrope(den, index=1.2, mean=1e4, geom=geom, loc=loc)
+        fromValues = polytrope(den[loc], index=1.2, mean=1e4, geom=geom, loc=sparse)
+        fromCube = polytrope(den, index=1.2, mean=1e4, geom=geom, loc=sparse)
+
+        assert np.allclose(fromValues, tem[loc], rtol=1e-12)
+        assert np.array_equal(fromCube, fromValues)
+
+def test_projection_operator_matches_dense():
+    """
+    The operator reproduces getSkyEmiss on the dense cube, with and
+    without the gaussian filter (and with one width per sky axis).
+    """
+    loc = sphere(dim)
+    sparse = SparseCube.fromLoc(dim, loc)
+    den = lognormal(dim, loc, mean=1e2, sigma=0.5, dtype=np.float64)
+    tem = np.where(den > 0, 1e4, 0.)
+
+    dense, cells = SII_den(), SII_den()
+    dense.getEmissivity(tem=tem, n_e=den, loc=loc, dtype=np.float64)
+    cells.getEmissivity(tem=tem[loc], n_e=den[loc], loc=sparse, dtype=np.float64)
+
+    for convl, kernel in ((False, 1), (True, 1), (True, 0.7), (True, (1.5, 0.5))):
+        dense.getSkyEmiss(convl=convl, kernel=kernel)
+        cells.getSkyEmiss(operator=ProjectionOperator(sparse, kernel=kernel, convl=convl, cache=False))
+
+        assert cells.skyEmiss.shape == dense.skyEmiss.shape
+        assert np.allclose(cells.skyEmiss, dense.skyEmiss, rtol=1e-10, atol=0)
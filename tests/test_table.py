@@ -0,0 +1,102 @@
+import os, sys; sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import numpy as np
+import pyneb as pn
+
+from nebulous.level import getLineEmissivity
+from nebulous.table import EmissivityTable, bicubicCoefficients, evalCoefficients, interp2D
+
+
+def getCells(n=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    return 10**rng.uniform(3.5, 4.3, n), 10**rng.uniform(0.5, 5, n)
+
+def test_interp2D_reproduces_polynomials():
+    """
+    Bilinear interpolation is exact for bilinear functions and the cubic
+    convolution for quadratics (away from the edges).
+    """
+    x0, dx, y0, dy = 1., 0.5, -2., 0.25
+    gx = x0 + dx * np.arange(12)
+    gy = y0 + dy * np.arange(10)
+    gx, gy = np.meshgrid(gx, gy, indexing='ij')
+
+    rng = np.random.default_rng(1)
+    x = rng.uniform(x0 + 2*dx, x0 + 9*dx, 100)
+    y = rng.uniform(y0 + 2*dy, y0 + 7*dy, 100)
+
+    f1 = lambda x, y: 1 + 2*x - 3*y + 0.5*x*y
+    f2 = lambda x, y: x**2 - x*y + 2*y**2
+    grid = {"x0": x0, "dx": dx, "y0": y0, "dy": dy}
+
+    assert np.allclose(interp2D(f1(gx, gy), x, y, order=1, **grid), f1(x, y))
+    assert np.allclose(interp2D(f2(gx, gy), x, y, order=3, **grid), f2(x, y))
+
+def test_bicubic_coefficients_match_interp2D():
+    rng = np.random.default_rng(2)
+    table = rng.normal(size=(8, 6))
+    x = rng.uniform(0, 7, 200)
+    y = rng.uniform(0, 5, 200)
+    grid = {"x0": 0., "dx": 1., "y0": 0., "dy": 1.}
+
+    coeffs = bicubicCoefficients(table)[:, :, None]
+    assert np.allclose(evalCoefficients(coeffs, x, y, **grid)[0],
+        interp2D(table, x, y, order=3, **grid))
+
+def test_table_matches_pyneb_cel():
+    """
+    The bicubic table agrees with PyNeb to ~1e-4 (the worst cells, at
+    the cool end of the range, reach ~1.3e-4).
+    """
+    atom = pn.Atom('O', 3)
+    wave = (4363, 5007)
+    table = EmissivityTable(atom, wave, 'wave', cache=False)
+
+    tem, den = getCells()
+    emiss = table.getEmissivity(tem, den)
+    for i, wl in enumerate(wave):
+        ref = atom.getEmissivity(tem=tem, den=den, wave=wl, product=False)
+        assert np.max(np.abs(emiss[i] / ref - 1)) < 2e-4
+
+def test_table_matches_pyneb_orl():
+    """
+    Recombination tables agree with PyNeb to ~5e-4.
+    """
+    atom = pn.RecAtom('H', 1)
+    wave = ('4_2', '3_2')
+    table = EmissivityTable(atom, wave, 'label', cache=False)
+
+    tem, den = getCells()
+    emiss = table.getEmissivity(tem, den)
+    for i, label in enumerate(wave):
+        ref = atom.getEmissivity(tem=tem, den=den, label=label, product=False)
+        assert np.max(np.abs(emiss[i] / ref - 1)) < 5e-4
+
+def test_table_scalar_and_array_inputs():
+    atom = pn.Atom('S', 2)
+    wave = (6716, 6731)
+    table = EmissivityTable(atom, wave, 'wave', nTem=50, nDen=41, cache=False)
+
+    scalar = table.getEmissivity(1e4, 1e3)
+    assert scalar.shape == (2,)
+
+    den = np.geomspace(1e1, 1e4, 12).reshape(3, 4)
+    emiss = table.getEmissivity(1e4, den)
+    assert emiss.shape == (2, 3, 4)
+    assert np.allclose(emiss[:, 0, 0], table.getEmissivity(1e4, den[0, 0]))
+
+def test_table_out_of_grid_uses_atom():
+    """
+    Cells outside of the tabulated grid are computed directly with the
+    atom, so they agree with the native solver to round-off.
+    """
+    atom = pn.Atom('O', 3)
+    wave = (4363, 5007)
+    table = EmissivityTable(atom, wave, 'wave', temRange=(5e3, 2e4),
+        denRange=(1e1, 1e5), nTem=50, nDen=41, cache=False)
+
+    tem = np.array([3e3, 3e4, 1e4, 1e4])
+    den = np.array([1e2, 1e2, 1e0, 1e7])
+    emiss = table.getEmissivity(tem, den)
+    ref = getLineEmissivity(atom, wave, 'wave', tem, den, solver="native")
+
+    assert np.allclose(emiss, ref, rtol=1e-12)
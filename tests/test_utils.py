@@ -0,0 +1,46 @@
+import os, sys; sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import numpy as np
+import pytest
+
+from nebulous import utils
+from nebulous.utils import getCoordinates, getOpenCoordinates, getRadialDistance
+
+
+dim = (9, 12, 7)
+
+def getMeshgrid(dim):
+    return np.meshgrid(*(np.arange(n) - 0.5 * (n - 1) for n in dim), indexing='ij')
+
+def test_coordinates_match_meshgrid():
+    for a, b in zip(getCoordinates(dim), getMeshgrid(dim)):
+        assert a.shape == dim
+        assert np.array_equal(a, b)
+
+    x, y, z = getMeshgrid(dim)
+    assert np.array_equal(getRadialDistance(dim, chunk=20), np.sqrt(x**2 + y**2 + z**2))
+
+def test_grids_are_read_only():
+    x, y, z = getCoordinates(dim)
+    for grid in (x, getOpenCoordinates(dim)[1], getRadialDistance(dim)):
+        assert not grid.flags.writeable
+        with pytest.raises(ValueError):
+            grid[0] = 1.
+
+    writable = np.array(x)
+    writable[0] = 1.
+
+def test_grid_cache_size(monkeypatch):
+    monkeypatch.setattr(utils, 'gridCacheSize', 1)
+    monkeypatch.setattr(utils, 'radius_dict', {})
+    monkeypatch.setattr(utils, 'coordinate_dict', {})
+
+    first = getRadialDistance(dim)
+    assert getRadialDistance(dim) is first
+    getRadialDistance((5, 5, 5))
+    assert list(utils.radius_dict) == [(5, 5, 5)]
+
+    # Without caching, the grids are still returned
+    monkeypatch.setattr(utils, 'gridCacheSize', 0)
+    assert getRadialDistance((6, 6, 6)).shape == (6, 6, 6)
+    assert len(getOpenCoordinates((6, 6, 6))) == 3
+    assert (6, 6, 6) not in utils.radius_dict